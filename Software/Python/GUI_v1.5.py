@@ -23,7 +23,7 @@ from    stethoscopeProtocol         import  *		                # import all func
 from    bluetoothProtocol_teensy32  import  *		                # import all functions from the bluetooth protocol -teensy3.2
 import  stethoscopeDefinitions      as      definitions                 # Import definiotns [Are we even using those???]
 import  sys, time, bluetooth, serial, argparse                          # 'nuff said
-import  pexpect                                                         # Child process spawning and STDOUT redirection
+from    dialIPC                     import  runDial, DialRefused        # Structured updates from the dial process
 #import  pressureDialGauge_GUI                                           # Import pressureDialGauge
 
 
@@ -261,37 +261,38 @@ class GUI(object):
             pass
         
         # Construct command to pass to shell
-        cmd = "python pressureDialGauge_GUI.py --stethoscope %s --mode %s" %( self.stt, self.mde )
-
-        # Start BloodPressureCuff meter
-        child = pexpect.spawn(cmd, timeout=None)                        # Spawn child
-
-        for line in child:                                              # Read STDOUT ...
-            out = line.strip('\n\r')                                    # ... of spawned child ...
-            print( out )                                                # ... process and print.
-
-            out_SIM = out.split()                                       # Here is where we read pressure
-            if( out_SIM[0] == "SIM" ):                                  # ABPC GUI has "pressure" printed ...
-                SIM = out_SIM[1]                                        # ... before the numerical value
-
-                # We update the value on the message box
-                self.app.queueFunction( self.app.setMessage(self.str_name['3'], SIM) )
-                '''
-                We could also do many other things here, like
-                check if we are in a specified interval.
-                Or maybe send bytes to the stethoscope.
-                Or God knows what we want to do.
-                Your imagination is the limit (...and computing power)
-
-                if( (mmHg >= 75 and mmHg <=100) and ( rot >= 1 and rot <= 2) and ( prox >=0.1 and prox<= 1.0 ) ):
-                    startBlending( self.rfObject, definitions.ESMSYN )
-
-                else: I would like to have Jennifer Aniston's babies
-                '''
-                
-        child.close()                                                   # Kill child process
+        cmd = [ "python", "pressureDialGauge_GUI.py", "--stethoscope", self.stt, "--mode", self.mde ]
+
+        # Start BloodPressureCuff meter, it pushes its readings over dialIPC
+        try:
+            runDial( cmd, self.dialMessage )                            # Returns when the dial exits
+        except DialRefused as instance:                                 # cuffDaemon serves another launcher
+            print( fullStamp() + " Cuff daemon is " + instance.args[0] + ", try again later" )
         closeBTPort( self.rfObject )                                    # Close BT connection
         
+# ------------------------------------------------------------------------    
+
+    def dialMessage( self, name, values ):
+        '''
+        Handle a message of the dial process (see dialIPC.py for the schema).
+        '''
+
+        if( name == "state" ):                                          # Simulation band entered/left
+            SIM = str( bool(values[0]) )
+
+            # We update the value on the message box
+            self.app.queueFunction( self.app.setMessage, self.str_name['3'], SIM )
+            '''
+            We could also do many other things here, like
+            check if we are in a specified interval.
+            Or maybe send bytes to the stethoscope.
+            Or God knows what we want to do.
+            Your imagination is the limit (...and computing power)
+            '''
+
+        elif( name == "event" ):
+            print( fullStamp() + " Dial: " + values[0] )
+
 # ------------------------------------------------------------------------    
 
 # Define required parameters
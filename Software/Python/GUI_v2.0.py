@@ -21,8 +21,10 @@ from    stethoscopeProtocol         import  *		                # import all func
 from    bluetoothProtocol_teensy32  import  *		                # import all functions from the bluetooth protocol -teensy3.2
 import  stethoscopeDefinitions      as      definitions                 # Import definiotns [Are we even using those???]
 import  sys, time, bluetooth, serial, argparse                          # 'nuff said
-import  pexpect                                                         # Child process spawning and STDOUT redirection
+from    dialIPC                     import  runDial                     # Structured updates from the dial process
 import  pressureDialGauge_GUI                                           # Import pressureDialGauge
+from    sessionWorkflow             import  SessionWorkflow, Step, \
+                                            WAITING, FAILED             # Non-blocking session steps
 
 
 class GUI(object):
@@ -248,7 +250,7 @@ class GUI(object):
 
     def start_stt( self, prompt ):
         '''
-        Start stethoscope for recording.
+        Start the session (see sessionWorkflow.py); returns at once.
         
         INPUTS:
             - prompt: Indicate whether the appropriate button was pressed or not
@@ -257,48 +259,24 @@ class GUI(object):
             - NON
         '''
 
-        # Define important variables
-        port = 1                                                        # Specify port to connect through
-        snd  = 'H'                                                      # 'H'eartbeat sound
-
-        # Construct destination
-        self.dst = "%s%s%s%s" %( snd,                                   # Sound
-                                 self.usr,                              # SP ID
-                                 self.cty,                              # City
-                                 fullStamp()[2:4] )                     # Time
-
-        # Establish connection
-        self.rfObject = createBTPort( self.stt, port )                  # Connect to device
-        self.status   = statusEnquiry( self.rfObject )                  # Send an enquiry byte
-
-        # Check returned byte
-        if( self.status == True ):
-            if( self.mde == "REC" ):
-                startCustomRecording( self.rfObject, self.dst )         # Start recording
-            else: startBlending( self.rfObject, definitions.ESMSYN )    # Start simulation
-##            else: startBlending( self.rfObject, definitions.EHBREC )    # Start simulation
-
-            startTime = time.time()                                     # Start timer
-
-        else:                                                           # Else ...
-            closeBTPort( self.rfObject )                                # Close connection
-            self.app.stop()                                             # Kill program
-
-        # This is me wasting time
-        while( time.time() - startTime < 10 ):                           # Ensure that user records at least this much time
-##            print( time.time() - startTime )
-            pass
-
-        # Proceed
-        row = self.app.getRow()-1                                       # Get current row and go up one
-        self.app.addNamedButton( "Stop", "Stop",                        # Make 'Stop' visitble and link to start_bpc()
-                                 self.start_bpc, row, 1  )              # Place to the right.
+        self.app.disableButton( "Start" )                               # One session at a time
+        self.stethName = self.app.getOptionBox( "Steth.\t" )            # Widgets are read on this thread only
+        self.workflow = SessionWorkflow( [ Step( "connect",    self.connectStep ),
+                                           Step( "record",     self.recordStep,    # Record at least 10 sec
+                                                 minDuration=10, gate="stop" ),    # ... until 'Stop'
+                                           Step( "stop",       self.stopStep ),
+                                           Step( "launchCuff", self.cuffStep ),
+                                           Step( "collect",    self.collectStep ) ],
+                                         post    = self.app.queueFunction,         # Handlers run on the GUI thread
+                                         onState = self.sessionState,
+                                         onDone  = self.sessionDone )
+        self.workflow.start()
         
 # ------------------------------------------------------------------------
 
     def start_bpc( self, prompt ):
         '''
-        Start Blood Pressure Cuff.
+        Stop recording and start the Blood Pressure Cuff.
         
         INPUTS:
             - prompt: Indicate whether the appropriate button was pressed or not
@@ -307,7 +285,50 @@ class GUI(object):
             - NON
         '''
 
-        # Define important variables
+        if( prompt == "Stop" ):
+            self.app.disableButton( "Stop" )                            # Pressed once
+            self.workflow.trigger( "stop" )                             # Record step may end now
+
+        else: self.app.stop()                                           # Kill program
+
+# ------------------------------------------------------------------------
+# Session steps, run in order on the workflow's worker thread
+# ------------------------------------------------------------------------
+
+    def connectStep( self, context ):
+        port = 1                                                        # Specify port to connect through
+
+        # Establish connection
+        self.rfObject = createBTPort( self.stt, port )                  # Connect to device
+        self.status   = statusEnquiry( self.rfObject )                  # Send an enquiry byte
+
+        # Check returned byte
+        if( self.status != True ):
+            closeBTPort( self.rfObject )                                # Close connection
+            raise IOError( "Stethoscope did not acknowledge" )
+
+    def recordStep( self, context ):
+        snd = 'H'                                                       # 'H'eartbeat sound
+
+        # Construct destination
+        self.dst = "%s%s%s%s" %( snd,                                   # Sound
+                                 self.usr,                              # SP ID
+                                 self.cty,                              # City
+                                 fullStamp()[2:4] )                     # Time
+
+        if( self.mde == "REC" ):
+            startCustomRecording( self.rfObject, self.dst )             # Start recording
+        else: startBlending( self.rfObject, definitions.ESMSYN )        # Start simulation
+##        else: startBlending( self.rfObject, definitions.EHBREC )        # Start simulation
+
+    def stopStep( self, context ):
+        # Disconnect device
+        if( self.mde == "REC" ): stopRecording( self.rfObject )         # Stop recording
+        else: stopBlending( self.rfObject )                             # Stop simulation
+
+        closeBTPort( self.rfObject )                                    # Close connection
+
+    def cuffStep( self, context ):
         snd = 'K'                                                       # 'K'orotkoff sound
 
         # Construct destination
@@ -316,40 +337,57 @@ class GUI(object):
                                  self.cty,                              # City
                                  fullStamp()[2:4] )                     # Time
 
-        if( prompt == "Stop" ):
+        # Print diagnostic information
+        print( "Using Stethoscope %s with address %s"                   # Inform user which ...
+               %(self.stethName, self.stt) )                            # ... stethoscope is used
+        print( "Storing under: %s\n" %self.dst )                        # Inform of destination
 
-            # Disconnect device
-            if( self.mde == "REC" ): stopRecording( self.rfObject )     # Stop recording
-            else: stopBlending( self.rfObject )                         # Stop simulation
+        # Construct command to pass to shell
+        cmd = [ "python", "pressureDialGauge_GUI.py", "--directory", self.cty, "--destination", self.dst,
+                "--stethoscope", self.stt, "--mode", self.mde ]
 
-            closeBTPort( self.rfObject )                                # Close connection
+        # Start BloodPressureCuff meter, it pushes its readings over dialIPC
+        context["dialExit"] = runDial( cmd, self.dialMessage )          # Returns when the dial exits
 
-            # Print diagnostic information
-            print( "Using Stethoscope %s with address %s"               # Inform user which ...
-                   %(self.app.getOptionBox( "Steth.\t" ), self.stt) )   # ... stethoscope is used
-            print( "Storing under: %s\n" %self.dst )                    # Inform of destination
+    def collectStep( self, context ):
+        context["destination"] = self.dst                               # Last recording made
 
-            # Construct command to pass to shell
-            cmd = "python pressureDialGauge_GUI.py --directory %s --destination %s --stethoscope %s --mode %s" %( self.cty,
-                                                                                                                  self.dst,
-                                                                                                                  self.stt,
-                                                                                                                  self.mde )
+# ------------------------------------------------------------------------
+# Session handlers, run on the GUI thread
+# ------------------------------------------------------------------------
 
-            # Start BloodPressureCuff meter
-            child = pexpect.spawn(cmd, timeout=None)                    # Spawn child
+    def sessionState( self, step, state ):
+        print( fullStamp() + " Session %s: %s" %(step, state) )
 
-            for line in child:                                          # Read STDOUT ...
-                out = line.strip('\n\r')                                # ... of spawned child ...
-                print( out )                                            # ... process and print.
+        if( step == "record" and state == WAITING ):                    # Recorded long enough
+            row = self.app.getRow()-1                                   # Get current row and go up one
+            self.app.addNamedButton( "Stop", "Stop",                    # Make 'Stop' visitble and link to start_bpc()
+                                     self.start_bpc, row, 1  )          # Place to the right.
 
-            child.close()                                               # Kill child process
+    def sessionDone( self, state, context ):
+        print( self.workflow.report() )                                 # Step durations
 
-        else: self.app.stop()                                           # Kill program
+        if( state == FAILED ):
+            self.app.stop()                                             # Kill program
+            return
 
         # Cleanup and return to previous window
         self.app.destroySubWindow( self.win_name['2'] )                 # Destroy subWindow (2)
         self.app.showSubWindow( self.win_name['1'] )                    # Reopen  subWindow (1)
         
+# ------------------------------------------------------------------------    
+
+    def dialMessage( self, name, values ):
+        '''
+        Handle a message of the dial process (see dialIPC.py for the schema).
+        '''
+
+        if( name == "state" ):                                          # Simulation band entered/left
+            print( "SIM %r" %bool(values[0]) )
+
+        elif( name == "event" ):
+            print( fullStamp() + " Dial: " + values[0] )
+
 # ------------------------------------------------------------------------    
 
 # Define required parameters
@@ -27,16 +27,24 @@ from    appJar                      import  gui                         # Import
 from    timeStamp                   import  fullStamp                   # Show date/time on console output
 from    stethoscopeProtocol         import  *		                # Import all functions from the stethoscope protocol
 from    bluetoothProtocol_teensy32  import  *		                # Import all functions from the bluetooth protocol -teensy3.2
+from    dialIPC                     import  runDial, DialRefused        # Structured updates from the dial process
+from    mqttIngest                  import  MqttIngest                  # Cuff IMU data straight from the broker
 from    threading                   import  Thread                      # Mulithreading
 import  Queue                       as      qu
 import  stethoscopeDefinitions      as      definitions                 # Import definiotns [Are we even using those???]
-import  sys, time, bluetooth, serial, argparse, pexpect                 # 'nuff said
+import  sys, time, bluetooth, serial, argparse                          # 'nuff said
 
 from    configurationProtocol       import  *
+from    connectionManager           import  ConnectionManager           # Owns the stethoscope links
+from    startupOrchestrator         import  startDevices                # Concurrent startup of the panel's devices
+from    playbackStateMachine        import  PlaybackStateMachine        # Start/stop blending on input changes
+from    sensorFusion                import  FusionEngine                # Time-aligned pressure + IMU conditions
+from    guiUpdateBus                import  GuiUpdateBus                # Batched, change-only label updates
+from    panelConfig                 import  loadPanelConfig             # Panel parameters (see panelConfig.py)
 
 class GUI(object):
 
-    def __init__( self, logo, img, addr, MQTThost, MQTTtopic ):
+    def __init__( self, logo, img, addr, MQTThost, MQTTtopic, links=None ):
         '''
         Create a GUI for interfacing Stethoscope and Blood Pressure Cuff.
 
@@ -44,6 +52,7 @@ class GUI(object):
             - logo : Absolute path to the pd3d logo as a string.
             - img  : Absolute path to the instructional image as a string.
             - addr : A list containing the mac addresses of stethoscopes.
+            - links: ConnectionManager already connecting them (optional).
         '''
         # Set MQTT attributes.
         self.MQTThost = MQTThost
@@ -56,6 +65,15 @@ class GUI(object):
         self.rollState = False
         self.playbackState = False
 
+        # Pressure and IMU samples are fused on one timeline (see sensorFusion.py) and
+        # playback follows the joint condition (see playbackStateMachine.py).
+        self.fusion = FusionEngine()
+        self.fusion.addCondition( "korotkoff",
+                                  [ (lambda state: state["Hmag"] > 1.5, 0.2),   # Stethoscope at the cuff for 200 ms ...
+                                    (lambda state: state["inBand"], 0.0) ],     # ... while the pressure is in band
+                                  onChange=self.fusionChanged )
+        self.playback = PlaybackStateMachine( requires=("korotkoff",), onChange=self.playbackChanged )
+
         # Retrieve the size of the screen: (manually defined for now)
         # self.getScreenSize()
         self.pad = 5
@@ -72,10 +90,16 @@ class GUI(object):
 
         # Store stethoscopes in a dictionary
         self.stt_addr = dict()                                          # Create empty dictionary
-        self.handle   = [None]*
         for i in range( len(addr) ):                                    # Loop over addresses 
             handle = "AS%03d" %(i+1)                                    # Construct handle
             self.stt_addr[ handle ] = addr[i]                           # Store into dictionary
+
+        # Connect to every stethoscope in the background and keep the links warm
+        if( links is None ):
+            links = ConnectionManager( addr ).start()
+        self.links = links
+        self.linkLabel = None                                           # Created with the MQTT window
+        self.links.monitor.onWarning = self.linkWarning                 # Early warnings from linkHealth
         
         # ProceedS
         self.main()                                                     # Launch the main window
@@ -105,6 +129,7 @@ class GUI(object):
         self.app.setSize( "fullscreen" )                                # Launch in fullscreen
         self.app.setBg( "black" )                                       # Set GLOBAL background color
         self.app.setFont( size=20 )                                     # Set GLOBAL font size
+        self.bus = GuiUpdateBus( self.app, fps=20 ).start()             # Label updates from other threads
 
         ## Populating the primary window with labels and widgets:
         # Setup the title section: Row 0
@@ -183,9 +208,6 @@ class GUI(object):
 
                 # Begin separate thread for MQTT.
                 self.app.thread( self.MQTTupdate, proxOut, pitchOut, rOut, connection )
-
-                # Begin separate thread for playing or disabling the audio on the stethoscope.
-                self.app.thread( self.sttCommands)
                 
                 ## Set the parameters for the sub window: "MOSQUITTO Output"
                 self.app.startSubWindow( self.subwindow['1'], modal=True )
@@ -226,7 +248,13 @@ class GUI(object):
                 self.app.setLabelBg( rOut, "red")
                 row = row + 1
 
-                # Setup the Exit Button: Row 5
+                # Setup the Stethoscope link section: Row 5
+                self.app.addLabel( "sttLink", "Stethoscope", row, 0, colspan=2 )
+                self.app.setLabelBg( "sttLink", "green" )
+                self.linkLabel = "sttLink"
+                row = row + 1
+
+                # Setup the Exit Button: Row 6
                 self.app.setSticky("")
                 self.app.addNamedButton( "Quit", quitButton2, self.app.stop, row, 0, colspan=2 )
 
@@ -249,16 +277,16 @@ class GUI(object):
         print( "Using Stethoscope %s with address %s"                   # Inform user which ...
                %(self.app.getOptionBox( "Steth.\t" ), self.stt) )       # ... stethoscope is used
 
-        # Establish connection
-        port = 1                                                        # Specify port to connect through
-        self.rfObject = createBTPort( self.stt, port )                  # Connect to device
-        self.status   = statusEnquiry( self.rfObject )                  # Send an enquiry byte
+        # Establish connection (the connection manager is already on it)
+        self.link     = self.links.link( self.stt )                     # Link to the chosen stethoscope
+        self.status   = self.link.waitUp( 10 )                          # Wait for the ENQ/ACK handshake
+        self.playback.attach( self.link.submit )                        # Commands go to this link from now on
 
         if( self.status != 1 ):                                         # ...
-            print( "Device reported back NAK. Troubleshoot device" )    # ...
-            print( "Program will now exit." )                           # If the device reports back NAK
-            closeBTPort( self.rfObject )                                # Kill everything
-            sleep( 5.0 )                                                # ...
+            print( "Device did not come up. Troubleshoot device" )      # ...
+            print( "Program will now exit." )                           # If the device never ACKs
+            self.links.stop()                                           # Kill everything
+            time.sleep( 5.0 )                                           # ...
             self.app.stop()                                             # ...
 
         else:
@@ -266,141 +294,96 @@ class GUI(object):
 
         print( "Launching BP Cuff Pressure Dial..." )
         # Construct command to pass to shell
-        cmd = "python pressureDialGauge_GUI.py --stethoscope %s --mode %s" %( self.stt, self.mde )
+        cmd = [ "python", "pressureDialGauge_GUI.py", "--stethoscope", self.stt, "--mode", self.mde ]
 
-        # Start BloodPressureCuff meter
-        cuff = pexpect.spawn(cmd, timeout=None)                         # Spawn child
+        # Start BloodPressureCuff meter, it pushes its readings over dialIPC
+        try:
+            runDial( cmd, self.dialMessage )                            # Returns when the dial exits
+        except DialRefused as instance:                                 # cuffDaemon serves another launcher
+            print( fullStamp() + " Cuff daemon is " + instance.args[0] + ", try again later" )
+        
+# ------------------------------------------------------------------------
 
-        # Moe didn't explain how this works very well, but apparently "line" represents an iterable that is populated by the output of "cuff".
-        # Furthermore, the output of "cuff" is not the same as the evaluation of "cuff"
-        for line in cuff:                                               # Read STDOUT ...
-            out = line.strip('\n\r')                                    # ... of spawned child ...
-            #print( out )                                                # ... process and print.
+    def playbackChanged( self, playing ):
+        '''
+        Called by the playback state machine after it started or stopped blending.
+        '''
+        self.playbackState = playing
 
-            out_SIM = out.split()                                       # Here is where we read pressure
-            if( out_SIM[0] == "SIM" ):                                  # ABPC GUI has "SIM" printed ...
+# ------------------------------------------------------------------------
 
-                # Only send the byte if it has never done that before.
-                if( out_SIM[1] == "True"):    # ... before the boolean state
-                    self.pressureState = True
+    def fusionChanged( self, name, active, at ):
+        '''
+        Called by the fusion engine when a joint condition changed (at: timeline time).
+        '''
+        self.playback.set( name, active, at )
+
+# ------------------------------------------------------------------------
+
+    def dialMessage( self, name, values ):
+        '''
+        Handle a message of the dial process (see dialIPC.py for the schema).
+        '''
+
+        if( name == "sample" ):
+            self.pressure = values[1]                                   # Latest reading in mmHg
+            self.fusion.push( "pressure", {"mmHg": self.pressure, "inBand": self.pressureState} )
+
+        elif( name == "state" ):
+            self.pressureState = bool( values[0] )                      # Within the simulation band
+            self.fusion.push( "pressure", {"inBand": self.pressureState} )
+
+        elif( name == "event" ):
+            print( fullStamp() + " Dial: " + values[0] )
+
+# ------------------------------------------------------------------------
+
+    def linkWarning( self, address, kind, value ):
+        '''
+        Show link quality warnings of the chosen stethoscope (called from linkHealth).
+        '''
+
+        if( self.linkLabel is None or address != getattr(self, "stt", None) ):
+            return
+
+        color = { "ok": "green", "slow": "orange", "lossy": "orange",
+                  "silent": "red", "down": "red" }[ kind ]
+        self.bus.set( "setLabel", self.linkLabel, "Stethoscope (%s)" %kind )
+        self.bus.set( "setLabelBg", self.linkLabel, color )
 
-                else:
-                    self.pressureState = False                    
-                
-        cuff.close()                                                   # Kill child process
-        closeBTPort( self.rfObject )                                    # Close BT connection
-        
 # ------------------------------------------------------------------------
     def MQTTupdate(self, proxOut, pitchOut, rOut, connection):
             # Delay, to let the window come up!
             time.sleep(3)
             
-            # Beginning the connection.
-            initialState = True
-
-            ## Using pexpect to interface with bash and linux mosquitto_clients.
+            ## Subscribe in-process (see mqttIngest.py), reconnecting in the background.
             print("Connecting to MQTT Client...")
-            mqttBash = "mosquitto_sub -h " + self.MQTThost + " -t " + self.MQTTtopic
-            mqttClient = pexpect.spawn(mqttBash, timeout=None)
+            self.mqtt = MqttIngest( self.MQTThost, [self.MQTTtopic] ).start()
 
             #Loop forever, until program exit.
             while(True): 
-                # This is the same delay the Arduino program uses to publish to MQTT.
-                # time.sleep(0.5)
-
-                # Read a line from MQTT output in the terminal.
-                # It is in format: "SENSORID,Hmag,pitch,roll,LOCATIONID" 
-                mqttLine = mqttClient.readline()
-                mqttOutput = mqttLine.split(",")
-
-                if (mqttOutput[0] == "BPCUFFSENS" ):
-                    Hmag = float(mqttOutput[1])
-                    pitch = float(mqttOutput[2])
-                    roll = float(mqttOutput[3])
-                    print Hmag, pitch, abs(roll), self.proximityState, self.pressureState, self.playbackState
-
-                    if (initialState == True):
-                    # Update MQTT Connection Label, once connected.
-                        self.app.queueFunction( self.app.setLabel(connection, "MQTT Connected") )
-                        self.app.queueFunction( self.app.setLabelBg(connection, "green") )
-                        initialState = False
-
-                    ## Only update the window if and only if there was a state CHANGE:
-                    # Proximity Label:
-                    if (Hmag > 1.5):
-                        if (self.proximityState == False):
-                            # Previous state "NO", a change in state was observed.
-                            # Update the proximity label to "OK"
-                            self.app.queueFunction( self.app.setLabelBg(proxOut, "green") )
-                            self.proximityState = True
-                    else:
-                        if (self.proximityState == True):
-                            # Previous state "OK", a change in state was observed.
-                            # Update the proximity label to "NO"
-                            self.app.queueFunction( self.app.setLabelBg(proxOut, "red") )
-                            self.proximityState = False
-
-                    # Pitch Label:
-                    if ( pitch < 80 and pitch >30 ):
-                        if (self.pitchState == False):
-                            # Previous state "NO", a change in state was observed.
-                            # Update the pitch label to "OK"
-                            self.app.queueFunction( self.app.setLabelBg(pitchOut, "green") )
-                            self.pitchState = True
-                    else:
-                        if (self.pitchState == True):
-                            # Previous state "OK", a change in state was observed.
-                            # Update the proximity label to "NO"
-                            self.app.queueFunction( self.app.setLabelBg(pitchOut, "red") )
-                            self.pitchState = False
-
-                    # Roll Label:
-                    if ( abs(roll) < 30 ):
-                        if (self.rollState == False):
-                            # Previous state "NO", a change in state was observed.
-                            # Update the roll label to "OK"
-                            self.app.queueFunction( self.app.setLabelBg(rOut, "green") )
-                            self.rollState = True
-                    else:
-                        if (self.rollState == True):
-                            # Previous state "OK", a change in state was observed.
-                            # Update the roll label to "NO"
-                            self.app.queueFunction( self.app.setLabelBg(rOut, "red") )
-                            self.rollState = False
-                            
-# ------------------------------------------------------------------------
-    def sttCommands(self):
-        # Simple delay to let Bluetooth connect and self.rfObject to resolve.
-        time.sleep(5)
-
-        # Loop to check the stethoscope audio playback conditions.
-        while(True):
-            time.sleep(0.5)
-            #print self.proximityState, self.pressureState, self.playbackState
-
-            # Check the condition.
-            if (self.proximityState and self.pressureState):
-
-                # If the condition is met, check to see if it is already playing a sound.
-                if(self.playbackState==False):
-                    
-                    # If it is not, then play the sound.
-                    startBlending( self.rfObject, definitions.KOROT )
-
-                # Regardless, set the playback state to True. (So, above only runs once!)
-                self.playbackState=True
-                    
-            # If the condition is NOT met, check to see if it is already playing a sound.
-            else:
-
-                # If it is, then stop the sound.
-                if(self.playbackState==True):
-                    stopBlending( self.rfObject )
-
-                self.playbackState=False
-                    
-  
-    
+                # Take whatever arrived since the last pass (parsed in one batch).
+                # Only the newest reading matters for the labels.
+                readings = self.mqtt.get( timeout=1.0 )
+                for reading in readings:                                # Every sample, stamped on reception
+                    self.fusion.push( "imu", {"Hmag": reading.Hmag, "pitch": reading.pitch,
+                                              "roll": reading.roll}, reading.receivedAt )
+                self.fusion.poll()                                      # Hold times that ran out meanwhile
+                if( readings ):
+                    Hmag, pitch, roll = readings[-1].Hmag, readings[-1].pitch, readings[-1].roll
+
+                    # Update MQTT Connection Label (applied once, unchanged after).
+                    self.bus.set( "setLabel", connection, "MQTT Connected" )
+                    self.bus.set( "setLabelBg", connection, "green" )
+
+                    ## Post the desired state every time; the bus only repaints
+                    ## a label when its state CHANGED, once per frame.
+                    self.proximityState = Hmag > 1.5                    # Proximity Label
+                    self.pitchState = pitch < 80 and pitch > 30         # Pitch Label
+                    self.rollState = abs(roll) < 30                     # Roll Label
+                    self.bus.set( "setLabelBg", proxOut, "green" if self.proximityState else "red" )
+                    self.bus.set( "setLabelBg", pitchOut, "green" if self.pitchState else "red" )
+                    self.bus.set( "setLabelBg", rOut, "green" if self.rollState else "red" )
 # ------------------------------------------------------------------------ 
 
 # Define required parameters:
@@ -415,10 +398,12 @@ deviceID_list = ("{}/panel{}devices.txt").format(dataDir, panelID)       # Defin
 _, _, bt_address_list = panelDeviceID( deviceID_list, panelID )
 
 sttaddr = [ bt_address_list[0] ]                                        # Get stethoscope address
+links, _ = startDevices( bt_address_list )                              # Bring up every device of the panel at once
 
 
-mqtthost = "192.168.42.1"
-mqtttopic = "csec/device/bpcuff_1"
+params = loadPanelConfig( dataDir ).current                             # Broker from the panel config
+mqtthost = params.mqttHost
+mqtttopic = params.mqttTopic
 
 # START!
-display = GUI( logo, img, sttaddr, mqtthost, mqtttopic )
+display = GUI( logo, img, sttaddr, mqtthost, mqtttopic, links )
@@ -21,24 +21,32 @@ import bluetooth
 import  os, time, serial
 import  protocolDefinitions as definitions
 from    timeStamp           import *
+from    discoveryService    import DiscoveryService
+from    latencyStats        import stats                                                    # Round-trip histograms
+from    rfcommBinding       import binder, openSerialPort                                   # In-process rfcomm bind/release
+
+# Cached discovery
+#   Inquiries run in the background (see discoveryService.py); the functions below answer from its cache
+#   and only wait for an inquiry when the cache has nothing to offer (e.g. the very first run)
+discovery = DiscoveryService( duration=5 )
+INQUIRY_WAIT = 5*1.28 + 2                                                                   # One inquiry plus name lookups (sec)
 
 # Find RF Device
-#   This function uses the hardware of the peripheral device or control system to scan/find bluetooth enabled devices
+#   This function returns the bluetooth enabled devices seen by the discovery service
 #   This function does not differenciate among found devices
 #   Input   ::  None
 #   Output  ::  {array, list} "availableDeviceNames", "availableDeviceBTAddresses"
 def findDevices():
     print( fullStamp() + " findDevices()" )
     
-    devices = bluetooth.discover_devices( duration=5, lookup_names=True)
-    Ndevices = len(devices)                                                                 # Number of detected devices
+    devices = discovery.start().devices( wait=INQUIRY_WAIT )
     availableDeviceNames = []                                                               # Initialized arrays/lists for device names...
     availableDeviceBTAddresses = []                                                         # ...and their bluetooth addresses
 
-    for i in range(0,Ndevices):                                                             # Populate device name and bluetooth address arrays/lists with a for-loop
+    for address, entry in devices:                                                          # Populate device name and bluetooth address arrays/lists with a for-loop
 
-        availableDeviceNames.append(devices[i][1])
-        availableDeviceBTAddresses.append(devices[i][0])
+        availableDeviceNames.append(entry["name"])
+        availableDeviceBTAddresses.append(address)
         
     print( fullStamp() + " Devices found (names): " + str(availableDeviceNames) )           # Print the list of devices found
     print( fullStamp() + " Devices found (addresses): " + str(availableDeviceBTAddresses) ) # Print the list of addresses for the devices found
@@ -46,25 +54,21 @@ def findDevices():
     return availableDeviceNames, availableDeviceBTAddresses                                # Return arrays/lists of devices and bluetooth addresses
 
 # Identify Smart Device - Specific
-#   This function searches through the list of detected devices and finds the specific smart device corresponding to the input name
+#   This function looks up the specific smart device corresponding to the input address in the discovery cache
 #   Input   ::  {string}     "smartDeviceAddress"
 #   Output  ::  {array/list} "smartDeviceNames", "smartDeviceBTAddresses"
 def findSmartDevice( address_device2find ):
     print( fullStamp() + " findSmartDevice()" )
     
-    devices = bluetooth.discover_devices( duration=5, lookup_names=True )
-    availableDeviceName = []
-    availableDeviceBTAddress = []
-
-    for i in range( 0, len(devices) ):
-        if devices[i][0] == address_device2find:
-            availableDeviceName.append(devices[i][1])
-            availableDeviceBTAddress.append(devices[i][0])
+    entry = discovery.start().lookup( address_device2find, wait=INQUIRY_WAIT )
+    if entry is not None:
+        availableDeviceName = [entry["name"]]
+        availableDeviceBTAddress = [address_device2find]
             
-            print( fullStamp() + " Found device with name: " + str(availableDeviceName) )
-            print( fullStamp() + " Found device with address: " + str(availableDeviceBTAddress) )
+        print( fullStamp() + " Found device with name: " + str(availableDeviceName) )
+        print( fullStamp() + " Found device with address: " + str(availableDeviceBTAddress) )
 
-            return availableDeviceName, availableDeviceBTAddress
+        return availableDeviceName, availableDeviceBTAddress
 
     print( fullStamp() + " Device with address " + address_device2find + " not found" )
     return 0, 0
@@ -75,8 +79,8 @@ def createBTPort( bt_addr, port ):
     if bluetooth.is_valid_address(bt_addr) is True:                 # Check if address is valid
         socket = bluetooth.BluetoothSocket( bluetooth.RFCOMM )      # Create a BT socket
         socket.connect( (bt_addr, port) )                           # Connect to socket
-        time.sleep(1)
-        BTconnectionCheck( socket )
+        BTwaitReady( socket )                                       # Poll ENQ instead of sleeping
+        discovery.linkActive( socket, True )                        # No background inquiry while it is live
         return(socket)
     else:
         print( fullStamp() + " Invalid BT address" )
@@ -85,21 +89,84 @@ def createBTPort( bt_addr, port ):
 #   Connection Check
 def BTconnectionCheck( socket ):
     outByte = definitions.ENQ
+    t0 = monotonic()
     socket.send(outByte)
     inByte = socket.recv(1)     # recv(buffersize)
 
     if inByte == definitions.ACK:
+        stats.record( "statusEnquiry", monotonic() - t0, "ACK" )
         print( fullStamp() + " ACK Connection Established" )
     
     elif inByte == definitions.NAK:
+        stats.record( "statusEnquiry", monotonic() - t0, "NAK" )
         print( fullStamp() + " NAK device NOT READY" )
 
     else:
+        stats.record( "statusEnquiry", None, "ERROR" )
         print( fullStamp() + " Please troubleshoot devices" )
 
+#   Drain
+#   Reads and discards whatever arrives within "wait" sec of quiet (e.g. a late ACK to a timed out ENQ)
+#   Input   ::  {socket} "socket", {float} "wait" (sec)
+#   Output  ::  {int}    number of bytes discarded
+def BTdrain( socket, wait ):
+    discarded = 0
+    socket.settimeout( wait )
+    while True:
+        try:
+            data = socket.recv(64)
+        except Exception as instance:
+            if "timed out" not in str(instance):
+                raise
+            return discarded
+        if not data:
+            return discarded
+        discarded = discarded + len(data)
+
+#   Readiness Check
+#   Polls ENQ until the device ACKs (a NAK or no answer means it is not ready yet)
+#   An ENQ that timed out may still be answered, so its late answer is drained before the next ENQ,
+#   and once more after the final ACK, so it is never read as the response to a later command
+#   Input   ::  {socket} "socket", {float} "timeout", {float} "poll" (sec)
+#   Output  ::  {float}  time to ready (sec), None if the device never ACKed
+def BTwaitReady( socket, timeout=5.0, poll=0.1 ):
+    t0 = monotonic()
+    unanswered = False                                              # An ENQ timed out
+    while monotonic() - t0 < timeout:
+        try:
+            socket.settimeout( poll*5 )
+            t1 = monotonic()
+            socket.send( definitions.ENQ )
+            inByte = socket.recv(1)
+        except Exception as instance:
+            if "timed out" not in str(instance):                    # Only a missing answer is retried
+                stats.record( "statusEnquiry", None, "ERROR" )
+                raise
+            stats.record( "statusEnquiry", None, "TIMEOUT" )
+            unanswered = True
+            BTdrain( socket, poll )
+            continue
+
+        stats.record( "statusEnquiry", monotonic() - t1, "ACK" if inByte == definitions.ACK else "NAK" )
+        if inByte == definitions.ACK:
+            if unanswered:
+                BTdrain( socket, poll*5 )                           # The other ENQ's answer, if it comes
+            socket.settimeout( None )
+            print( fullStamp() + " ACK Connection Established (ready after %.2f sec)" %(monotonic() - t0) )
+            return monotonic() - t0
+
+        time.sleep( poll )                                          # NAK: device still booting
+
+    if unanswered:
+        BTdrain( socket, poll*5 )
+    socket.settimeout( None )
+    print( fullStamp() + " Device NOT READY after %.1f sec, please troubleshoot devices" %timeout )
+    return None
+
 #   Why not?
 def closeBTPort( socket ):
     print( fullStamp() + " closeBTPort()" )
+    discovery.linkActive( socket, False )
     socket.close()
     print( fullStamp() + " Port Closed" )
 
@@ -107,54 +174,45 @@ def closeBTPort( socket ):
 
 # ==========================================================================================
 # ================================== PySerial Stuff ========================================
+#   Create Port
+#   Binds the device to /dev/rfcomm<portNumber> in-process (cached across reconnects, see rfcommBinding.py)
+#   and retries the ENQ/ACK handshake a bounded number of times
+#   Input   ::  {string} "deviceName", {int} "portNumber", {string} "deviceBTAddress", {int} "baudrate", {int} "attempts"
+#   Output  ::  {serial} open port that ACKed, None if every attempt failed
 def createPort(deviceName,portNumber,deviceBTAddress,baudrate,attempts):
-    print fullStamp() + " createPort()"
-    portRelease("rfcomm",portNumber)                                                        # The program performs a port-release to ensure that the desired rf port is available
-    portBind("rfcomm",portNumber,deviceBTAddress)
-    rfObject = serial.Serial(
-        port = "/dev/rfcomm" + str(portNumber),
-        baudrate = baudrate,
-        bytesize = serial.EIGHTBITS,
-        parity = serial.PARITY_NONE,
-        stopbits = serial.STOPBITS_ONE)
-    time.sleep(1)
-    connectionCheck(rfObject,deviceName,portNumber,deviceBTAddress,baudrate,attempts)
-    rfObject.close()
-    return(rfObject)
+    print fullStamp() + " createPort() " + deviceName
+    return openSerialPort(portNumber, deviceBTAddress, baudrate, attempts=max(1, attempts))
 
 #   Connection Check
-def connectionCheck(rfObject,deviceName,portNumber,deviceBTAddress,baudrate,attempts):
-    outByte = definitions.ENQ                                                               # Send SOH (Start of Heading) byte - see protocolDefinitions.py
-    rfObject.write(outByte)
+#   Output  ::  {bool} True if the device ACKed an ENQ
+def connectionCheck(rfObject):
+    t0 = monotonic()
+    rfObject.write(definitions.ENQ)                                                         # Send ENQ byte - see protocolDefinitions.py
     inByte = rfObject.read(size=1)
     if inByte == definitions.ACK:                                                           # Check for ACK / NAK response
+        stats.record( "statusEnquiry", monotonic() - t0, "ACK" )
         print fullStamp() + " ACK Connection Established"
-        rfObject.close()
-        return rfObject
-    
+        return True
+
     elif inByte == definitions.NAK:
+        stats.record( "statusEnquiry", monotonic() - t0, "NAK" )
         print fullStamp() + " NAK device NOT READY"
 
     else:
-        rfObject.close()
-        if attempts is not 0:
-            return createPort(deviceName,portNumber,deviceBTAddress,baudrate,attempts-1,q)
-        elif attempts is 0:
-            print fullStamp() + " Attempts limit reached"
-            print fullStamp() + " Please troubleshoot devices"
+        stats.record( "statusEnquiry", None, "TIMEOUT" )
+        print fullStamp() + " Please troubleshoot devices"
+    return False
 
 # Port Bind
-#   This function binds the specified bluetooth device to a rfcomm port
+#   This function binds the specified bluetooth device to a rfcomm port (no-op if it already is)
 #   Input   ::  {string} port type, {int} port number, {string} bluetooth address of device
-#   Output  ::  None -- Terminal messages
+#   Output  ::  {string} path of the serial device
 def portBind(portType, portNumber, deviceBTAddress):
-    print fullStamp() + " Connecting device to " + portType + str(portNumber)               # Terminal message, program status
-    os.system("sudo " + portType + " bind /dev/" + portType + str(portNumber) + " " + deviceBTAddress)     # Bind bluetooth device to control system
+    return binder.bind(portNumber, deviceBTAddress)
 
 # Port Release
 #   This function releases the specified communication port (serial) given the type and the number
 #   Input   ::  {string} "portType", {int} "portNumber"
 #   Output  ::  None -- Terminal messages
 def portRelease(portType, portNumber):
-    print fullStamp() + " Releasing " + portType + str(portNumber)                          # Terminal message, program status
-    os.system("sudo " + portType + " release " + str(portNumber))                           # Releasing port through terminal commands
+    binder.release(portNumber)
@@ -13,6 +13,7 @@ Fluvio L Lobo Fenoglietto 11/15/2017
 from    os.path     import expanduser
 import  sys
 from    timeStamp   import fullStamp
+from    panelRegistry import registry, macAddress, PANEL_COLUMNS, DEVICE_COLUMNS     # Cached, indexed files
 
 # ================================================================================= #
 # Define Path
@@ -117,43 +118,38 @@ def addPaths(paths):
 def getMAC(interface):
     print( fullStamp() + " getMAC()" )
     print( fullStamp() + " Searching MAC address for " + interface + " module" )
-    try:
-        address = open("/sys/class/net/" + interface + "/address").read()[:-1]
+    address = macAddress( interface )                                               # sysfs is only read once
+    if address is None:
+        print( fullStamp() + " Failed to find address, check input interface" )
+    else:
         print( fullStamp() + " MAC (" + interface + "): " + address )
         return address
-    except:
-        print( fullStamp() + " Failed to find address, check input interface" )
 
 # ================================================================================= #
 # Self Identification
 #
 # Function to self-identify the panel using a MAC address
+# (panels.txt is loaded once by panelRegistry and reloaded when it changes)
 #
 # Fluvio L Lobo Fenoglietto 05/28/2018
 # ================================================================================= #
 def panelSelfID(id_file_path, device_address):
     print( fullStamp() + " panelSelfID()" )                                         # signals execution of the function
 
-    dataFile = open( id_file_path, 'r' )                                            # opens data file with panel information
-    line_num             = 0
-    panel_id_list        = []                                                       # define array variable
-    panel_address_list   = []
-    for line in dataFile:                                                           # for each line in the file ...
-        if len(line) <= 1:                                                          # if nothing in line ... pass
-            pass
-        elif line[0] == "#":                                                        # if line starts with number sign (= comment) ... pass
-            pass
-        else:                                                                       # in any other case ...
-            trim_line = line[:-1]                                                   # trim line by ignoring "end of line" character
-            split_line = trim_line.split(",")                                       # split line with comma delimiter (default)
-            panel_id_list.append( split_line[0] )                                   # append the first element as the number id
-            panel_address_list.append( split_line[1] )                              # append the second element as the MAC address
-            if split_line[1] == device_address:                                     # compare each address to the input panel/device MAC address
-                panel_id        = panel_id_list[line_num]                           # if so ... store id number
-                panel_address   = panel_address_list[line_num]                      # if so ... associate address too ...
-                print( fullStamp() + " Self identified as PANEL" + str(panel_id) )
-
-            line_num = line_num + 1
+    table = registry.table( id_file_path, PANEL_COLUMNS )                           # id,mac rows (malformed lines reported)
+    if table.missing():
+        raise IOError( "No such file: " + id_file_path )                            # as open() used to
+    panel_id_list        = [ fields[0] for fields in table.rows ]                   # first element is the number id
+    panel_address_list   = [ fields[1] for fields in table.rows ]                   # second element is the MAC address
+    panel_id, panel_address = None, None
+
+    match = table.index( 1, str.lower ).get( (device_address or "").lower() )       # compare the input panel/device MAC address
+    if match is not None:
+        panel_id        = match[0]                                                  # if so ... store id number
+        panel_address   = match[1]                                                  # if so ... associate address too ...
+        print( fullStamp() + " Self identified as PANEL" + str(panel_id) )
+    else:
+        print( fullStamp() + " " + str(device_address) + " is not listed in " + id_file_path )
 
     return panel_id_list, panel_address_list, panel_id, panel_address
     
@@ -161,38 +157,18 @@ def panelSelfID(id_file_path, device_address):
 # Device Identification
 #
 # Function to identify devices associated with the operating panel
+# (panel<N>devices.txt is loaded once by panelRegistry and reloaded when it changes)
 #
 # Fluvio L Lobo Fenoglietto 05/28/2018
 # ================================================================================= #
 def panelDeviceID(id_file_path, panel_id):
     print( fullStamp() + " panelDeviceID()" )
 
-    dataFile = open( id_file_path, 'r' )
-    
-    line_num                = 0
-    device_id_list          = []
-    device_name_list        = []
-    device_bt_address_list  = []
-    
-    for line in dataFile:                                                           # for each line in the file ...
-        if len(line) <= 1:                                                          # if nothing in line ... pass
-            pass
-        elif line[0] == "#":                                                        # if line starts with number sign (= comment) ... pass
-            pass
-        else:
-            trim_line = line[:-1]                                                   # trim line by ignoring "end of line" character
-            split_line = trim_line.split(",")                                       # split line with comma delimiter (default)
-            device_id_list.append( split_line[0] )
-            device_name_list.append( split_line[1] )
-            device_bt_address_list.append( split_line[2] )
-
-            line_num = line_num + 1
+    table = registry.table( id_file_path, DEVICE_COLUMNS )                          # id,name,bt address rows
+    if table.missing():
+        raise IOError( "No such file: " + id_file_path )
+    device_id_list          = [ fields[0] for fields in table.rows ]
+    device_name_list        = [ fields[1] for fields in table.rows ]
+    device_bt_address_list  = [ fields[2] for fields in table.rows ]
 
     return device_id_list, device_name_list, device_bt_address_list
-            
-
-
-
-
-
-
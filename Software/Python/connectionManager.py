@@ -0,0 +1,396 @@
+"""
+connectionManager.py
+
+The following module owns every stethoscope link of a panel.
+
+Each link (one per Bluetooth address, normally the device list read by
+configurationProtocol.panelDeviceID) has a CommandDispatcher and a maintenance
+thread. The maintenance thread connects the link and reconnects it in the
+background with jittered exponential backoff whenever a command reports a link
+failure. A linkHealth.HealthMonitor probes idle links, tracks their quality and
+reconnects unhealthy ones proactively.
+Commands submitted while a link is down simply wait in its (coalescing) queue,
+so neither the sampling loop nor the GUI ever blocks on a reconnect.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  random, threading
+from    timeStamp                   import  fullStamp, monotonic
+from    stethoscopeDispatcher       import  CommandDispatcher, enquiryCommand, ACK, NAK, ERROR, TIMEOUT
+from    latencyStats                import  stats as latencyStats
+from    rfFraming                   import  negotiate
+from    linkHealth                  import  LinkQuality, HealthMonitor
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+DOWN        = "DOWN"                                                        # Not connected, waiting for next attempt
+CONNECTING  = "CONNECTING"                                                  # Socket connect + ENQ handshake running
+UP          = "UP"                                                          # Handshake done, accepting commands
+
+def openRFCOMM( address, port, timeout ):
+    """
+    Open an RFCOMM socket with a bounded connect time.
+    """
+    import  bluetooth                                                       # python-bluez, see bluetoothProtocol_teensy32.py
+    sock = bluetooth.BluetoothSocket( bluetooth.RFCOMM )
+    sock.settimeout( timeout )
+    try:
+        sock.connect( (address, port) )
+    except Exception:
+        sock.close()
+        raise
+    return( sock )
+
+# ================================================================================= #
+# Link
+# ================================================================================= #
+
+class Link(object):
+
+    def __init__( self, manager, address ):
+        '''
+        One stethoscope link: socket, dispatcher and health figures.
+
+        INPUTS:
+            - manager   : Owning ConnectionManager
+            - address   : Bluetooth address of the stethoscope
+        '''
+
+        self.manager        = manager
+        self.address        = address
+        self.state          = DOWN
+        self.rfObject       = None
+        self.dispatcher     = CommandDispatcher( None, timeout=manager.commandTimeout )
+        self.dispatcher.onLinkError = self._linkError
+
+        self.failures       = 0                                             # Consecutive failed connects
+        self.reconnects     = 0                                             # Successful (re)connects
+        self.quality        = LinkQuality()                                 # RTT, loss, last ACK
+        self.startedAt      = None                                          # Manager start (monotonic)
+        self.readyAt        = None                                          # First time UP (monotonic)
+        self.wake           = threading.Event()
+        self.upEvent        = threading.Event()
+        self.stateLock      = threading.Lock()                              # _down() runs on several threads
+        self.thread         = None
+
+# ------------------------------------------------------------------------
+
+    def submit( self, command ):
+        '''
+        Queue a command on this link without blocking (see CommandDispatcher).
+        Outcomes feed the link's health figures. Only commands whose answer
+        matters (no coalescing group) take the link down when they time out;
+        a fire-and-forget state command (blend, mute) is resent next time.
+        '''
+
+        future = self.dispatcher.submit( command )
+        if( command.group is None ): future.addCallback( self._observe )
+        else: future.addCallback( self._observeOnly )
+        return( future )
+
+# ------------------------------------------------------------------------
+
+    def waitUp( self, timeout=None ):
+        '''
+        Block until the link is UP (or timeout). Returns True if it is.
+        '''
+        return( self.upEvent.wait(timeout) )
+
+# ------------------------------------------------------------------------
+
+    def health( self ):
+        '''
+        OUTPUT:
+            - dict with state, rtt (sec), loss rate, seconds since last ACK,
+              time to ready (sec), reconnects, failures
+        '''
+
+        return( { "state"       : self.state,
+                  "timeToReady" : self.timeToReady(),
+                  "rtt"         : self.quality.rtt,
+                  "loss"        : self.quality.loss(),
+                  "sinceAck"    : self.quality.sinceAck(),
+                  "reconnects"  : self.reconnects,
+                  "failures"    : self.failures } )
+
+# ------------------------------------------------------------------------
+
+    def timeToReady( self ):
+        '''
+        Seconds from manager start to the first ACKed handshake, None if not yet.
+        '''
+        if( self.startedAt is None or self.readyAt is None ):
+            return( None )
+        return( self.readyAt - self.startedAt )
+
+# ------------------------------------------------------------------------
+
+    def _observe( self, future ):
+        self.quality.observe( future )                                      # Real traffic doubles as probes
+        if( future.result == TIMEOUT and self.state == UP ):
+            self._down( "timeout" )
+
+    def _observeOnly( self, future ):
+        self.quality.observe( future )                                      # Loss still shows in the health figures
+
+# ------------------------------------------------------------------------
+
+    def _linkError( self, dispatcher, instance ):
+        self._down( str(instance) )
+
+# ------------------------------------------------------------------------
+
+    def _down( self, reason ):
+        '''
+        Mark the link down and let the maintenance thread reconnect it. Called by
+        the dispatcher, command callbacks and the health monitor: only the first
+        caller tears the link down.
+        '''
+
+        with self.stateLock:
+            if( self.state != UP ):
+                return
+            print( fullStamp() + " Link " + self.address + " down (" + reason + ")" )
+            latencyStats.count( "link " + self.address, "DOWN" )
+            self.state = DOWN
+            self.upEvent.clear()
+            self.dispatcher.setLink( None )                                 # Commands wait in the queue meanwhile
+            self._close()
+        self.wake.set()
+
+# ------------------------------------------------------------------------
+
+    def _close( self ):
+        if( self.manager.discovery is not None ):
+            self.manager.discovery.linkActive( self, False )
+        if( self.rfObject is not None ):
+            try:
+                self.rfObject.close()
+            except Exception:
+                pass
+            self.rfObject = None
+
+# ------------------------------------------------------------------------
+
+    def _connect( self ):
+        '''
+        Connect and handshake (ENQ -> ACK). Returns True once the link is UP.
+        '''
+
+        self.state = CONNECTING
+        try:
+            self.rfObject = self.manager.connect( self.address, self.manager.port,
+                                                  self.manager.connectTimeout )
+            if( self.manager.framing ):
+                self.rfObject = negotiate( self.rfObject )                  # Falls back to legacy byte mode
+        except Exception as instance:
+            print( fullStamp() + " Connect to " + self.address + " failed " + str(instance.args) )
+            latencyStats.count( "link " + self.address, "CONNECT_FAILED" )
+            self._close()
+            self.state = DOWN
+            return( False )
+
+        self.dispatcher.setLink( self.rfObject, gated=True )                # Queued commands wait for the ACK
+        handshake = self._handshake()
+        if( handshake.result != ACK ):
+            print( fullStamp() + " Handshake with " + self.address + " failed (" + str(handshake.result) + ")" )
+            self.dispatcher.setLink( None )
+            self._close()
+            self.state = DOWN
+            return( False )
+
+        self.dispatcher.ungate()
+        if( self.manager.discovery is not None ):
+            self.manager.discovery.linkActive( self, True )
+        self.quality.reset()
+        self._observe( handshake )
+        with self.stateLock:
+            self.state  = UP
+        self.failures   = 0
+        self.reconnects = self.reconnects + 1
+        if( self.readyAt is None ):
+            self.readyAt = monotonic()
+        else:
+            latencyStats.count( "link " + self.address, "RECONNECT" )
+        self.upEvent.set()
+        print( fullStamp() + " Link " + self.address + " UP" )
+        return( True )
+
+# ------------------------------------------------------------------------
+
+    def _handshake( self ):
+        '''
+        Poll ENQ until the device ACKs. A NAK means the device is still booting,
+        so it is asked again every readyPoll sec until readyTimeout runs out.
+
+        OUTPUT:
+            - CommandFuture of the last ENQ
+        '''
+
+        deadline = monotonic() + self.manager.readyTimeout
+        while( True ):
+            handshake = self.dispatcher.submit( enquiryCommand(priority=-1) )   # Ahead of anything queued
+            handshake.wait( self.manager.commandTimeout + 1 )
+            if( handshake.result != NAK or monotonic() >= deadline or not self.manager.running ):
+                return( handshake )
+            self.wake.wait( self.manager.readyPoll )
+
+# ------------------------------------------------------------------------
+
+    def _backoff( self ):
+        '''
+        Jittered exponential backoff: half fixed, half random.
+        '''
+        delay = min( self.manager.backoffMax, self.manager.backoffBase * (2 ** self.failures) )
+        return( delay/2.0 + random.uniform(0, delay/2.0) )
+
+# ------------------------------------------------------------------------
+
+    def _run( self ):
+        '''
+        Maintenance loop: connect / reconnect.
+        '''
+
+        while( self.manager.running ):
+            if( self.state != UP ):
+                if( self._connect() ):
+                    continue
+                self.failures = self.failures + 1
+                self.wake.wait( self._backoff() )
+                self.wake.clear()
+                continue
+
+            self.wake.wait()                                                # Until _down() or stop()
+            self.wake.clear()
+
+        self.dispatcher.stop()
+        self._close()
+
+# ================================================================================= #
+# Connection Manager
+# ================================================================================= #
+
+class ConnectionManager(object):
+
+    def __init__( self, addresses, port=1, keepalive=5.0, backoffBase=0.5, backoffMax=30.0,
+                  connectTimeout=10.0, commandTimeout=2.0, readyTimeout=5.0, readyPoll=0.1,
+                  framing=False, onWarning=None, connect=openRFCOMM, discovery=None ):
+        '''
+        Owner of all stethoscope links of a panel.
+
+        INPUTS:
+            - addresses     : Bluetooth addresses of the stethoscopes
+            - port          : RFCOMM channel
+            - keepalive     : Idle time (sec) after which an ENQ probe is sent
+            - backoffBase   : First reconnect delay (sec)
+            - backoffMax    : Largest reconnect delay (sec)
+            - connectTimeout: Socket connect timeout (sec)
+            - commandTimeout: Response timeout for commands (sec)
+            - readyTimeout  : How long a NAKing (booting) device is polled (sec)
+            - readyPoll     : ENQ interval while the device NAKs (sec)
+            - framing       : Negotiate framed mode (rfFraming.py) on connect
+            - onWarning     : fn(address, kind, value) for link quality warnings
+                              (see linkHealth.py)
+            - connect       : fn(address, port, timeout) -> connected socket
+            - discovery     : DiscoveryService told about live links, so it does
+                              not inquire while they stream
+        '''
+
+        self.port           = port
+        self.keepalive      = keepalive
+        self.backoffBase    = backoffBase
+        self.backoffMax     = backoffMax
+        self.connectTimeout = connectTimeout
+        self.commandTimeout = commandTimeout
+        self.readyTimeout   = readyTimeout
+        self.readyPoll      = readyPoll
+        self.framing        = framing
+        self.monitor        = HealthMonitor( self, probeInterval=keepalive, onWarning=onWarning )
+        self.connect        = connect
+        self.discovery      = discovery
+        self.running        = False
+
+        self.links          = {}
+        for address in addresses:
+            self.links[ address ] = Link( self, address )
+
+# ------------------------------------------------------------------------
+
+    @classmethod
+    def fromPanel( cls, deviceFile, panelID, **kwargs ):
+        '''
+        Build a manager for the devices listed in panel<N>devices.txt.
+        '''
+        from configurationProtocol import panelDeviceID
+        _, _, bt_address_list = panelDeviceID( deviceFile, panelID )
+        return( cls(bt_address_list, **kwargs) )
+
+# ------------------------------------------------------------------------
+
+    def start( self ):
+        '''
+        Start every link's dispatcher and maintenance thread (returns at once).
+        '''
+
+        self.running = True
+        for link in self.links.values():
+            link.startedAt = monotonic()
+            link.dispatcher.start()
+            link.thread = threading.Thread( target=link._run, name="link " + link.address )
+            link.thread.daemon = True
+            link.thread.start()
+        self.monitor.start()
+        return( self )
+
+# ------------------------------------------------------------------------
+
+    def stop( self ):
+        self.running = False
+        self.monitor.stop()
+        for link in self.links.values():
+            link.wake.set()
+        for link in self.links.values():
+            if( link.thread is not None ):
+                link.thread.join()
+                link.thread = None
+
+# ------------------------------------------------------------------------
+
+    def link( self, address ):
+        return( self.links[address] )
+
+# ------------------------------------------------------------------------
+
+    def waitReady( self, timeout=None ):
+        '''
+        Block until every link is UP (or timeout); links come up concurrently.
+
+        OUTPUT:
+            - True if all links are UP
+        '''
+
+        deadline = None if timeout is None else monotonic() + timeout
+        for link in self.links.values():
+            remaining = None if deadline is None else max( 0, deadline - monotonic() )
+            if( not link.waitUp(remaining) ):
+                return( False )
+        return( True )
+
+# ------------------------------------------------------------------------
+
+    def submit( self, address, command ):
+        return( self.links[address].submit(command) )
+
+# ------------------------------------------------------------------------
+
+    def health( self ):
+        '''
+        OUTPUT:
+            - dict address -> Link.health()
+        '''
+        return( dict((address, link.health()) for address, link in self.links.items()) )
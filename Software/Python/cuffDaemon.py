@@ -0,0 +1,210 @@
+"""
+cuffDaemon.py
+
+The following module keeps the blood pressure cuff warm between sessions.
+
+Every session used to spawn a fresh `python pressureDialGauge_GUI.py`: PyQt4,
+Qwt5 and numpy were imported again, the ADC was set up again and the stethoscope
+reconnected, so a live dial came up seconds after Start/Stop was pressed. Now
+launchOnBoot.sh starts the dial once as a daemon (pressureDialGauge_GUI.py
+--daemon): the window is built but hidden and the ADC is sampled all along. With
+--links the panel's stethoscope links are kept up by a ConnectionManager too; that
+is only for launchers that use the daemon's links, as every launcher that opens
+its own RFCOMM link would compete with the daemon for the single channel.
+
+A CuffDaemon is the control side of it. It listens on a local Unix socket
+(dialIPC.DAEMON_SOCKET) and runs one session at a time:
+
+    launcher                        daemon
+                            <-      detach "busy" if a session is live (the
+                                    launcher retries, then reports it)
+    attach {dial options}   ->      host.attach(options, publisher) opens the log,
+                                    picks the warm link, shows the dial
+                            <-      ready {startup timings}, then hello/sample/
+                                    state/event exactly as a spawned dial sends
+    detach / close          ->      host.detach()     (or the dial's Quit button,
+                            <-      connection closed  which ends it from the daemon)
+
+dialIPC.runDial() tries the daemon first, so the launchers need no change and
+still spawn a dial when no daemon runs. The startup time of every session, and
+of each of its steps, is printed, sent to the launcher, kept in self.sessions and
+recorded in latencyStats ("sessionStartup").
+
+A host implements attach(options, publisher) -> dict of step durations (sec) and
+detach(reason); see pressureDialGauge_GUI.MyWindow.
+
+The socket drives the cuff, so it lives in a directory only root can write to
+(/run/abpcCuff) and only its owner and group may connect: the group of the user
+that started the daemon with sudo (SUDO_GID), e.g. the desktop user running the
+launchers.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  json, os, select, socket, threading
+from    dialIPC                     import  MessageReader, DialPublisher, encode, DETACH, DAEMON_SOCKET
+from    latencyStats                import  stats
+from    timeStamp                   import  fullStamp, monotonic
+
+# ================================================================================= #
+# Cuff Daemon
+# ================================================================================= #
+
+class CuffDaemon(object):
+
+    def __init__( self, host, path=DAEMON_SOCKET, history=50, group=None ):
+        '''
+        INPUTS:
+            - host      : Warm dial, with attach(options, publisher) and detach(reason)
+            - path      : Control socket
+            - history   : Startup timings kept in self.sessions
+            - group     : Group id allowed to connect (default: the sudo user's, else ours)
+        '''
+
+        self.host       = host
+        self.path       = path
+        self.history    = history
+        self.group      = group if group is not None else int( os.environ.get("SUDO_GID", os.getgid()) )
+
+        self.lock       = threading.Lock()
+        self.server     = None
+        self.session    = None                                              # Connection of the live session
+        self.sessions   = []                                                # Startup timings, newest last
+        self.running    = False
+
+# ------------------------------------------------------------------------
+
+    def start( self ):
+        '''
+        Listen on the control socket (returns at once).
+        '''
+        directory = os.path.dirname( self.path )
+        if( directory and not os.path.isdir(directory) ):
+            os.makedirs( directory, 0o755 )                                 # Nobody else can replace the socket
+        if( os.path.exists(self.path) ):
+            os.unlink( self.path )                                          # Left over by a previous boot
+        self.server = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        self.server.bind( self.path )
+        os.chown( self.path, -1, self.group )                               # Launchers need not run as root ...
+        os.chmod( self.path, 0o660 )                                        # ... but must be in the group
+        self.server.listen( 2 )
+        self.running = True
+
+        thread = threading.Thread( target=self._accept, name="cuffDaemon" )
+        thread.daemon = True
+        thread.start()
+        print( fullStamp() + " Cuff daemon listening on " + self.path )
+        return( self )
+
+    def stop( self ):
+        self.running = False
+        self.end( "daemon stopped" )
+        if( self.server is not None ):
+            self.server.close()
+        if( os.path.exists(self.path) ):
+            os.unlink( self.path )
+
+# ------------------------------------------------------------------------
+
+    def end( self, reason ):
+        '''
+        End the live session, if any (e.g. the dial's Quit button); the
+        launcher's runDial() returns.
+        '''
+        with self.lock:
+            conn, self.session = self.session, None
+        if( conn is None ):
+            return
+        self.host.detach( reason )
+        try:
+            conn.shutdown( socket.SHUT_RDWR )
+        except (socket.error, OSError):
+            pass
+        conn.close()
+
+# ------------------------------------------------------------------------
+
+    def _accept( self ):
+        while( self.running ):
+            try:
+                conn, _ = self.server.accept()
+            except (socket.error, OSError):
+                return
+            thread = threading.Thread( target=self._serve, args=(conn,), name="cuffSession" )
+            thread.daemon = True
+            thread.start()
+
+    def _serve( self, conn ):
+        '''
+        One launcher connection: attach, then wait for detach or EOF.
+        '''
+        reader = MessageReader()
+        try:
+            message = self._receive( conn, reader )
+            if( message is None or message[0] != "attach" ):
+                return
+            t0 = monotonic()
+
+            with self.lock:
+                busy = self.session is not None
+                if( not busy ):
+                    self.session = conn
+            if( busy ):
+                conn.sendall( encode(DETACH, "busy") )                      # Launcher retries, then gives up
+                return
+            publisher = DialPublisher( sock=conn )
+
+            try:
+                timings = dict( self.host.attach(json.loads(message[1][0]), publisher) or {} )
+            except Exception as instance:
+                print( fullStamp() + " Session failed to start " + str(instance.args) )
+                publisher.event( "Session failed to start: " + str(instance.args) )
+                publisher.detach( "failed" )
+                self.end( "failed" )
+                return
+            timings["total"] = monotonic() - t0
+            self._report( timings )
+            publisher.ready( timings )
+
+            while( self.session is conn ):                                  # Until detach, EOF or end()
+                message = self._receive( conn, reader, 0.5 )
+                if( message is None or message[0] == "detach" ):
+                    break
+            if( self.session is conn ):
+                self.end( "launcher detached" )
+
+        except (socket.error, OSError, ValueError) as instance:
+            if( self.session is conn ):                                     # Not closed by end()
+                print( fullStamp() + " Session connection failed " + str(instance.args) )
+                self.end( "connection failed" )
+        finally:
+            if( self.session is not conn ):
+                conn.close()
+
+    def _receive( self, conn, reader, timeout=None ):
+        '''
+        OUTPUT:
+            - Next (name, values) ; None at EOF ; ("", ()) if timeout (sec) passed
+        '''
+        while( True ):
+            message = reader.next()
+            if( message is not None ):
+                return( message )
+            if( not select.select([conn], [], [], timeout)[0] ):              # The publisher made it non-blocking
+                return( ("", ()) )
+            data = conn.recv( 4096 )
+            if( not data ):
+                return( None )
+            reader.feed( data )
+
+# ------------------------------------------------------------------------
+
+    def _report( self, timings ):
+        steps = ", ".join( "%s %.3f" %(name, timings[name]) for name in sorted(timings) if name != "total" )
+        print( fullStamp() + " Session live after %.3f sec (%s)" %(timings["total"], steps) )
+        stats.record( "sessionStartup", timings["total"] )
+        with self.lock:
+            self.sessions.append( timings )
+            del self.sessions[:-self.history]
@@ -0,0 +1,387 @@
+"""
+dataRetention.py
+
+The following module manages the retention of the session output tree (dataOutput/)
+for panels that run unattended all day.
+
+    - Active logs are rotated when they grow past a size limit or stay open past an
+      age limit. Rotating is a single rename and is the only work ever done on the
+      caller's (acquisition) thread.
+    - Closed sessions (rotated logs, and files nobody has written to for a while)
+      are compressed with gzip on a background housekeeping thread.
+    - The same thread deletes the oldest closed sessions whenever the tree exceeds
+      its disk-usage budget, and expires them past a maximum age if one is set.
+
+Only rotated session logs (<name>_<fullStamp>[-n]<ext>[.gz], as rotate() names
+them) are ever compressed or deleted. Everything else under dataOutput/, e.g.
+latency.json snapshots or wavTransfer's .part/.part.json checkpoints, is left
+alone but still counts against the budget.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  os, re, gzip, shutil, threading, time
+from    timeStamp   import fullStamp
+
+try:
+    import  Queue   as queue                                                # Python 2
+except ImportError:
+    import  queue                                                           # Python 3
+
+# ================================================================================= #
+# Defaults
+# ================================================================================= #
+
+MAX_FILE_BYTES  = 5*1024*1024                                               # Rotate active logs past 5 MB ...
+MAX_FILE_AGE    = 24*60*60                                                  # ... or after 24 h of being open
+MAX_KEEP_AGE    = None                                                      # Keep closed sessions (opt in, e.g. 30*24*60*60)
+BUDGET_BYTES    = 512*1024*1024                                             # Keep the whole tree under 512 MB
+CLOSED_AFTER    = 60*60                                                     # Untouched for 1 h == closed session
+SWEEP_INTERVAL  = 5*60                                                      # Housekeeping period (sec)
+
+ROTATED         = re.compile( r"_\d{4}(-\d{2}){5}(-\d+)?(\.[^.]+)?(\.gz)?$" )  # Names given by rotate()
+
+# ================================================================================= #
+# Retention Manager
+# ================================================================================= #
+
+class RetentionManager(object):
+
+    def __init__( self, rootDir, maxFileBytes=MAX_FILE_BYTES, maxFileAge=MAX_FILE_AGE,
+                  maxKeepAge=MAX_KEEP_AGE, budgetBytes=BUDGET_BYTES, compress=True,
+                  closedAfter=CLOSED_AFTER, sweepInterval=SWEEP_INTERVAL ):
+        '''
+        Retention policy for a session output tree.
+
+        INPUTS:
+            - rootDir       : Root of the output tree (e.g. <cwd>/dataOutput)
+            - maxFileBytes  : Size at which an active log is rotated
+            - maxFileAge    : Age (sec) at which an active log is rotated
+            - maxKeepAge    : Age (sec) after which closed sessions are deleted (None to keep them)
+            - budgetBytes   : Disk-usage budget for the whole tree (None for no budget)
+            - compress      : Gzip closed sessions in the background
+            - closedAfter   : Idle time (sec) after which an untracked file counts as closed
+            - sweepInterval : Period (sec) of the background housekeeping sweep
+        '''
+
+        self.rootDir        = rootDir
+        self.maxFileBytes   = maxFileBytes
+        self.maxFileAge     = maxFileAge
+        self.maxKeepAge     = maxKeepAge
+        self.budgetBytes    = budgetBytes
+        self.compress       = compress
+        self.closedAfter    = closedAfter
+        self.sweepInterval  = sweepInterval
+
+        self.active         = set()                                         # Logs currently open for writing
+        self.lock           = threading.Lock()                              # Guards self.active
+        self.closed         = queue.Queue()                                 # Rotated logs awaiting housekeeping
+        self.thread         = None
+        self.running        = False
+
+        self.stats          = { "rotated"   : 0,                            # Housekeeping counters
+                                "compressed": 0,
+                                "expired"   : 0,
+                                "evicted"   : 0,
+                                "usedBytes" : 0 }
+
+# ------------------------------------------------------------------------
+
+    def start( self ):
+        '''
+        Start the background housekeeping thread.
+        '''
+
+        if( self.thread is None ):
+            self.running = True
+            self.thread  = threading.Thread( target=self._run, name="retention" )
+            self.thread.daemon = True                                       # Never hold the program open
+            self.thread.start()
+
+        return( self )
+
+# ------------------------------------------------------------------------
+
+    def stop( self ):
+        '''
+        Stop the housekeeping thread after its current task.
+        '''
+
+        self.running = False
+        self.closed.put( None )                                             # Wake the thread up
+        if( self.thread is not None ):
+            self.thread.join()
+            self.thread = None
+
+# ------------------------------------------------------------------------
+
+    def openLog( self, fileName, header="" ):
+        '''
+        Open a session log for appending.
+        A previous run stored under the same name is rotated, never truncated.
+
+        INPUTS:
+            - fileName  : Path to the log file
+            - header    : Text written at the top of every (re)opened file
+
+        OUTPUT:
+            - RotatingLog instance
+        '''
+
+        return( RotatingLog(self, fileName, header) )
+
+# ------------------------------------------------------------------------
+
+    def rotate( self, fileName ):
+        '''
+        Move a log out of the way and queue it for housekeeping.
+        Only a rename is done here; everything else happens in the background.
+
+        INPUTS:
+            - fileName  : Path to the log file
+
+        OUTPUT:
+            - Path of the rotated file (None if there was nothing to rotate)
+        '''
+
+        if( not os.path.isfile(fileName) or os.path.getsize(fileName) == 0 ):
+            return( None )
+
+        base, ext   = os.path.splitext( fileName )
+        rotated     = "%s_%s%s" %( base, fullStamp(), ext )
+        n = 1
+        while( os.path.exists(rotated) or os.path.exists(rotated + ".gz") ):
+            rotated = "%s_%s-%d%s" %( base, fullStamp(), n, ext )           # Several rotations in one second
+            n = n + 1
+
+        os.rename( fileName, rotated )
+        self.stats["rotated"] += 1
+        self.closed.put( rotated )
+        return( rotated )
+
+# ------------------------------------------------------------------------
+
+    def _track( self, fileName, isActive ):
+        with self.lock:
+            if( isActive ): self.active.add( os.path.abspath(fileName) )
+            else: self.active.discard( os.path.abspath(fileName) )
+
+# ------------------------------------------------------------------------
+
+    def _run( self ):
+        '''
+        Housekeeping loop: compress rotated logs as they arrive and
+        sweep the whole tree every sweepInterval seconds.
+        '''
+
+        lastSweep = 0
+        while( self.running ):
+            try:
+                timeout = max( 0.1, self.sweepInterval - (time.time() - lastSweep) )
+                rotated = self.closed.get( timeout=timeout )
+                if( rotated is not None and self.compress ):
+                    self._compress( rotated )
+            except queue.Empty:
+                pass
+
+            if( time.time() - lastSweep >= self.sweepInterval ):
+                lastSweep = time.time()
+                self.sweep()
+
+# ------------------------------------------------------------------------
+
+    def _compress( self, fileName ):
+        '''
+        Gzip a closed file in a streaming fashion and remove the original.
+        '''
+
+        if( fileName.endswith(".gz") or not os.path.isfile(fileName) ):
+            return
+
+        try:
+            with open( fileName, "rb" ) as src:
+                dst = gzip.open( fileName + ".gz.tmp", "wb" )
+                try:
+                    shutil.copyfileobj( src, dst, 64*1024 )
+                finally:
+                    dst.close()
+            st = os.stat( fileName )
+            os.utime( fileName + ".gz.tmp", (st.st_atime, st.st_mtime) )    # Age counts from the session, not the gzip
+            os.rename( fileName + ".gz.tmp", fileName + ".gz" )
+            os.remove( fileName )
+            self.stats["compressed"] += 1
+
+        except (IOError, OSError) as instance:
+            print( fullStamp() + " Failed to compress " + fileName + " " + str(instance.args) )
+
+# ------------------------------------------------------------------------
+
+    def sweep( self ):
+        '''
+        Compress idle sessions, expire old ones, and enforce the disk budget.
+        Only rotated session logs are touched (see ROTATED).
+        Runs on the housekeeping thread; safe to call directly from tools.
+
+        OUTPUT:
+            - Bytes used by the tree after the sweep
+        '''
+
+        if( not os.path.isdir(self.rootDir) ):
+            return( 0 )
+
+        with self.lock:
+            active = set( self.active )
+
+        now     = time.time()
+        closed  = []                                                        # (mtime, size, path) of closed sessions
+        used    = 0
+
+        for dirPath, dirNames, fileNames in os.walk( self.rootDir ):
+            for name in fileNames:
+                path = os.path.join( dirPath, name )
+                if( name.endswith(".tmp") ):
+                    continue
+                try:
+                    st = os.stat( path )
+                except OSError:
+                    continue                                                # Vanished under us
+
+                if( os.path.abspath(path) in active or not self.isSession(name) ):
+                    used = used + st.st_size
+                    continue
+
+                if( self.compress and not name.endswith(".gz")
+                    and now - st.st_mtime >= self.closedAfter ):
+                    self._compress( path )
+                    path = path + ".gz"
+                    try:
+                        st = os.stat( path )
+                    except OSError:
+                        continue
+
+                if( self.maxKeepAge is not None and now - st.st_mtime >= self.maxKeepAge ):
+                    self._remove( path, "expired" )
+                    continue
+
+                used = used + st.st_size
+                closed.append( (st.st_mtime, st.st_size, path) )
+
+        if( self.budgetBytes is not None and used > self.budgetBytes ):
+            closed.sort()                                                   # Oldest first
+            for mtime, size, path in closed:
+                if( used <= self.budgetBytes ):
+                    break
+                if( self._remove(path, "evicted") ):
+                    used = used - size
+
+        self.stats["usedBytes"] = used
+        return( used )
+
+# ------------------------------------------------------------------------
+
+    @staticmethod
+    def isSession( name ):
+        '''
+        OUTPUT:
+            - True if name is a rotated session log (not a .part/.json file of another tool)
+        '''
+        if( name.endswith((".part", ".json", ".part.gz", ".json.gz")) ):
+            return( False )
+        return( ROTATED.search(name) is not None )
+
+# ------------------------------------------------------------------------
+
+    def _remove( self, path, reason ):
+        try:
+            os.remove( path )
+            self.stats[reason] += 1
+            return( True )
+        except OSError:
+            return( False )
+
+
+# ================================================================================= #
+# Rotating Log
+# ================================================================================= #
+
+class RotatingLog(object):
+
+    def __init__( self, manager, fileName, header="" ):
+        '''
+        Append-only session log that rotates itself by size and age.
+
+        INPUTS:
+            - manager   : RetentionManager owning the output tree
+            - fileName  : Path to the log file
+            - header    : Text written at the top of every (re)opened file
+        '''
+
+        self.manager    = manager
+        self.fileName   = fileName
+        self.header     = header
+        self.f          = None
+
+        dirName = os.path.dirname( fileName )
+        if( dirName and not os.path.exists(dirName) ):
+            os.makedirs( dirName )
+
+        manager.rotate( fileName )                                          # Keep the previous run
+        manager._track( fileName, True )
+        self._open()
+
+# ------------------------------------------------------------------------
+
+    def _open( self ):
+        self.f          = open( self.fileName, "a" )
+        self.size       = self.f.tell()
+        self.openedAt   = time.time()
+        if( self.header ):
+            self.f.write( self.header )
+            self.f.flush()
+            self.size   = self.size + len( self.header )
+
+# ------------------------------------------------------------------------
+
+    def write( self, data ):
+        '''
+        Append data to the log, rotating it first if it is due.
+
+        INPUTS:
+            - data  : String to be written
+        '''
+
+        if( self.f is None ):
+            return
+
+        if( self.size >= self.manager.maxFileBytes or
+            time.time() - self.openedAt >= self.manager.maxFileAge ):
+            self.rotate()
+
+        self.f.write( data )
+        self.f.flush()
+        self.size = self.size + len( data )
+
+# ------------------------------------------------------------------------
+
+    def rotate( self ):
+        '''
+        Close the current file, hand it to the manager and start a new one.
+        '''
+
+        self.f.close()
+        self.manager.rotate( self.fileName )
+        self._open()
+
+# ------------------------------------------------------------------------
+
+    def close( self ):
+        '''
+        Close the log. The file becomes a closed session for housekeeping.
+        '''
+
+        if( self.f is not None ):
+            self.f.close()
+            self.f = None
+            self.manager._track( self.fileName, False )
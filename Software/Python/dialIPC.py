@@ -0,0 +1,383 @@
+"""
+dialIPC.py
+
+The following module carries pressure samples, playback state and events from
+the dial process (pressureDialGauge_GUI.py) to the appJar launcher that spawned it.
+
+The launchers used to run the dial under pexpect and scrape "SIM True" lines off
+its STDOUT: a pty, a line parse per message and an update rate tied to the dial's
+print cadence (--frequency). Instead the launcher now listens on a Unix domain
+socket and passes its path to the dial (--ipc); the dial pushes binary messages
+at full sampling rate and the launcher decodes them as they arrive.
+
+Schema (version 1), big-endian:
+
+    Every message : LEN (u16) | TYPE (u8) | PAYLOAD            LEN = 1 + len(PAYLOAD)
+
+    TYPE  NAME    PAYLOAD
+    0x00  hello   version (u8), pid (u32)                      first message of the dial
+    0x01  sample  t (f64, sec since dial start), mmHg (f32)   every pressure reading
+    0x02  state   playback (u8 0/1), normal (u8 0/1)           on every simulation transition
+    0x03  event   UTF-8 text                                   recording started, errors, ...
+    0x04  attach  UTF-8 JSON of the dial options               launcher -> cuffDaemon
+    0x05  detach  UTF-8 text (reason)                          launcher: ends its daemon session
+                                                               cuffDaemon: refuses one (busy, failed)
+    0x06  ready   UTF-8 JSON of the startup timings (sec)      cuffDaemon, session is live
+
+Unknown types are skipped by LEN, so newer dials can add messages. The dial never
+blocks on the launcher: if the socket buffer is full, samples are dropped (and
+counted) while state and event messages are queued and flushed first.
+
+When cuffDaemon.py is running (launchOnBoot.sh), runDial() attaches to it instead
+of spawning a dial: the daemon's dial is already booted and its links are up, and
+it streams the same messages over the connection. If the daemon refuses the
+session (busy with another launcher, failed to start) runDial() raises DialRefused
+rather than spawning a dial: the daemon holds the ADC, a second reader would fight it.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  errno, json, os, select, shutil, socket, struct, subprocess, tempfile, threading
+from    time                        import  sleep
+from    timeStamp                   import  fullStamp, monotonic
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+VERSION = 1
+HEADER  = struct.Struct( ">HB" )
+
+HELLO   = 0x00
+SAMPLE  = 0x01
+STATE   = 0x02
+EVENT   = 0x03
+ATTACH  = 0x04
+DETACH  = 0x05
+READY   = 0x06
+
+DAEMON_SOCKET = "/run/abpcCuff/cuff.sock"                                   # Control socket of cuffDaemon (root-owned dir)
+
+SCHEMA  = { HELLO   : ( "hello",  struct.Struct(">BI")  ),                      # type -> (name, payload layout)
+            SAMPLE  : ( "sample", struct.Struct(">df")  ),                      # None: UTF-8 text
+            STATE   : ( "state",  struct.Struct(">BB")  ),
+            EVENT   : ( "event",  None                  ),
+            ATTACH  : ( "attach", None                  ),
+            DETACH  : ( "detach", None                  ),
+            READY   : ( "ready",  None                  ) }
+
+def encode( kind, *values ):
+    """
+    Build one message of the schema above.
+    """
+    layout = SCHEMA[kind][1]
+    if( layout is None ):
+        payload = values[0].encode( "utf-8" )
+    else:
+        payload = layout.pack( *values )
+    return( HEADER.pack(len(payload) + 1, kind) + payload )
+
+def decode( kind, payload ):
+    """
+    OUTPUT:
+        - (name, values) ; None for a type this version does not know
+    """
+    if( kind not in SCHEMA ):
+        return( None )
+    name, layout = SCHEMA[kind]
+    if( layout is None ):
+        return( name, (payload.decode("utf-8", "replace"),) )
+    return( name, layout.unpack(payload) )
+
+# ================================================================================= #
+# Message Reader
+# ================================================================================= #
+
+class MessageReader(object):
+
+    def __init__( self ):
+        '''
+        Incremental parser: feed() it recv() chunks, take messages with next().
+        '''
+        self.buffer     = bytearray()
+        self.stats      = { "messages": 0, "unknown": 0 }
+
+    def feed( self, data ):
+        self.buffer.extend( bytearray(data) )
+
+    def next( self ):
+        '''
+        OUTPUT:
+            - (name, values) of the next complete message ; None if there is none yet
+        '''
+        buffer = self.buffer
+        while( len(buffer) >= HEADER.size ):
+            length, kind = HEADER.unpack( bytes(buffer[:HEADER.size]) )
+            total = 2 + length
+            if( len(buffer) < total ):
+                return( None )
+            payload = bytes( buffer[HEADER.size:total] )
+            del buffer[:total]
+
+            message = decode( kind, payload )
+            if( message is None ):
+                self.stats["unknown"] += 1
+                continue
+            self.stats["messages"] += 1
+            return( message )
+        return( None )
+
+# ================================================================================= #
+# Dial Side
+# ================================================================================= #
+
+class DialPublisher(object):
+
+    def __init__( self, path=None, sock=None ):
+        '''
+        Push messages to the launcher listening on path, or over a connected sock
+        (cuffDaemon sessions); never blocks the sampling loop. Safe to call from
+        several threads (the daemon's sampler and its session thread).
+        '''
+        if( sock is None ):
+            sock        = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+            sock.connect( path )
+        self.sock       = sock
+        self.sock.setblocking( False )
+        self.pending    = b""                                               # Bytes the socket did not take yet
+        self.closed     = False
+        self.stats      = { "sent": 0, "dropped": 0 }
+        self.lock       = threading.RLock()                                 # One writer at a time on sock/pending
+        self._send( encode(HELLO, VERSION, os.getpid()), True )
+
+    def close( self ):
+        with self.lock:
+            self.closed = True
+            self.sock.close()
+
+# ------------------------------------------------------------------------
+
+    def sample( self, t, mmHg ):
+        self._send( encode(SAMPLE, t, mmHg), False )
+
+    def state( self, playback, normal ):
+        self._send( encode(STATE, int(bool(playback)), int(bool(normal))), True )
+
+    def event( self, text ):
+        self._send( encode(EVENT, text), True )
+
+    def ready( self, timings ):
+        self._send( encode(READY, json.dumps(timings)), True )
+
+    def detach( self, reason ):
+        self._send( encode(DETACH, reason), True )
+
+# ------------------------------------------------------------------------
+
+    def _send( self, message, keep ):
+        '''
+        Flush what is pending, then send message; when the socket is full a message
+        is queued if keep is set (state, events) and dropped otherwise (samples).
+        '''
+        with self.lock:
+            if( self.closed ):
+                return
+            try:
+                if( self.pending ):
+                    self.pending = self.pending[ self.sock.send(self.pending): ]
+                if( self.pending ):
+                    if( keep ):
+                        self.pending = self.pending + message
+                    else:
+                        self.stats["dropped"] += 1
+                    return
+                sent = self.sock.send( message )
+                self.pending = message[sent:]
+                self.stats["sent"] += 1
+            except socket.error as instance:
+                if( instance.errno in (errno.EAGAIN, errno.EWOULDBLOCK) ):
+                    if( keep ):
+                        self.pending = self.pending + message
+                    else:
+                        self.stats["dropped"] += 1
+                    return
+                print( fullStamp() + " Launcher went away " + str(instance.args) )
+                self.close()                                                # Keep sampling without it
+
+# ================================================================================= #
+# Launcher Side
+# ================================================================================= #
+
+class DialListener(object):
+
+    def __init__( self ):
+        '''
+        Unix socket the dial connects to (in a private temporary directory).
+        '''
+        self.directory  = tempfile.mkdtemp( prefix="abpcDial" )
+        self.path       = os.path.join( self.directory, "dial.sock" )
+        self.server     = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        self.server.bind( self.path )
+        self.server.listen( 1 )
+        self.conn       = None
+        self.reader     = MessageReader()
+
+    def close( self ):
+        for sock in ( self.conn, self.server ):
+            if( sock is not None ):
+                sock.close()
+        shutil.rmtree( self.directory, ignore_errors=True )
+
+# ------------------------------------------------------------------------
+
+    def accept( self, timeout ):
+        '''
+        OUTPUT:
+            - True once the dial connected ; False if it did not within timeout (sec)
+        '''
+        if( self.conn is None and select.select([self.server], [], [], timeout)[0] ):
+            self.conn, _ = self.server.accept()
+        return( self.conn is not None )
+
+# ------------------------------------------------------------------------
+
+    def poll( self, timeout ):
+        '''
+        Wait up to timeout (sec) for data.
+
+        OUTPUT:
+            - list of (name, values) received ; None once the dial closed the socket
+        '''
+        if( select.select([self.conn], [], [], timeout)[0] ):
+            data = self.conn.recv( 65536 )
+            if( not data ):
+                return( None )
+            self.reader.feed( data )
+
+        messages = []
+        message  = self.reader.next()
+        while( message is not None ):
+            messages.append( message )
+            message = self.reader.next()
+        return( messages )
+
+# ================================================================================= #
+# Launch
+# ================================================================================= #
+
+class DialRefused(Exception):
+    '''
+    cuffDaemon is running but refused the session (args[0]: its reason, "busy", "failed").
+    '''
+    pass
+
+# ------------------------------------------------------------------------
+
+def dialOptions( cmd ):
+    '''
+    OUTPUT:
+        - dict of the "--name value" options of a dial command line
+    '''
+    options = {}
+    for i, arg in enumerate( cmd ):
+        if( arg.startswith("--") and i + 1 < len(cmd) and not cmd[i+1].startswith("--") ):
+            options[ arg[2:] ] = cmd[i+1]
+    return( options )
+
+# ------------------------------------------------------------------------
+
+def attachDial( options, onMessage, path=DAEMON_SOCKET ):
+    '''
+    Run a session on the warm dial of cuffDaemon and deliver its messages until it ends.
+
+    OUTPUT:
+        - 0 once the session ended ; None if no daemon is listening on path
+        - Raises DialRefused if the daemon refused the session (detach)
+    '''
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+        sock.connect( path )
+    except socket.error:
+        sock.close()
+        return( None )
+
+    reader = MessageReader()
+    try:
+        sock.sendall( encode(ATTACH, json.dumps(options)) )
+        while( True ):
+            data = sock.recv( 65536 )
+            if( not data ):
+                return( 0 )                                                 # Session ended
+            reader.feed( data )
+            message = reader.next()
+            while( message is not None ):
+                name, values = message
+                if( name == "detach" ):
+                    raise DialRefused( values[0] )
+                if( name == "ready" ):
+                    values = ( json.loads(values[0]), )
+                onMessage( name, values )
+                message = reader.next()
+    finally:
+        sock.close()
+
+# ------------------------------------------------------------------------
+
+def runDial( cmd, onMessage, connectTimeout=30.0, daemon=DAEMON_SOCKET, busyWait=5.0 ):
+    '''
+    Run a dial session and deliver its messages until it ends: on cuffDaemon
+    if it is running, else in a dial process spawned for it. A dial is never
+    spawned next to a running daemon, it owns the ADC.
+
+    INPUTS:
+        - cmd           : Command line as a list, "--ipc <path>" is appended
+        - onMessage     : fn(name, values) called for every message
+        - connectTimeout: How long the dial may take to connect (sec)
+        - daemon        : Control socket of cuffDaemon (None: always spawn)
+        - busyWait      : How long to retry while the daemon is busy (sec)
+
+    OUTPUT:
+        - Exit code of the dial process (0 for a daemon session)
+        - Raises DialRefused if the daemon is still busy after busyWait, or failed
+    '''
+
+    if( daemon is not None ):
+        t0 = monotonic()
+        while( True ):
+            try:
+                code = attachDial( dialOptions(cmd), onMessage, daemon )
+                break
+            except DialRefused as instance:
+                if( instance.args[0] != "busy" or monotonic() - t0 > busyWait ):
+                    print( fullStamp() + " Cuff daemon refused the session (" + instance.args[0] + ")" )
+                    raise
+                sleep( 0.5 )                                                # Previous session may be ending
+        if( code is not None ):
+            return( code )                                                  # Else no daemon there: spawn
+
+    listener = DialListener()
+    child    = subprocess.Popen( list(cmd) + ["--ipc", listener.path] )
+    try:
+        t0 = monotonic()
+        while( not listener.accept(0.1) ):                                  # Dial boots (Qt, ADC, ...)
+            if( child.poll() is not None ):
+                return( child.returncode )
+            if( monotonic() - t0 > connectTimeout ):
+                print( fullStamp() + " Dial did not connect, running it without updates" )
+                return( child.wait() )
+
+        while( True ):
+            messages = listener.poll( 0.5 )
+            if( messages is None ):
+                break
+            for name, values in messages:
+                onMessage( name, values )
+        return( child.wait() )
+
+    finally:
+        if( child.poll() is None ):
+            child.terminate()
+            child.wait()
+        listener.close()
@@ -0,0 +1,281 @@
+"""
+discoveryService.py
+
+The following module keeps a cache of nearby Bluetooth devices so that nobody has
+to wait for a 5 second inquiry on a connect path.
+
+A DiscoveryService runs inquiries on a background thread, only when something it
+was asked about has gone stale, and with a random offset so that panels sharing a
+room do not all inquire at once. Results are kept in a TTL cache of
+address -> name / RSSI / last seen, persisted to disk so a restart starts warm.
+Lookups are answered from the cache immediately.
+
+An inquiry disturbs live RFCOMM links, so background inquiries are skipped while
+any link is registered with linkActive(), and a wanted device that was missed by
+maxMisses inquiries in a row (out of range, powered off) no longer makes one due;
+a lookup() that waits asks for it again. Only a lookup/devices() call that waits
+inquires while links are live.
+
+RSSI is whatever the discover function reports. python-bluez's
+discover_devices() has no RSSI, so with the default bluezDiscover it stays None.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  json, os, random, threading, time
+from    os.path                     import  expanduser
+from    timeStamp                   import  fullStamp
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+CACHE_FILE = os.path.join( expanduser("~"), ".abpcDiscovery.json" )         # Survives restarts
+
+def bluezDiscover( duration ):
+    """
+    Default inquiry using python-bluez.
+    discover_devices() does not report RSSI, so it is left as None.
+
+    OUTPUT:
+        - list of (address, name, rssi)
+    """
+    import  bluetooth
+    devices = bluetooth.discover_devices( duration=duration, lookup_names=True )
+    return( [(address, name, None) for address, name in devices] )
+
+# ================================================================================= #
+# Discovery Service
+# ================================================================================= #
+
+class DiscoveryService(object):
+
+    def __init__( self, cacheFile=CACHE_FILE, ttl=600.0, interval=60.0, duration=5,
+                  discover=bluezDiscover, maxMisses=3 ):
+        '''
+        Background Bluetooth discovery with a persistent TTL cache.
+
+        INPUTS:
+            - cacheFile : JSON file the cache is persisted to (None to disable)
+            - ttl       : Age (sec) after which an entry is stale
+            - interval  : Minimum time (sec) between background inquiries
+            - duration  : Inquiry duration (units of 1.28 sec, as in python-bluez)
+            - discover  : fn(duration) -> list of (address, name, rssi)
+            - maxMisses : Inquiries in a row a wanted device may be missing from
+                          before it stops triggering background inquiries
+        '''
+
+        self.cacheFile  = cacheFile
+        self.ttl        = ttl
+        self.interval   = interval
+        self.duration   = duration
+        self.discover   = discover
+        self.maxMisses  = maxMisses
+
+        self.cache      = {}                                                # address -> {"name", "rssi", "lastSeen"}
+        self.wanted     = set()                                             # Addresses callers care about
+        self.misses     = {}                                                # address -> inquiries in a row without it
+        self.links      = set()                                             # Live links; no background inquiry meanwhile
+        self.lock       = threading.Lock()
+        self.wake       = threading.Event()
+        self.scanned    = threading.Condition( self.lock )                  # Notified after every inquiry
+        self.scans      = 0                                                 # Number of completed inquiries
+        self.lastScan   = 0
+        self.running    = False
+        self.thread     = None
+
+        self._load()
+
+# ------------------------------------------------------------------------
+
+    def start( self ):
+        if( self.thread is None ):
+            self.running        = True
+            self.thread         = threading.Thread( target=self._run, name="discovery" )
+            self.thread.daemon  = True
+            self.thread.start()
+        return( self )
+
+# ------------------------------------------------------------------------
+
+    def stop( self ):
+        self.running = False
+        self.wake.set()
+        if( self.thread is not None ):
+            self.thread.join()
+            self.thread = None
+
+# ------------------------------------------------------------------------
+
+    def lookup( self, address, wait=None ):
+        '''
+        Look up a device in the cache.
+
+        INPUTS:
+            - address   : Bluetooth address
+            - wait      : On a miss, wait up to this long (sec) for the next inquiry
+
+        OUTPUT:
+            - dict with name, rssi, lastSeen ; None if unknown or stale
+        '''
+
+        with self.lock:
+            self.wanted.add( address )
+            entry = self._fresh( address )
+            if( entry is None and wait ):
+                self.misses.pop( address, None )                            # Asked for again: worth inquiring
+                self.wake.set()                                             # Inquire now rather than later
+                scans    = self.scans
+                deadline = time.time() + wait
+                while( self.scans == scans and time.time() < deadline ):
+                    self.scanned.wait( deadline - time.time() )
+                entry = self._fresh( address )
+
+        return( entry )
+
+# ------------------------------------------------------------------------
+
+    def devices( self, wait=None ):
+        '''
+        OUTPUT:
+            - list of (address, entry) for every fresh device in the cache
+              (waits up to `wait` sec for an inquiry if there are none)
+        '''
+
+        with self.lock:
+            found = self._allFresh()
+            if( not found and wait ):
+                self.wake.set()
+                scans    = self.scans
+                deadline = time.time() + wait
+                while( self.scans == scans and time.time() < deadline ):
+                    self.scanned.wait( deadline - time.time() )
+                found = self._allFresh()
+
+        return( found )
+
+# ------------------------------------------------------------------------
+
+    def refresh( self ):
+        '''
+        Request an inquiry as soon as possible (does not block).
+        '''
+        self.wake.set()
+
+    def unwant( self, address ):
+        '''
+        Stop keeping a device fresh (its entry stays in the cache).
+        '''
+        with self.lock:
+            self.wanted.discard( address )
+            self.misses.pop( address, None )
+
+    def linkActive( self, key, active ):
+        '''
+        Register (or drop) a live link, e.g. its socket; background inquiries
+        wait until none is left.
+        '''
+        with self.lock:
+            if( active ): self.links.add( key )
+            else: self.links.discard( key )
+
+# ------------------------------------------------------------------------
+
+    def _fresh( self, address ):
+        entry = self.cache.get( address )
+        if( entry is None or time.time() - entry["lastSeen"] > self.ttl ):
+            return( None )
+        return( dict(entry) )
+
+    def _allFresh( self ):
+        now = time.time()
+        return( [(address, dict(entry)) for address, entry in self.cache.items()
+                 if now - entry["lastSeen"] <= self.ttl] )
+
+# ------------------------------------------------------------------------
+
+    def _due( self ):
+        '''
+        An inquiry is due when a wanted device is stale (or nothing is known yet),
+        unless a link is live or the device keeps being missed.
+        '''
+        with self.lock:
+            if( self.links ):
+                return( False )
+            if( not self.cache ):
+                return( True )
+            limit = self.ttl / 2.0                                          # Refresh before entries expire
+            for address in self.wanted:
+                if( self.misses.get(address, 0) >= self.maxMisses ):
+                    continue                                                # Out of range or off; lookup(wait) retries
+                entry = self.cache.get( address )
+                if( entry is None or time.time() - entry["lastSeen"] > limit ):
+                    return( True )
+        return( False )
+
+# ------------------------------------------------------------------------
+
+    def _run( self ):
+        while( self.running ):
+            forced = self.wake.is_set()
+            self.wake.clear()
+
+            if( forced or (self._due() and time.time() - self.lastScan >= self.interval) ):
+                self._inquire()
+
+            jitter = random.uniform( 0, 0.25*self.interval )                # De-synchronize panels in one room
+            self.wake.wait( self.interval + jitter )
+
+# ------------------------------------------------------------------------
+
+    def _inquire( self ):
+        try:
+            found = self.discover( self.duration )
+        except Exception as instance:
+            print( fullStamp() + " Bluetooth inquiry failed " + str(instance.args) )
+            found = []
+
+        now = time.time()
+        with self.lock:
+            seen = set( address for address, name, rssi in found )
+            for address in self.wanted:
+                if( address in seen ): self.misses.pop( address, None )
+                else: self.misses[address] = self.misses.get( address, 0 ) + 1
+            for address, name, rssi in found:
+                entry = self.cache.get( address, {} )
+                self.cache[ address ] = { "name"     : name if name is not None else entry.get("name"),
+                                          "rssi"     : rssi,
+                                          "lastSeen" : now }
+            self.lastScan   = now
+            self.scans      = self.scans + 1
+            self.scanned.notify_all()
+
+        self._save()
+
+# ------------------------------------------------------------------------
+
+    def _load( self ):
+        if( self.cacheFile is None or not os.path.isfile(self.cacheFile) ):
+            return
+        try:
+            with open( self.cacheFile, "r" ) as f:
+                self.cache = json.load( f )
+        except (IOError, ValueError) as instance:
+            print( fullStamp() + " Ignoring unreadable discovery cache " + str(instance.args) )
+            self.cache = {}
+
+# ------------------------------------------------------------------------
+
+    def _save( self ):
+        if( self.cacheFile is None ):
+            return
+        with self.lock:
+            data = json.dumps( self.cache, indent=1, sort_keys=True )
+        try:
+            with open( self.cacheFile + ".tmp", "w" ) as f:
+                f.write( data )
+            os.rename( self.cacheFile + ".tmp", self.cacheFile )            # Atomic replace
+        except (IOError, OSError) as instance:
+            print( fullStamp() + " Failed to save discovery cache " + str(instance.args) )
@@ -0,0 +1,183 @@
+"""
+fakeBroker.py
+
+The following module is a stand-in for the Mosquitto broker the cuff sensors
+publish to, so mqttIngest can be exercised and benchmarked without the network.
+
+A FakeBroker listens on a local TCP port and speaks the subscriber half of MQTT
+3.1.1 (CONNECT, SUBSCRIBE, PINGREQ, DISCONNECT). publish() delivers a message to
+every client whose filters match its topic, simulateCuffs() runs publishers that
+send the cuff payload (text, or batched binary) at a given rate, and
+dropClients() cuts every connection to exercise reconnects. Like a real broker,
+it disconnects a client it has heard nothing from for 1.5 times the keepalive the
+client gave in CONNECT.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  math, random, socket, struct, threading
+from    mqttIngest                  import  PacketReader, packet, publishPacket, topicMatches, \
+                                            CONNECT, CONNACK, SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT
+from    mqttPayload                 import  encode
+from    timeStamp                   import  monotonic
+
+# ================================================================================= #
+# Fake Broker
+# ================================================================================= #
+
+class FakeBroker(object):
+
+    def __init__( self, port=0 ):
+        '''
+        Simulated MQTT broker on 127.0.0.1 (port 0: any free port, see self.port).
+        '''
+        self.server     = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        self.server.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        self.server.bind( ("127.0.0.1", port) )
+        self.server.listen( 8 )
+        self.port       = self.server.getsockname()[1]
+
+        self.lock       = threading.Lock()
+        self.clients    = {}                                                # socket -> list of topic filters
+        self.stats      = { "connects": 0, "published": 0, "delivered": 0, "expired": 0 }
+        self.running    = False
+
+# ------------------------------------------------------------------------
+
+    def start( self ):
+        self.running = True
+        thread = threading.Thread( target=self._accept, name="fakeBroker" )
+        thread.daemon = True
+        thread.start()
+        return( self )
+
+    def stop( self ):
+        self.running = False
+        self.server.close()
+        self.dropClients()
+
+    def dropClients( self ):
+        with self.lock:
+            clients, self.clients = list( self.clients ), {}
+        for sock in clients:
+            try:
+                sock.shutdown( socket.SHUT_RDWR )
+            except (socket.error, OSError):
+                pass
+            sock.close()
+
+# ------------------------------------------------------------------------
+
+    def publish( self, topic, payload ):
+        '''
+        Deliver one QoS 0 message to every matching subscriber.
+        '''
+        data = publishPacket( topic, payload )
+        with self.lock:
+            self.stats["published"] += 1
+            for sock, filters in list( self.clients.items() ):
+                if( any(topicMatches(f, topic) for f in filters) ):
+                    try:
+                        sock.sendall( data )
+                        self.stats["delivered"] += 1
+                    except (socket.error, OSError):
+                        del self.clients[sock]
+
+# ------------------------------------------------------------------------
+
+    def simulateCuffs( self, topics, rate, batch=0 ):
+        '''
+        Simulate cuff publishers, one per topic, taking rate readings per second each.
+
+        INPUTS:
+            - batch     : 0: one "BPCUFFSENS,Hmag,pitch,roll,PD3D" text message per reading,
+                          N: one binary message (mqttPayload.py) per N readings
+        '''
+        def run( sensor, topic, phase ):
+            t0, n, pending = monotonic(), 0, []
+            while( self.running ):
+                t = monotonic() - t0
+                Hmag, pitch, roll = 3 + 2*math.sin(t + phase), 55 + 30*math.sin(0.5*t + phase), 20*math.cos(t)
+                if( batch ):
+                    pending.append( (sensor, int(t*1000), Hmag, pitch, roll) )
+                    if( len(pending) >= batch ):
+                        self.publish( topic, encode(pending) )
+                        pending = []
+                else:
+                    self.publish( topic, ("BPCUFFSENS,%.2f,%.2f,%.2f,PD3D" %(Hmag, pitch, roll)).encode("ascii") )
+                n = n + 1
+                delay = t0 + n/float(rate) - monotonic()
+                if( delay > 0 ):
+                    threading.Event().wait( delay )
+
+        for topic in topics:
+            thread = threading.Thread( target=run, args=(topics.index(topic) + 1, topic, random.random()*6),
+                                       name="fakeCuff" )
+            thread.daemon = True
+            thread.start()
+
+# ------------------------------------------------------------------------
+
+    def _accept( self ):
+        while( self.running ):
+            try:
+                sock, _ = self.server.accept()
+            except (socket.error, OSError):
+                return
+            thread = threading.Thread( target=self._serve, args=(sock,), name="fakeBrokerClient" )
+            thread.daemon = True
+            thread.start()
+
+    def _serve( self, sock ):
+        reader = PacketReader()
+        try:
+            while( self.running ):
+                data = sock.recv( 4096 )
+                if( not data ):
+                    break
+                reader.feed( data )
+                frame = reader.next()
+                while( frame is not None ):
+                    if( not self._handle(sock, *frame) ):
+                        return
+                    frame = reader.next()
+        except socket.timeout:
+            with self.lock:
+                self.stats["expired"] += 1                                  # Keepalive ran out
+        except (socket.error, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.clients.pop( sock, None )
+            sock.close()
+
+    def _handle( self, sock, kind, flags, body ):
+        if( kind == CONNECT ):
+            n, = struct.unpack( ">H", body[:2] )
+            keepalive, = struct.unpack( ">H", body[2+n+2:2+n+4] )           # After protocol name, level, flags
+            if( keepalive ):
+                sock.settimeout( 1.5*keepalive )                            # recv() times out: client is gone
+            sock.sendall( packet(CONNACK, b"\x00\x00") )
+            with self.lock:
+                self.clients[sock] = []
+                self.stats["connects"] += 1
+
+        elif( kind == SUBSCRIBE ):
+            packetId, = struct.unpack( ">H", body[:2] )
+            offset, filters = 2, []
+            while( offset < len(body) ):
+                n, = struct.unpack( ">H", body[offset:offset+2] )
+                filters.append( body[offset+2:offset+2+n].decode("utf-8") )
+                offset = offset + 2 + n + 1                                 # + requested QoS
+            with self.lock:
+                self.clients.setdefault( sock, [] ).extend( filters )
+            sock.sendall( packet(SUBACK, struct.pack(">H", packetId) + b"\x00"*len(filters)) )
+
+        elif( kind == PINGREQ ):
+            sock.sendall( packet(PINGRESP) )
+
+        elif( kind == DISCONNECT ):
+            return( False )
+        return( True )
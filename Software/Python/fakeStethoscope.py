@@ -0,0 +1,433 @@
+"""
+fakeStethoscope.py
+
+The following module is a stand-in for the Teensy stethoscope firmware, so the
+protocol layer can be exercised and benchmarked without hardware.
+
+A FakeStethoscope decodes the byte protocol with stethoscopeCodec (ENQ, blending
+with its audio file byte, STARTCREC followed by a file name, the two-byte DC1/DC3/
+DC4 commands, ...), keeps the device state those commands change and answers
+ACK/NAK (or data for deviceID) in order, like the firmware does. It serves one end
+of a socketpair or a local TCP socket, with configurable response latency, jitter,
+NAK rate and drop rate (a dropped command gets no answer at all). In framed mode
+it also serves SENDWAV transfers from an in-memory SD card (self.files).
+
+Benchmark the clients against it:
+    python fakeStethoscope.py --client dispatcher --count 500 --latency 0.02
+    python3 fakeStethoscope.py --client async --window 8 --jitter 0.01 --drop 0.01
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  collections, os, random, socket, struct, threading, time, zlib
+from    stethoscopeCodec            import  codec, toBytes, ACK_BYTE, NAK_BYTE, STRING, FILE, DATA
+from    timeStamp                   import  fullStamp, monotonic
+from    rfFraming                   import  FrameReader, encodeFrame, NEGOTIATE
+from    wavTransfer                 import  parseRequest, INFO
+
+# ================================================================================= #
+# Fake Stethoscope
+# ================================================================================= #
+
+class FakeStethoscope(object):
+
+    def __init__( self, latency=0.0, jitter=0.0, nakRate=0.0, dropRate=0.0,
+                  stringGap=0.05, deviceID=b"FK1", framing=False, seed=None ):
+        '''
+        Simulated stethoscope.
+
+        INPUTS:
+            - latency   : Mean delay (sec) between a command and its answer
+            - jitter    : Uniform +/- spread (sec) added to the latency
+            - nakRate   : Probability a command is answered NAK
+            - dropRate  : Probability a command is never answered
+            - stringGap : Silence (sec) that ends a STRING payload (as in the firmware)
+            - deviceID  : Answer to deviceID (padded/cut to its response length)
+            - framing   : Accept framed mode (rfFraming.py) when the client offers it
+            - seed      : Random seed, for reproducible runs
+        '''
+
+        self.latency    = latency
+        self.jitter     = jitter
+        self.nakRate    = nakRate
+        self.dropRate   = dropRate
+        self.stringGap  = stringGap
+        self.deviceID   = toBytes( deviceID )
+        self.framing    = framing
+        self.random     = random.Random( seed )
+
+        self.lock       = threading.Lock()
+        self.state      = { "blending"  : None,                             # Audio file byte being blended
+                            "recording" : None,                             # Recording name (True if unnamed)
+                            "streaming" : False,
+                            "tracking"  : False,
+                            "playback"  : None,
+                            "monitor"   : False,
+                            "muted"     : False,
+                            "bp"        : None }
+        self.files      = {}                                                # SD card: name -> bytes
+        self.log        = []                                                # (name, payload) of every command
+        self.stats      = { "received": 0, "ACK": 0, "NAK": 0, "dropped": 0, "unknown": 0 }
+        self.sockets    = []
+        self.server     = None
+        self.running    = True
+
+# ------------------------------------------------------------------------
+
+    def socketPair( self ):
+        '''
+        Serve one end of a socketpair; returns the client end.
+        '''
+        client, device = socket.socketpair()
+        self.serve( device )
+        return( client )
+
+# ------------------------------------------------------------------------
+
+    def listen( self, host="127.0.0.1", port=0 ):
+        '''
+        Accept TCP connections (one simulated link each) in the background.
+
+        OUTPUT:
+            - (host, port) actually bound
+        '''
+
+        self.server = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        self.server.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        self.server.bind( (host, port) )
+        self.server.listen( 4 )
+
+        def accept():
+            while( self.running ):
+                try:
+                    sock, _ = self.server.accept()
+                except (socket.error, OSError):
+                    return
+                sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+                self.serve( sock )
+
+        self._thread( accept )
+        return( self.server.getsockname() )
+
+# ------------------------------------------------------------------------
+
+    def connect( self, address=None, port=None, timeout=None ):
+        '''
+        ConnectionManager-compatible connect function: fn(address, port, timeout).
+        '''
+        return( self.socketPair() )
+
+# ------------------------------------------------------------------------
+
+    def stop( self ):
+        self.running = False
+        for sock in [self.server] + self.sockets:
+            if( sock is not None ):
+                try:
+                    sock.close()
+                except (socket.error, OSError):
+                    pass
+
+# ------------------------------------------------------------------------
+
+    def serve( self, sock ):
+        '''
+        Serve the device end of a connected socket on background threads.
+        '''
+
+        self.sockets.append( sock )
+        due  = collections.deque()                                          # (due time, bytes), in order
+        cond = threading.Condition()
+
+        def writer():
+            while( True ):
+                with cond:
+                    while( not due ):
+                        cond.wait()
+                    when, data = due.popleft()
+                if( data is None ):
+                    return
+                time.sleep( max(0, when - monotonic()) )
+                try:
+                    sock.sendall( data )
+                except (socket.error, OSError):
+                    return
+
+        def respond( data ):
+            delay = self.latency + self.random.uniform( -self.jitter, self.jitter )
+            with cond:
+                last = due[-1][0] if due else 0
+                due.append( (max(last, monotonic() + max(0, delay)), data) )  # Firmware answers in order
+                cond.notify()
+
+        def reader():
+            try:
+                self._read( sock, respond )
+            finally:
+                with cond:
+                    due.append( (0, None) )
+                    cond.notify()
+
+        self._thread( writer )
+        self._thread( reader )
+
+# ------------------------------------------------------------------------
+
+    def _thread( self, target ):
+        thread = threading.Thread( target=target )
+        thread.daemon = True
+        thread.start()
+        return( thread )
+
+# ------------------------------------------------------------------------
+
+    def _read( self, sock, respond ):
+        '''
+        Decode commands from the byte stream and answer them.
+        '''
+
+        buffer = b""
+        while( self.running ):
+            if( self.framing and buffer[:len(NEGOTIATE)] == NEGOTIATE[:len(buffer)] ):
+                if( len(buffer) >= len(NEGOTIATE) ):                        # Client offers framed mode
+                    respond( NEGOTIATE )
+                    return( self._readFramed(sock, respond, buffer[len(NEGOTIATE):]) )
+                command, consumed = None, 0
+            else:
+                command, consumed = codec.decodeCommand( buffer )
+
+            if( consumed == 0 ):                                            # Need more bytes
+                try:
+                    data = sock.recv( 4096 )
+                except (socket.error, OSError):
+                    return
+                if( not data ):
+                    return
+                buffer = buffer + data
+                continue
+
+            code, buffer = buffer[:consumed], buffer[consumed:]
+            with self.lock:
+                self.stats["received"] += 1
+
+            if( command is None ):                                          # Unknown code
+                with self.lock:
+                    self.stats["unknown"] += 1
+                respond( NAK_BYTE )
+                continue
+
+            payload = None
+            if( command.payload == STRING ):                                # String runs until the link goes quiet
+                payload, buffer = self._readString( sock, buffer ), b""
+                if( payload is None ):
+                    return
+            elif( command.payload == FILE ):
+                payload = code
+
+            answer = self._handle( command, payload )
+            if( answer is not None ):
+                respond( answer )
+
+# ------------------------------------------------------------------------
+
+    def _readFramed( self, sock, respond, buffer ):
+        '''
+        Framed mode: every frame holds one command, answered in a frame with its SEQ.
+        '''
+
+        reader = FrameReader()
+        reader.feed( buffer )
+        while( self.running ):
+            frame = reader.next()
+            if( frame is None ):
+                try:
+                    data = sock.recv( 4096 )
+                except (socket.error, OSError):
+                    return
+                if( not data ):
+                    return
+                reader.feed( data )
+                continue
+
+            seq, body = frame
+            request = parseRequest( body )                                  # SENDWAV (framed only)
+            if( request is not None ):
+                answer = self._transfer( *request )
+                if( answer is not None ):
+                    respond( encodeFrame(seq, answer) )
+                continue
+
+            command, consumed = codec.decodeCommand( body )
+            with self.lock:
+                self.stats["received"] += 1
+                if( command is None ):
+                    self.stats["unknown"] += 1
+            if( command is None ):
+                respond( encodeFrame(seq, NAK_BYTE) )
+                continue
+
+            payload = None
+            if( command.payload == STRING ):
+                payload = body[consumed:]                                   # Delimited by the frame
+            elif( command.payload == FILE ):
+                payload = body[:consumed]
+
+            answer = self._handle( command, payload )
+            if( answer is not None ):
+                respond( encodeFrame(seq, answer) )
+
+# ------------------------------------------------------------------------
+
+    def _transfer( self, kind, name, offset, length ):
+        '''
+        Answer an SD card transfer request (see wavTransfer.py).
+        '''
+
+        with self.lock:
+            self.stats["received"] += 1
+            if( self.random.random() < self.dropRate ):
+                self.stats["dropped"] += 1
+                return( None )
+            data = self.files.get( name.decode("latin-1") )
+            if( data is None or offset > len(data) ):
+                self.stats["NAK"] += 1
+                return( NAK_BYTE )
+            self.stats["ACK"] += 1
+
+        if( kind == INFO ):
+            return( ACK_BYTE + struct.pack(">II", len(data), zlib.crc32(data) & 0xFFFFFFFF) )
+        return( ACK_BYTE + struct.pack(">I", offset) + data[offset:offset+length] )
+
+# ------------------------------------------------------------------------
+
+    def _readString( self, sock, buffer ):
+        sock.settimeout( self.stringGap )
+        try:
+            while( True ):
+                try:
+                    data = sock.recv( 4096 )
+                except socket.timeout:
+                    return( buffer )
+                except (socket.error, OSError):
+                    return( None )
+                if( not data ):
+                    return( buffer )
+                buffer = buffer + data
+        finally:
+            try:
+                sock.settimeout( None )
+            except (socket.error, OSError):
+                pass
+
+# ------------------------------------------------------------------------
+
+    def _handle( self, command, payload ):
+        '''
+        Apply a command. Returns the answer bytes (None when dropped).
+        '''
+
+        with self.lock:
+            self.log.append( (command.name, payload) )
+
+            if( self.random.random() < self.dropRate ):
+                self.stats["dropped"] += 1
+                return( None )
+
+            if( self.random.random() < self.nakRate ):
+                self.stats["NAK"] += 1
+                return( NAK_BYTE )
+
+            self._apply( command.name, payload )
+            self.stats["ACK"] += 1
+
+        if( command.response == DATA ):
+            return( (self.deviceID + b"\0"*command.nResponse)[:command.nResponse] )
+        return( ACK_BYTE )
+
+# ------------------------------------------------------------------------
+
+    def _apply( self, name, payload ):
+        state = self.state
+        if  ( name == "startBlending" ):            state["blending"]   = payload
+        elif( name == "stopBlending" ):             state["blending"]   = None
+        elif( name == "startRecording" ):           state["recording"]  = True
+        elif( name == "startCustomRecording" ):     state["recording"]  = payload.decode( "latin-1" )
+        elif( name == "stopRecording" ):
+            if( state["recording"] not in (None, True) ):                   # Named recording lands on the SD card
+                self.files[ state["recording"] ] = b"RIFF" + os.urandom( 32000 )
+            state["recording"] = None
+        elif( name == "startMicStream" ):           state["streaming"]  = True
+        elif( name == "startTrackingMicStream" ):   state["tracking"]   = True
+        elif( name == "stopTrackingMicStream" ):    state["tracking"]   = False
+        elif( name in ("normalHBPlayback", "earlyHMPlayback", "startPlayback") ):
+                                                    state["playback"]   = name
+        elif( name == "stopPlayback" ):             state["playback"]   = None
+        elif( name == "startHBMonitor" ):           state["monitor"]    = True
+        elif( name == "stopHBMonitor" ):            state["monitor"]    = False
+        elif( name in ("startBPNorm", "startBPBrady", "startBPTachy") ):
+                                                    state["bp"]         = name
+        elif( name == "stopBPAll" ):                state["bp"]         = None
+        elif( name == "mute" ):                     state["muted"]      = True
+        elif( name == "unmute" ):                   state["muted"]      = False
+
+# ================================================================================= #
+# Benchmarks
+# ================================================================================= #
+
+def benchmarkDispatcher( fake, count ):
+    '''
+    Serial request/response through a CommandDispatcher.
+
+    OUTPUT:
+        - (elapsed sec, Histogram of round trips, results per outcome)
+    '''
+
+    from stethoscopeDispatcher import CommandDispatcher, enquiryCommand
+    from latencyStats import Histogram
+
+    dispatcher  = CommandDispatcher( fake.socketPair(), maxPending=count+1 ).start()
+    histogram   = Histogram()
+    outcomes    = {}
+
+    t0 = monotonic()
+    futures = [ dispatcher.submit(enquiryCommand()) for _ in range(count) ]
+    for future in futures:
+        result = future.wait()
+        outcomes[result] = outcomes.get( result, 0 ) + 1
+        if( future.latency() is not None ):
+            histogram.record( future.latency() )
+    elapsed = monotonic() - t0
+
+    dispatcher.stop()
+    return( elapsed, histogram, outcomes )
+
+# ------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument( "--client", default="dispatcher", choices=("dispatcher", "async"), help="Client under test" )
+    ap.add_argument( "--count", type=int, default=500, help="Commands per run" )
+    ap.add_argument( "--window", type=int, default=4, help="Pipelining window (async only)" )
+    ap.add_argument( "--latency", type=float, default=0.02, help="Device response delay (sec)" )
+    ap.add_argument( "--jitter", type=float, default=0.0, help="+/- response delay spread (sec)" )
+    ap.add_argument( "--nak", type=float, default=0.0, help="NAK rate" )
+    ap.add_argument( "--drop", type=float, default=0.0, help="Drop rate" )
+    args = vars( ap.parse_args() )
+
+    fake = FakeStethoscope( args["latency"], args["jitter"], args["nak"], args["drop"], seed=1 )
+    if( args["client"] == "dispatcher" ):
+        elapsed, histogram, outcomes = benchmarkDispatcher( fake, args["count"] )
+    else:
+        from stethoscopeAsync import benchmark                              # Python 3 only
+        elapsed, histogram, outcomes = benchmark( fake, args["count"], args["window"] )
+    fake.stop()
+
+    done = sum( outcomes.values() )
+    print( fullStamp() + " %s: %d commands in %.2f sec (%.1f cmd/s)" %(args["client"], done, elapsed, done/elapsed) )
+    for p in ( 50, 90, 99, 99.9 ):
+        value = histogram.percentile( p )
+        print( "    p%-5g %s" %(p, "-" if value is None else "%.2f ms" %(value*1e3)) )
+    print( "    outcomes %r   device %r" %(outcomes, fake.stats) )
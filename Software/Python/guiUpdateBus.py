@@ -0,0 +1,161 @@
+"""
+guiUpdateBus.py
+
+The following module carries widget updates from any thread to the appJar
+(Tk) thread, batched per frame and only when something changed.
+
+GUI_v3.1 queued one appJar call per MQTT message, and appJar's queueFunction()
+only drains its queue every 250 ms, so a burst of readings piled up calls that
+repainted labels with values they already had. A GuiUpdateBus keeps the latest
+desired value per (setter, widget), e.g. ("setLabelBg", "proxOut"), instead:
+set() may be called from any thread as often as the data arrives and only
+overwrites that slot. Once per frame (fps times a second, scheduled with
+app.after() on the Tk thread) the pending slots are swapped out in one go and
+every value that differs from what the widget already shows is applied.
+
+Counters (see counts()): "submitted" set() calls, "coalesced" values replaced
+before their frame, "unchanged" values the widget already showed, "applied"
+setter calls, "failed" setter calls that raised (e.g. a destroyed widget) and
+"frames" that applied anything. Applied and unchanged values are also counted
+in latencyStats under "guiUpdates", next to a "guiFrame" histogram of the time a
+frame spent in Tk.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  threading
+from    timeStamp                   import  fullStamp, monotonic
+from    latencyStats                import  stats
+
+# ================================================================================= #
+# GUI Update Bus
+# ================================================================================= #
+
+class GuiUpdateBus(object):
+
+    def __init__( self, app, fps=20 ):
+        '''
+        INPUTS:
+            - app       : appJar gui whose setters are called (setLabel, setLabelBg, ...)
+            - fps       : Frames (batches) applied per second at most
+        '''
+
+        self.app        = app
+        self.fps        = fps
+
+        self.lock       = threading.Lock()
+        self.pending    = {}                                                # (setter, widget) -> value
+        self.shown      = {}                                                # (setter, widget) -> value applied
+        self.counters   = dict( (name, 0) for name in ("submitted", "coalesced", "unchanged",
+                                                         "applied", "failed", "frames") )
+        self.running    = False
+        self.afterId    = None
+
+# ------------------------------------------------------------------------
+
+    def start( self ):
+        '''
+        Start applying frames (call on the Tk thread, e.g. before app.go()).
+        '''
+        self.running = True
+        self.afterId = self.app.after( self._period(), self._frame )
+        return( self )
+
+    def stop( self ):
+        self.running = False
+        if( self.afterId is not None ):
+            self.app.afterCancel( self.afterId )
+            self.afterId = None
+
+    def setFps( self, fps ):
+        self.fps = fps                                                      # Used from the next frame on
+
+# ------------------------------------------------------------------------
+
+    def set( self, setter, widget, value ):
+        '''
+        Desired state of a widget (any thread, never blocks on Tk).
+
+        INPUTS:
+            - setter    : Name of the appJar method, e.g. "setLabelBg"
+            - widget    : Widget title
+            - value     : Value passed to the setter
+        '''
+        key = ( setter, widget )
+        with self.lock:
+            self.counters["submitted"] += 1
+            if( key in self.pending ):
+                self.counters["coalesced"] += 1
+            self.pending[key] = value
+
+    def forget( self, widget=None ):
+        '''
+        Drop what is known to be shown (all widgets, or one), e.g. after a
+        subwindow was destroyed and rebuilt, so the next values are applied
+        (Tk thread only, like flush()).
+        '''
+        if( widget is None ):
+            self.shown = {}
+        else:
+            for key in [ k for k in self.shown if k[1] == widget ]:
+                del self.shown[key]
+
+# ------------------------------------------------------------------------
+
+    def flush( self ):
+        '''
+        Apply everything pending now (Tk thread only; the frames call it).
+        '''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if( not pending ):
+            return
+
+        start, applied, unchanged, failed = monotonic(), 0, 0, 0
+        for key, value in pending.items():
+            if( key in self.shown and self.shown[key] == value ):
+                unchanged = unchanged + 1
+                continue
+            setter, widget = key
+            try:
+                getattr( self.app, setter )( widget, value )
+                self.shown[key] = value
+                applied = applied + 1
+            except Exception as instance:
+                print( fullStamp() + " GUI update %s(%r) failed %s" %(setter, widget, str(instance.args)) )
+                failed = failed + 1
+
+        with self.lock:
+            self.counters["applied"]   += applied
+            self.counters["unchanged"] += unchanged
+            self.counters["failed"]    += failed
+            if( applied ):
+                self.counters["frames"] += 1
+        if( applied ):
+            stats.record( "guiFrame", monotonic() - start )
+            stats.count( "guiUpdates", "applied", applied )
+        if( unchanged ):
+            stats.count( "guiUpdates", "unchanged", unchanged )
+
+    def counts( self ):
+        '''
+        OUTPUT:
+            - dict of the counters (coalesced only counts values replaced within a frame)
+        '''
+        with self.lock:
+            return( dict(self.counters) )
+
+# ------------------------------------------------------------------------
+
+    def _period( self ):
+        return( max(1, int(1000.0/self.fps)) )                              # app.after() takes ms
+
+    def _frame( self ):
+        if( not self.running ):
+            return
+        try:
+            self.flush()
+        finally:
+            self.afterId = self.app.after( self._period(), self._frame )
@@ -0,0 +1,281 @@
+"""
+latencyStats.py
+
+The following module records how long every stethoscope command takes.
+
+Round trips are timed with a monotonic clock and recorded per command name into
+HDR-style histograms: log-linear buckets with 32 sub-buckets per power of two, so
+any latency from 1 us to minutes is kept within ~3% using a few hundred integer
+counters and a constant-time record(). Outcome counters (ACK, NAK, TIMEOUT,
+ERROR) sit next to each histogram, and links add RECONNECT/DOWN counters.
+
+The module-level `stats` instance is fed by stethoscopeProtocol,
+bluetoothProtocol_teensy32, stethoscopeDispatcher and connectionManager. A
+SnapshotWriter dumps it to a JSON file periodically; running this module prints
+such a file:
+
+    python latencyStats.py dataOutput/latency.json [--watch 2]
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  json, os, threading, time
+from    timeStamp                   import  fullStamp, monotonic
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+SUB_BITS    = 5                                                             # 2**5 sub-buckets per power of two
+SUB         = 1 << SUB_BITS
+PERCENTILES = ( 50, 90, 99, 99.9 )
+
+def bucketIndex( us ):
+    '''
+    Bucket of an integer value (exact below 2*SUB, log-linear above).
+    '''
+    if( us < 2*SUB ):
+        return( us )
+    shift = us.bit_length() - SUB_BITS - 1
+    return( (shift + 1)*SUB + (us >> shift) - SUB )
+
+def bucketBounds( index ):
+    '''
+    OUTPUT:
+        - (lowest, highest) integer value of a bucket
+    '''
+    if( index < 2*SUB ):
+        return( index, index )
+    shift = index // SUB - 1
+    low   = ( index % SUB + SUB ) << shift
+    return( low, low + (1 << shift) - 1 )
+
+# ================================================================================= #
+# Histogram
+# ================================================================================= #
+
+class Histogram(object):
+
+    __slots__ = ( "counts", "total", "sum", "min", "max" )
+
+    def __init__( self ):
+        '''
+        Log-linear latency histogram, values in microseconds.
+        '''
+        self.counts = {}                                                    # bucket index -> count
+        self.total  = 0
+        self.sum    = 0
+        self.min    = None
+        self.max    = None
+
+    def record( self, seconds ):
+        us = int( seconds * 1e6 )
+        if( us < 0 ):
+            us = 0
+        index = bucketIndex( us )
+        self.counts[index] = self.counts.get( index, 0 ) + 1
+        self.total  = self.total + 1
+        self.sum    = self.sum + us
+        if( self.min is None or us < self.min ): self.min = us
+        if( self.max is None or us > self.max ): self.max = us
+
+    def percentile( self, p ):
+        '''
+        OUTPUT:
+            - Value (sec) below which p percent of the samples fall, None if empty
+        '''
+        if( self.total == 0 ):
+            return( None )
+        rank = p / 100.0 * self.total
+        seen = 0
+        for index in sorted( self.counts ):
+            seen = seen + self.counts[index]
+            if( seen >= rank ):
+                low, high = bucketBounds( index )
+                return( min(high, self.max) / 1e6 )
+        return( self.max / 1e6 )
+
+    def summary( self ):
+        '''
+        OUTPUT:
+            - dict with count, min, mean, max and percentiles (sec), plus raw buckets
+        '''
+        out = { "count" : self.total,
+                "min"   : None if self.min is None else self.min / 1e6,
+                "mean"  : None if self.total == 0 else self.sum / 1e6 / self.total,
+                "max"   : None if self.max is None else self.max / 1e6 }
+        for p in PERCENTILES:
+            out["p%g" %p] = self.percentile( p )
+        out["buckets"] = dict( (str(k), v) for k, v in self.counts.items() )
+        return( out )
+
+# ================================================================================= #
+# Latency Statistics
+# ================================================================================= #
+
+class LatencyStats(object):
+
+    def __init__( self ):
+        '''
+        Per-command histograms and counters, safe to feed from any thread.
+        '''
+        self.lock       = threading.Lock()
+        self.histograms = {}                                                # name -> Histogram
+        self.counters   = {}                                                # name -> {counter: n}
+        self.started    = time.time()
+
+# ------------------------------------------------------------------------
+
+    def record( self, name, seconds, result=None ):
+        '''
+        Record one exchange.
+
+        INPUTS:
+            - name      : Command name
+            - seconds   : Round-trip time (None if it never completed)
+            - result    : Outcome counted next to the histogram (ACK, NAK, ...)
+        '''
+
+        with self.lock:
+            if( seconds is not None ):
+                histogram = self.histograms.get( name )
+                if( histogram is None ):
+                    histogram = self.histograms[name] = Histogram()
+                histogram.record( seconds )
+            if( result is not None ):
+                counters = self.counters.setdefault( name, {} )
+                counters[result] = counters.get( result, 0 ) + 1
+
+# ------------------------------------------------------------------------
+
+    def count( self, name, counter, n=1 ):
+        with self.lock:
+            counters = self.counters.setdefault( name, {} )
+            counters[counter] = counters.get( counter, 0 ) + n
+
+# ------------------------------------------------------------------------
+
+    def snapshot( self ):
+        '''
+        OUTPUT:
+            - JSON-able dict of everything recorded so far
+        '''
+        with self.lock:
+            return( { "time"        : time.time(),
+                      "uptime"      : time.time() - self.started,
+                      "commands"    : dict( (name, h.summary()) for name, h in self.histograms.items() ),
+                      "counters"    : dict( (name, dict(c)) for name, c in self.counters.items() ) } )
+
+# ------------------------------------------------------------------------
+
+    def reset( self ):
+        with self.lock:
+            self.histograms = {}
+            self.counters   = {}
+            self.started    = time.time()
+
+stats = LatencyStats()                                                      # Shared by every protocol module
+
+# ================================================================================= #
+# Snapshot Writer
+# ================================================================================= #
+
+class SnapshotWriter(object):
+
+    def __init__( self, fileName, interval=10.0, source=stats ):
+        '''
+        Periodically write source.snapshot() to a JSON file.
+
+        INPUTS:
+            - fileName  : Snapshot file (replaced atomically)
+            - interval  : Seconds between snapshots
+            - source    : LatencyStats instance
+        '''
+        self.fileName   = fileName
+        self.interval   = interval
+        self.source     = source
+        self.wake       = threading.Event()
+        self.running    = False
+        self.thread     = None
+
+    def start( self ):
+        if( self.thread is None ):
+            self.running        = True
+            self.thread         = threading.Thread( target=self._run, name="latencyStats" )
+            self.thread.daemon  = True
+            self.thread.start()
+        return( self )
+
+    def stop( self ):
+        self.running = False
+        self.wake.set()
+        if( self.thread is not None ):
+            self.thread.join()
+            self.thread = None
+        self.write()                                                        # Final snapshot
+
+    def write( self ):
+        data = json.dumps( self.source.snapshot(), indent=1, sort_keys=True )
+        try:
+            directory = os.path.dirname( self.fileName )
+            if( directory and not os.path.isdir(directory) ):
+                os.makedirs( directory )
+            with open( self.fileName + ".tmp", "w" ) as f:
+                f.write( data )
+            os.rename( self.fileName + ".tmp", self.fileName )
+        except (IOError, OSError) as instance:
+            print( fullStamp() + " Failed to write latency snapshot " + str(instance.args) )
+
+    def _run( self ):
+        while( self.running ):
+            self.wake.wait( self.interval )
+            if( self.running ):
+                self.write()
+
+# ================================================================================= #
+# CLI View
+# ================================================================================= #
+
+def formatSnapshot( snapshot ):
+    '''
+    Render a snapshot as a text table (latencies in ms).
+    '''
+
+    def ms( value ):
+        return( "     -" if value is None else "%6.1f" %(value*1e3) )
+
+    lines = [ "uptime %.0f sec" %snapshot["uptime"],
+              "%-24s %7s %6s %6s %6s %6s %6s  %s" %("command", "count", "p50", "p90", "p99", "p99.9", "max", "counters") ]
+    names = sorted( set(snapshot["commands"]) | set(snapshot["counters"]) )
+    for name in names:
+        h = snapshot["commands"].get( name, {"count": 0} )
+        counters = " ".join( "%s=%d" %kv for kv in sorted(snapshot["counters"].get(name, {}).items()) )
+        lines.append( "%-24s %7d %s %s %s %s %s  %s" %(name, h["count"], ms(h.get("p50")), ms(h.get("p90")),
+                                                        ms(h.get("p99")), ms(h.get("p99.9")), ms(h.get("max")), counters) )
+    return( "\n".join(lines) )
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument( "snapshot", nargs="?", default="dataOutput/latency.json", help="Snapshot file" )
+    ap.add_argument( "--watch", type=float, default=0, help="Refresh every N sec" )
+    ap.add_argument( "--overhead", action="store_true", help="Measure the cost of record()" )
+    args = vars( ap.parse_args() )
+
+    if( args["overhead"] ):
+        s, n = LatencyStats(), 200000
+        t0 = monotonic()
+        for i in range( n ):
+            s.record( "statusEnquiry", 0.0123, "ACK" )
+        print( "record(): %.2f us per call" %((monotonic() - t0) / n * 1e6) )
+
+    else:
+        while( True ):
+            with open( args["snapshot"] ) as f:
+                print( formatSnapshot(json.load(f)) )
+            if( not args["watch"] ):
+                break
+            time.sleep( args["watch"] )
+            print( "" )
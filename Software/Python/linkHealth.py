@@ -0,0 +1,208 @@
+"""
+linkHealth.py
+
+The following module watches the quality of every stethoscope link and warns
+before a link fails a real command.
+
+Each Link carries a LinkQuality fed by every exchange on it, so busy links are
+measured on their real traffic (piggybacking) and are never probed. A
+HealthMonitor thread sends an ENQ probe, at a low configurable cadence, only to
+links that have been idle for that long. From this it tracks RTT (EWMA), loss
+rate over the last N exchanges and time since the last ACK per device, and
+calls onWarning(address, kind, value) whenever a figure crosses its threshold
+(and again with kind "ok" once the link has recovered). A timed-out command
+already makes the link reconnect; a link that answers but has not ACKed anything
+for too long (e.g. NAKs every probe) is reconnected proactively too, instead of
+waiting for the next startBlending to fail. The loss rate spans reconnects, so a
+link that keeps dropping out shows up as LOSSY.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  collections, threading
+from    timeStamp                   import  fullStamp, monotonic
+from    stethoscopeDispatcher       import  enquiryCommand, ACK, NAK, TIMEOUT, ERROR
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+# Warning kinds
+SLOW    = "slow"                                                            # RTT EWMA above warnRtt
+LOSSY   = "lossy"                                                           # Loss rate above warnLoss
+SILENT  = "silent"                                                          # No ACK for warnSilence sec
+DOWN    = "down"                                                            # Link lost, reconnecting
+OK      = "ok"                                                              # Every figure back to normal
+
+# ================================================================================= #
+# Link Quality
+# ================================================================================= #
+
+class LinkQuality(object):
+
+    def __init__( self, window=50, alpha=0.2 ):
+        '''
+        Rolling quality figures of one link.
+
+        INPUTS:
+            - window    : Number of recent exchanges the loss rate is computed over
+            - alpha     : Weight of a new RTT sample in the EWMA
+        '''
+        self.alpha          = alpha
+        self.outcomes       = collections.deque( maxlen=window )           # True: answered, False: lost
+        self.rtt            = None                                          # EWMA of round-trip time (sec)
+        self.rttVar         = None                                          # EWMA of |rtt - mean| (sec)
+        self.lastAck        = None                                          # monotonic time of last ACK
+        self.lastActivity   = monotonic()                                   # Last exchange of any kind
+
+    def observe( self, future ):
+        '''
+        Feed a resolved CommandFuture (called on the dispatcher thread).
+        '''
+        if( future.result in (ACK, NAK) ):
+            self.outcomes.append( True )
+            self.lastActivity = future.doneAt
+            if( future.result == ACK ):
+                self.lastAck = future.doneAt
+            rtt = future.latency()
+            if( self.rtt is None ):
+                self.rtt, self.rttVar = rtt, rtt / 2.0
+            else:
+                self.rttVar = ( 1 - self.alpha )*self.rttVar + self.alpha*abs( rtt - self.rtt )
+                self.rtt    = ( 1 - self.alpha )*self.rtt + self.alpha*rtt
+
+        elif( future.result in (TIMEOUT, ERROR) ):
+            self.outcomes.append( False )
+
+    def loss( self ):
+        if( not self.outcomes ):
+            return( 0.0 )
+        return( self.outcomes.count(False) / float(len(self.outcomes)) )
+
+    def sinceAck( self, now=None ):
+        if( self.lastAck is None ):
+            return( None )
+        return( (now or monotonic()) - self.lastAck )
+
+    def reset( self ):
+        '''
+        New connection: restart the silence clock (RTT and loss history are kept).
+        '''
+        self.lastAck        = monotonic()
+        self.lastActivity   = monotonic()
+
+# ================================================================================= #
+# Health Monitor
+# ================================================================================= #
+
+class HealthMonitor(object):
+
+    def __init__( self, manager, probeInterval=5.0, warnRtt=0.5, warnLoss=0.2, warnSilence=15.0,
+                  reconnectSilence=30.0, minSamples=10, onWarning=None ):
+        '''
+        Probe idle links and raise early warnings.
+
+        INPUTS:
+            - manager         : ConnectionManager whose links are watched
+            - probeInterval   : Idle time (sec) after which a link is probed
+            - warnRtt         : RTT EWMA (sec) that raises SLOW
+            - warnLoss        : Loss rate that raises LOSSY
+            - warnSilence     : Time without ACK (sec) that raises SILENT
+            - reconnectSilence: Time without ACK (sec) at which the link is reconnected
+            - minSamples      : Exchanges needed before the loss rate is trusted
+            - onWarning       : fn(address, kind, value), called on the monitor thread
+        '''
+
+        self.manager            = manager
+        self.probeInterval      = probeInterval
+        self.warnRtt            = warnRtt
+        self.warnLoss           = warnLoss
+        self.warnSilence        = warnSilence
+        self.reconnectSilence   = reconnectSilence
+        self.minSamples         = minSamples
+        self.onWarning          = onWarning
+
+        self.active             = {}                                        # address -> set of raised kinds
+        self.wake               = threading.Event()
+        self.running            = False
+        self.thread             = None
+
+# ------------------------------------------------------------------------
+
+    def start( self ):
+        if( self.thread is None ):
+            self.running        = True
+            self.thread         = threading.Thread( target=self._run, name="linkHealth" )
+            self.thread.daemon  = True
+            self.thread.start()
+        return( self )
+
+    def stop( self ):
+        self.running = False
+        self.wake.set()
+        if( self.thread is not None ):
+            self.thread.join()
+            self.thread = None
+
+# ------------------------------------------------------------------------
+
+    def _run( self ):
+        tick = min( 1.0, self.probeInterval / 2.0 )
+        while( self.running ):
+            for link in list( self.manager.links.values() ):
+                try:
+                    self.check( link )
+                except Exception as instance:
+                    print( fullStamp() + " Health check of " + link.address + " failed " + str(instance.args) )
+            self.wake.wait( tick )
+
+# ------------------------------------------------------------------------
+
+    def check( self, link, now=None ):
+        '''
+        Probe the link if idle, evaluate its figures, warn and reconnect as needed.
+        '''
+
+        if( not link.upEvent.is_set() ):                                    # Reconnect in progress
+            if( DOWN not in self.active.get(link.address, ()) ):
+                self._warn( link.address, DOWN, None )
+                self.active[link.address] = set( [DOWN] )
+            return
+
+        now     = monotonic() if now is None else now
+        quality = link.quality
+        if( now - quality.lastActivity >= self.probeInterval ):
+            quality.lastActivity = now                                      # One probe per interval
+            link.submit( enquiryCommand() )                                 # Lowest priority
+
+        loss    = quality.loss() if len( quality.outcomes ) >= self.minSamples else 0.0
+        silence = quality.sinceAck( now ) or 0.0
+
+        raised = set()
+        if( quality.rtt is not None and quality.rtt > self.warnRtt ):   raised.add( SLOW )
+        if( loss > self.warnLoss ):                                     raised.add( LOSSY )
+        if( silence > self.warnSilence ):                               raised.add( SILENT )
+
+        values   = { SLOW: quality.rtt, LOSSY: loss, SILENT: silence }
+        previous = self.active.get( link.address, set() )
+        for kind in raised - previous:                                      # Edge triggered
+            self._warn( link.address, kind, values[kind] )
+        if( previous and not raised ):
+            self._warn( link.address, OK, None )
+        self.active[link.address] = raised
+
+        if( silence >= self.reconnectSilence ):
+            link._down( "no ACK for %.1f sec" %silence )
+
+# ------------------------------------------------------------------------
+
+    def _warn( self, address, kind, value ):
+        print( fullStamp() + " Link " + address + " " + kind.upper() +
+               ( "" if value is None else " (%.3f)" %value ) )
+        if( self.onWarning is not None ):
+            try:
+                self.onWarning( address, kind, value )
+            except Exception as instance:
+                print( fullStamp() + " Warning handler failed " + str(instance.args) )
@@ -0,0 +1,459 @@
+"""
+mqttIngest.py
+
+The following module receives the cuff IMU data (Esp8266Mqtt_IMU_BPcuff_*)
+straight from the MQTT broker.
+
+GUI_v3.1 used to spawn mosquitto_sub under pexpect and read one text line at a
+time, printing each, which falls behind the ESP8266 publishers. An MqttIngest
+keeps one MQTT 3.1.1 connection in a background thread for any number of cuff
+topics (wildcards allowed), reconnecting with jittered exponential backoff. It
+reads the socket in large chunks and parses every complete packet in it, and
+stores raw messages in a bounded queue that drops the oldest when the consumer
+lags. The consumer drains the queue in batches with get(), which parses the
+payloads (text, or the batched binary format of mqttPayload.py), and latest()
+returns the newest reading per topic.
+
+Per-topic statistics: message count, rate (msg/sec counted over the last full
+rateWindow), lag from reception to consumption (mean/max), drops and parse
+errors.
+
+A PINGREQ goes out every keepalive/2 whatever the traffic, and a connection
+nothing has come back on for 1.5*keepalive (no PINGRESP either) is taken as
+half-open (Wi-Fi drop, broker power loss) and re-established.
+
+Only what a subscriber needs is implemented (CONNECT, SUBSCRIBE, PUBLISH QoS 0/1,
+PINGREQ), so no client library is required. fakeBroker.py is a local stand-in:
+    python mqttIngest.py --fake --rate 200
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  collections, os, random, socket, struct, threading
+from    timeStamp                   import  fullStamp, monotonic
+from    mqttPayload                 import  isBinary, decodeSamples
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+CONNECT, CONNACK, PUBLISH, PUBACK   = 1, 2, 3, 4                            # Control packet types
+SUBSCRIBE, SUBACK                   = 8, 9
+PINGREQ, PINGRESP, DISCONNECT       = 12, 13, 14
+
+Reading = collections.namedtuple( "Reading", "topic sensor Hmag pitch roll location receivedAt deviceTime" )
+
+def encodeLength( n ):
+    """
+    MQTT variable-length "remaining length".
+    """
+    out = bytearray()
+    while( True ):
+        byte, n = n % 128, n // 128
+        out.append( byte | (0x80 if n else 0) )
+        if( not n ):
+            return( bytes(out) )
+
+def encodeString( text ):
+    data = text.encode( "utf-8" ) if not isinstance( text, bytes ) else text
+    return( struct.pack(">H", len(data)) + data )
+
+def packet( kind, body=b"", flags=0 ):
+    return( struct.pack(">B", (kind << 4) | flags) + encodeLength(len(body)) + body )
+
+def connectPacket( clientId, keepalive ):
+    body = encodeString( "MQTT" ) + struct.pack( ">BBH", 4, 0x02, keepalive )   # v3.1.1, clean session
+    return( packet(CONNECT, body + encodeString(clientId)) )
+
+def subscribePacket( packetId, topics ):
+    body = struct.pack( ">H", packetId )
+    for topic in topics:
+        body = body + encodeString( topic ) + b"\x00"                          # Requested QoS 0
+    return( packet(SUBSCRIBE, body, 0x02) )
+
+def publishPacket( topic, payload ):
+    return( packet(PUBLISH, encodeString(topic) + payload) )
+
+def topicMatches( pattern, topic ):
+    """
+    MQTT topic filter matching ('+' one level, '#' the rest).
+    """
+    p, t = pattern.split( "/" ), topic.split( "/" )
+    for i, level in enumerate( p ):
+        if( level == "#" ):
+            return( True )
+        if( i >= len(t) or (level != "+" and level != t[i]) ):
+            return( False )
+    return( len(p) == len(t) )
+
+# ================================================================================= #
+# Packet Reader
+# ================================================================================= #
+
+class PacketReader(object):
+
+    def __init__( self ):
+        '''
+        Incremental MQTT parser: feed() it recv() chunks, take packets with next().
+        '''
+        self.buffer = bytearray()
+
+    def feed( self, data ):
+        self.buffer.extend( bytearray(data) )
+
+    def next( self ):
+        '''
+        OUTPUT:
+            - (type, flags, body) of the next complete packet ; None if there is none yet
+        '''
+        buffer = self.buffer
+        length, shift, i = 0, 0, 1
+        while( True ):
+            if( i >= len(buffer) ):
+                return( None )
+            length = length | ( (buffer[i] & 0x7F) << shift )
+            shift, i = shift + 7, i + 1
+            if( not buffer[i-1] & 0x80 ):
+                break
+        if( len(buffer) < i + length ):
+            return( None )
+        kind, flags = buffer[0] >> 4, buffer[0] & 0x0F
+        body = bytes( buffer[i:i+length] )
+        del buffer[:i+length]
+        return( kind, flags, body )
+
+def parsePublish( flags, body ):
+    '''
+    OUTPUT:
+        - (topic, packetId or None, payload)
+    '''
+    n,      = struct.unpack( ">H", body[:2] )
+    topic   = body[2:2+n].decode( "utf-8", "replace" )
+    offset  = 2 + n
+    packetId = None
+    if( (flags >> 1) & 0x03 ):                                              # QoS 1/2 carry a packet id
+        packetId, = struct.unpack( ">H", body[offset:offset+2] )
+        offset = offset + 2
+    return( topic, packetId, body[offset:] )
+
+# ================================================================================= #
+# Cuff Payloads
+# ================================================================================= #
+
+def parsePayload( payload ):
+    '''
+    Decode a cuff message, either
+        "BPCUFFSENS,Hmag,pitch,roll,LOCATION"                   (vDemo, GUI_v3.1)
+        "\\nH:\\t<Hmag>\\npitch:\\t<pitch>\\nroll:\\t<roll>\\n..."    (v2, v3)
+
+    OUTPUT:
+        - (sensor, Hmag, pitch, roll, location) ; None if the payload is neither
+    '''
+    text = payload.decode( "ascii", "replace" ).strip( "\x00 \r\n" )
+    try:
+        if( text.startswith("BPCUFFSENS,") ):
+            fields = text.split( "," )
+            return( fields[0], float(fields[1]), float(fields[2]), float(fields[3]),
+                    fields[4] if len(fields) > 4 else None )
+
+        values = {}
+        for line in text.splitlines():
+            key, _, value = line.partition( ":" )
+            values[ key.strip() ] = value.strip()
+        return( "BPCUFFSENS", float(values["H"]), float(values["pitch"]), float(values["roll"]), None )
+    except (KeyError, ValueError, IndexError):
+        return( None )
+
+# ================================================================================= #
+# MQTT Ingest
+# ================================================================================= #
+
+class MqttIngest(object):
+
+    def __init__( self, host, topics, port=1883, keepalive=30, queueSize=256, clientId=None,
+                  minBackoff=0.5, maxBackoff=10.0, rateWindow=1.0 ):
+        '''
+        Background MQTT subscriber for the cuff sensors.
+
+        INPUTS:
+            - host      : Broker address
+            - topics    : List of topic filters (e.g. ["csec/device/+"])
+            - port      : Broker port
+            - keepalive : MQTT keepalive (sec)
+            - queueSize : Messages kept when the consumer lags (oldest dropped first)
+            - clientId  : MQTT client id (default: unique per process)
+            - minBackoff: First reconnect delay (sec), doubled up to maxBackoff
+            - rateWindow: Window (sec) the per-topic message rate is counted over
+        '''
+
+        self.host           = host
+        self.port           = port
+        self.topics         = list( topics )
+        self.keepalive      = keepalive
+        self.clientId       = clientId or "abpc-%d-%04x" %( os.getpid(), random.getrandbits(16) )
+        self.minBackoff     = minBackoff
+        self.maxBackoff     = maxBackoff
+        self.rateWindow     = rateWindow
+
+        self.queue          = collections.deque( maxlen=queueSize )         # (topic, payload, receivedAt)
+        self.lock           = threading.Lock()
+        self.ready          = threading.Condition( self.lock )
+        self.latestReading  = {}                                            # topic -> Reading
+        self.topicStats     = {}                                            # topic -> dict
+        self.connected      = threading.Event()
+        self.reconnects     = 0
+
+        self.sock           = None
+        self.lastSent       = None                                          # When we last sent the broker a packet
+        self.lastReceived   = None                                          # ... and last heard from it
+        self.wake           = threading.Event()                             # Cuts reconnect delays short on stop()
+        self.running        = False
+        self.thread         = None
+
+# ------------------------------------------------------------------------
+
+    def start( self ):
+        if( self.thread is None ):
+            self.running        = True
+            self.wake.clear()
+            self.thread         = threading.Thread( target=self._run, name="mqttIngest" )
+            self.thread.daemon  = True
+            self.thread.start()
+        return( self )
+
+    def stop( self ):
+        self.running = False
+        self.wake.set()
+        sock = self.sock
+        if( sock is not None ):
+            try:
+                sock.sendall( packet(DISCONNECT) )
+                sock.shutdown( socket.SHUT_RDWR )
+            except (socket.error, OSError):
+                pass
+        if( self.thread is not None ):
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self.ready.notify_all()
+
+# ------------------------------------------------------------------------
+
+    def get( self, timeout=None ):
+        '''
+        Take every queued message, parsed.
+
+        INPUTS:
+            - timeout   : Wait up to this long (sec) when the queue is empty (None: forever)
+
+        OUTPUT:
+            - list of Reading, oldest first (empty on timeout)
+        '''
+
+        with self.lock:
+            if( not self.queue and self.running ):
+                self.ready.wait( timeout )
+            batch = list( self.queue )
+            self.queue.clear()
+
+        now, readings = monotonic(), []
+        for topic, payload, receivedAt in batch:
+            stats = self.topicStats[topic]
+            if( isBinary(payload) ):                                        # N samples per message
+                try:
+                    samples = [ Reading(topic, sensor, Hmag, pitch, roll, None, receivedAt, t)
+                                for sensor, t, Hmag, pitch, roll in decodeSamples(payload) ]
+                except (ValueError, struct.error):
+                    samples = []
+            else:
+                fields  = parsePayload( payload )
+                samples = [ Reading(topic, *(fields + (receivedAt, None))) ] if fields is not None else []
+            if( not samples ):
+                stats["parseErrors"] += 1
+                continue
+            lag = now - receivedAt
+            stats["lagMax"] = max( stats["lagMax"], lag )
+            stats["lagSum"] = stats["lagSum"] + lag
+            stats["consumed"] += 1
+            readings.extend( samples )
+            self.latestReading[topic] = samples[-1]
+        return( readings )
+
+    def latest( self, topic ):
+        return( self.latestReading.get(topic) )
+
+# ------------------------------------------------------------------------
+
+    def stats( self ):
+        '''
+        OUTPUT:
+            - dict topic -> {messages, rate, lagMean, lagMax, dropped, parseErrors}
+        '''
+        with self.lock:
+            out = {}
+            for topic, s in self.topicStats.items():
+                out[topic] = { "messages"    : s["messages"],
+                               "rate"        : s["rate"],
+                               "lagMean"     : s["lagSum"] / s["consumed"] if s["consumed"] else None,
+                               "lagMax"      : s["lagMax"],
+                               "dropped"     : s["dropped"],
+                               "parseErrors" : s["parseErrors"] }
+            return( out )
+
+# ------------------------------------------------------------------------
+
+    def _run( self ):
+        backoff = self.minBackoff
+        while( self.running ):
+            try:
+                self._session()
+                backoff = self.minBackoff                                   # Clean session end: retry fast
+            except (socket.error, OSError, IOError, ValueError) as instance:
+                if( self.running ):
+                    print( fullStamp() + " MQTT " + self.host + " " + str(instance) )
+            self.connected.clear()
+            if( self.running ):
+                delay   = backoff * random.uniform( 0.5, 1.0 )              # Jitter
+                backoff = min( backoff*2, self.maxBackoff )
+                self.wake.wait( delay )
+
+# ------------------------------------------------------------------------
+
+    def _session( self ):
+        '''
+        One connection: connect, subscribe, then read until the broker goes away.
+        '''
+
+        sock = socket.create_connection( (self.host, self.port), timeout=5.0 )
+        self.sock = sock
+        try:
+            reader = PacketReader()
+            sock.sendall( connectPacket(self.clientId, self.keepalive) )
+            kind, _, body = self._expect( sock, reader, CONNACK )
+            if( bytearray(body)[1] != 0 ):
+                raise ValueError( "Broker refused connection (code %d)" %bytearray(body)[1] )
+            sock.sendall( subscribePacket(1, self.topics) )
+            self._expect( sock, reader, SUBACK )
+
+            self.reconnects = self.reconnects + 1
+            self.connected.set()
+            print( fullStamp() + " MQTT connected to " + self.host + " " + ", ".join(self.topics) )
+
+            ping          = self.keepalive / 2.0
+            silence       = 1.5 * self.keepalive
+            self.lastSent = self.lastReceived = monotonic()                 # The broker drops us after 1.5*keepalive
+            while( self.running ):                                          # ... of silence, however much it sends
+                now  = monotonic()
+                if( now - self.lastReceived >= silence ):                   # Pinged, and not even a PINGRESP
+                    raise IOError( "No answer from broker for %.0f sec" %(now - self.lastReceived) )
+                idle = now - self.lastSent
+                if( idle >= ping ):
+                    sock.sendall( packet(PINGREQ) )
+                    self.lastSent, idle = monotonic(), 0
+                sock.settimeout( max(0.01, min(ping - idle, self.lastReceived + silence - now)) )
+                try:
+                    data = sock.recv( 65536 )                               # Whole chunks, not lines
+                except socket.timeout:
+                    continue
+                if( not data ):
+                    raise IOError( "Connection closed by broker" )
+                self.lastReceived = monotonic()
+                reader.feed( data )
+                self._handle( sock, reader, monotonic() )
+        finally:
+            self.sock = None
+            sock.close()
+
+    def _expect( self, sock, reader, wanted ):
+        while( True ):
+            frame = reader.next()
+            if( frame is not None ):
+                if( frame[0] == wanted ):
+                    return( frame )
+                continue
+            data = sock.recv( 4096 )
+            if( not data ):
+                raise IOError( "Connection closed by broker" )
+            reader.feed( data )
+
+# ------------------------------------------------------------------------
+
+    def _handle( self, sock, reader, now ):
+        '''
+        Queue every PUBLISH of the chunk under a single lock acquisition.
+        '''
+        batch = []
+        frame = reader.next()
+        while( frame is not None ):
+            kind, flags, body = frame
+            if( kind == PUBLISH ):
+                topic, packetId, payload = parsePublish( flags, body )
+                batch.append( (topic, payload, now) )
+                if( packetId is not None ):
+                    sock.sendall( packet(PUBACK, struct.pack(">H", packetId)) )
+                    self.lastSent = monotonic()
+            frame = reader.next()
+
+        if( not batch ):
+            return
+        counts = collections.Counter( message[0] for message in batch )
+        with self.lock:
+            for topic, n in counts.items():
+                stats = self.topicStats.get( topic )
+                if( stats is None ):
+                    stats = self.topicStats[topic] = { "messages": 0, "rate": 0.0, "windowStart": now,
+                                                       "windowCount": -n,   # Arrived before the window
+                                                       "lagSum": 0.0, "lagMax": 0.0, "consumed": 0,
+                                                       "dropped": 0, "parseErrors": 0 }
+                stats["messages"] += n
+                stats["windowCount"] += n                                   # Counted, not averaged per chunk
+                elapsed = now - stats["windowStart"]
+                if( elapsed >= self.rateWindow ):
+                    stats["rate"] = stats["windowCount"] / elapsed
+                    stats["windowStart"], stats["windowCount"] = now, 0
+            for message in batch:
+                if( len(self.queue) == self.queue.maxlen ):
+                    self.topicStats[ self.queue[0][0] ]["dropped"] += 1     # Oldest goes
+                self.queue.append( message )
+            self.ready.notify_all()
+
+# ================================================================================= #
+# Stand-alone
+# ================================================================================= #
+
+if __name__ == "__main__":
+    import argparse, time
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument( "--host", default="192.168.42.1", help="MQTT broker" )
+    ap.add_argument( "--topic", action="append", default=None, help="Topic filter (repeatable)" )
+    ap.add_argument( "--fake", action="store_true", help="Use fakeBroker with simulated cuffs" )
+    ap.add_argument( "--cuffs", type=int, default=4, help="Simulated cuffs (--fake)" )
+    ap.add_argument( "--rate", type=float, default=50.0, help="Readings/sec per simulated cuff (--fake)" )
+    ap.add_argument( "--batch", type=int, default=0, help="Readings per binary message, 0: text (--fake)" )
+    ap.add_argument( "--seconds", type=float, default=5.0, help="How long to run" )
+    args = vars( ap.parse_args() )
+
+    topics = args["topic"] or [ "csec/device/+" ]
+    port   = 1883
+    if( args["fake"] ):
+        from fakeBroker import FakeBroker
+        broker = FakeBroker().start()
+        broker.simulateCuffs( ["csec/device/bpcuff_%d" %(i+1) for i in range(args["cuffs"])], args["rate"], args["batch"] )
+        args["host"], port = "127.0.0.1", broker.port
+
+    ingest = MqttIngest( args["host"], topics, port ).start()
+    stopAt = monotonic() + args["seconds"]
+    readings = 0
+    while( monotonic() < stopAt ):
+        readings = readings + len( ingest.get(0.5) )
+    ingest.stop()
+
+    print( "%d readings in %.1f sec" %(readings, args["seconds"]) )
+
+    for topic, s in sorted( ingest.stats().items() ):
+        print( "%-28s %6d msgs %7.1f msg/s  lag %.2f/%.2f ms  dropped %d  errors %d"
+               %(topic, s["messages"], s["rate"], (s["lagMean"] or 0)*1e3, s["lagMax"]*1e3,
+                 s["dropped"], s["parseErrors"]) )
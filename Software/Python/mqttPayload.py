@@ -0,0 +1,121 @@
+"""
+mqttPayload.py
+
+The following module defines the binary payload format of the cuff IMU
+messages and decodes it, next to the text formats of older firmware.
+
+The ESP8266 sketches publish one text message per reading, which mqttIngest has
+to split and float() one message at a time. Version 1 of the binary format packs
+N readings into one message, little-endian like the ESP8266:
+
+    Header : MAGIC (u8, 0xB7) | VERSION (u8, 1) | COUNT (u16)
+    Sample : sensor (u16) | t (u32, ms on the sensor's clock) | Hmag (f32) | pitch (f32) | roll (f32)
+
+so a message is 4 + 18*COUNT bytes. No text payload starts with 0xB7, so both
+kinds can share a topic. With NumPy the samples are decoded in one frombuffer()
+call; without it struct is used instead (slower, same result).
+
+Benchmark both formats:
+    python mqttPayload.py --batch 32 --messages 20000
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  struct
+
+try:
+    import  numpy                   as      np
+except ImportError:
+    np = None                                                               # Decoded with struct instead
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+MAGIC       = 0xB7
+VERSION     = 1
+HEADER      = struct.Struct( "<BBH" )
+SAMPLE      = struct.Struct( "<HIfff" )                                     # 18 bytes, no padding
+FIELDS      = ( "sensor", "t", "Hmag", "pitch", "roll" )
+
+if( np is not None ):
+    DTYPE   = np.dtype( [("sensor", "<u2"), ("t", "<u4"), ("Hmag", "<f4"), ("pitch", "<f4"), ("roll", "<f4")] )
+    if( DTYPE.itemsize != SAMPLE.size ):
+        raise ValueError( "NumPy layout does not match the sample layout" )
+
+def isBinary( payload ):
+    return( len(payload) >= HEADER.size and bytearray(payload[:1])[0] == MAGIC )
+
+def encode( samples ):
+    '''
+    Pack readings into one version 1 message (used by tests and fakeBroker).
+
+    INPUTS:
+        - samples   : iterable of (sensor, t, Hmag, pitch, roll)
+    '''
+    samples = list( samples )
+    return( HEADER.pack(MAGIC, VERSION, len(samples)) + b"".join(SAMPLE.pack(*s) for s in samples) )
+
+def _check( payload ):
+    magic, version, count = HEADER.unpack( payload[:HEADER.size] )
+    if( magic != MAGIC or version != VERSION ):
+        raise ValueError( "Unsupported payload version %d" %version )
+    if( len(payload) != HEADER.size + count*SAMPLE.size ):
+        raise ValueError( "Payload of %d bytes does not hold %d samples" %(len(payload), count) )
+    return( count )
+
+# ================================================================================= #
+# Decoding
+# ================================================================================= #
+
+def decodeArray( payload ):
+    '''
+    OUTPUT:
+        - NumPy structured array with FIELDS (raises ValueError on a malformed payload)
+    '''
+    count = _check( payload )
+    return( np.frombuffer(payload, dtype=DTYPE, count=count, offset=HEADER.size) )
+
+def decodeSamples( payload ):
+    '''
+    OUTPUT:
+        - list of (sensor, t, Hmag, pitch, roll) tuples (raises ValueError on a malformed payload)
+    '''
+    if( np is not None ):
+        return( decodeArray(payload).tolist() )
+    count = _check( payload )
+    return( [ SAMPLE.unpack_from(payload, HEADER.size + i*SAMPLE.size) for i in range(count) ] )
+
+# ================================================================================= #
+# Stand-alone
+# ================================================================================= #
+
+if __name__ == "__main__":
+    import argparse, random, time
+    from mqttIngest import parsePayload
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument( "--batch", type=int, default=32, help="Samples per binary message" )
+    ap.add_argument( "--messages", type=int, default=20000, help="Messages decoded per run" )
+    args = vars( ap.parse_args() )
+
+    rng     = random.Random( 1 )
+    samples = [ (1, 20*i, rng.uniform(0, 8), rng.uniform(-90, 90), rng.uniform(-90, 90)) for i in range(args["batch"]) ]
+    text    = [ ("BPCUFFSENS,%.2f,%.2f,%.2f,PD3D" %s[2:]).encode("ascii") for s in samples ]
+    binary  = encode( samples )
+
+    def run( name, fn, payloads, perMessage ):
+        t0 = time.time()
+        for i in range( args["messages"] ):
+            fn( payloads[i % len(payloads)] )
+        dt = time.time() - t0
+        print( "%-22s %9.0f msg/s %11.0f samples/s" %(name, args["messages"]/dt, args["messages"]*perMessage/dt) )
+
+    print( "NumPy %s, %d samples per binary message (%d bytes vs %d bytes of text)"
+           %("available" if np is not None else "missing", args["batch"], len(binary), sum(len(t) for t in text)) )
+    run( "text (1/msg)", parsePayload, text, 1 )
+    run( "binary tuples", decodeSamples, [binary], args["batch"] )
+    if( np is not None ):
+        run( "binary array", decodeArray, [binary], args["batch"] )
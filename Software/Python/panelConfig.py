@@ -0,0 +1,348 @@
+"""
+panelConfig.py
+
+The following module loads the runtime parameters of a panel from one validated
+configuration, instead of module globals spread over the dial, GUI and protocol
+scripts (V_supply, GAIN, the ADC calibration points, the 180/40 mmHg filter
+markers, the 75-125 mmHg band, the EMA ALPHA, stethoscope addresses, the MQTT
+broker, ...).
+
+Values are layered, later layers winning:
+    SCHEMA defaults < <dataDir>/panelConfig.json < <dataDir>/panel<N>config.json < overrides
+(overrides are e.g. the command line). Both files are flat JSON objects of
+SCHEMA names; unknown names, wrong types and out-of-range values are all
+reported in one ConfigError.
+
+The result is a Parameters object: immutable, with __slots__, and with the
+derived constants precompiled (the ADC-to-mmHg mapping is two multiply-adds and
+a clamp, no numpy.interp call), so the acquisition loop reads plain attributes.
+Readers take `params = config.current` once per pass; a reload builds a new
+Parameters and swaps the reference, so a pass never sees a half-applied change.
+
+Only parameters marked hot (filter alpha and markers, band, trigger timing, log
+interval, mute commands) are taken over by a reload (reload(), or watch() when a file's mtime,
+inode or size changes). A changed cold parameter (sensor supply, ADC gain and
+calibration, addresses, broker) is reported and keeps its running value until
+restart.
+
+Stand-alone (validate and print the effective parameters):
+    python panelConfig.py <dataDir> [--panel N]
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  json, os, threading
+from    timeStamp                   import  fullStamp
+
+TEXT    = ( str, type(u"") )                                                # JSON strings on Python 2 and 3
+
+# ================================================================================= #
+# Schema
+# ================================================================================= #
+
+def _frozen( value ):
+    return( tuple(value) if isinstance(value, list) else value )          # As stored in Parameters
+
+def _positive( value ):
+    return( value > 0 )
+
+def _fraction( value ):
+    return( 0 < value <= 1 )
+
+def _pair( value ):
+    return( len(value) == 2 and value[0] < value[1] )
+
+def _addresses( value ):
+    return( all(len(address.split(":")) == 6 for address in value) )
+
+#   name                kind        default                         hot     check
+SCHEMA = (
+    ( "deviceName",     TEXT,       "ABPC",                         False,  None        ),
+    ( "scenarioNumber", int,        1,                              False,  None        ),
+    ( "stethoscopes",   list,       [ "00:06:66:D0:E4:94",
+                                      "00:06:66:8C:D3:F6",
+                                      "00:06:66:86:77:09" ],        False,  _addresses  ),
+    ( "port",           int,        1,                              False,  _positive   ),
+    ( "mqttHost",       TEXT,       "192.168.42.1",                 False,  None        ),
+    ( "mqttTopic",      TEXT,       "csec/device/bpcuff_1",         False,  None        ),
+
+    ( "vSupply",        float,      3.3,                            False,  _positive   ),  # Sensor supply (V)
+    ( "adcGain",        int,        1,                              False,  lambda v: v in (1, 2, 4, 8, 16) ),
+    ( "adcCounts",      list,       [ 1235, 19279.4116 ],           False,  _pair       ),  # ADC readings ...
+    ( "adcVolts",       list,       [ 0.16, 2.41 ],                 False,  _pair       ),  # ... and their voltages
+    ( "sensorOffset",   float,      0.04,                           False,  None        ),  # V/Vs = offset + span*kPa
+    ( "sensorSpan",     float,      0.018,                          False,  _positive   ),
+
+    ( "emaAlpha",       float,      0.03,                           True,   _fraction   ),
+    ( "filterOnMmHg",   float,      180.0,                          True,   _positive   ),  # Filter marker
+    ( "filterOffMmHg",  float,      40.0,                           True,   _positive   ),  # Filter/mute release
+    ( "bandLow",        float,      75.0,                           True,   _positive   ),  # Simulation band
+    ( "bandHigh",       float,      125.0,                          True,   _positive   ),
+    ( "hysteresis",     float,      3.0,                            True,   lambda v: v >= 0 ),
+    ( "dwell",          float,      0.3,                            True,   lambda v: v >= 0 ),
+    ( "minInterval",    float,      0.5,                            True,   lambda v: v >= 0 ),
+    ( "logInterval",    float,      0.25,                           True,   _positive   ),  # Log file write period (sec)
+    ( "muteCommands",   bool,       False,                          True,   None        ),  # Firmware handles MUTE/UNMUTE
+    )
+
+NAMES   = tuple( entry[0] for entry in SCHEMA )
+HOT     = frozenset( entry[0] for entry in SCHEMA if entry[3] )
+DERIVED = ( "countsMin", "countsMax", "voltsMin", "voltsMax", "voltsPerCount", "kPaPerVolt", "kPaOffset",
+            "mmHgPerKPa", "emaKeep", "bands" )
+
+class ConfigError(ValueError):
+    pass
+
+# ================================================================================= #
+# Parameters
+# ================================================================================= #
+
+class Parameters(object):
+
+    __slots__ = NAMES + DERIVED
+
+    def __init__( self, values ):
+        '''
+        Immutable parameters from a validated dict of every SCHEMA name.
+        '''
+        init = lambda name, value: object.__setattr__( self, name, value )
+        for name in NAMES:
+            init( name, _frozen(values[name]) )
+
+        # Precompiled constants of the hot path
+        init( "countsMin",     float(self.adcCounts[0]) )
+        init( "countsMax",     float(self.adcCounts[1]) )
+        init( "voltsMin",      float(self.adcVolts[0]) )
+        init( "voltsMax",      float(self.adcVolts[1]) )
+        init( "voltsPerCount", (self.voltsMax - self.voltsMin)/(self.countsMax - self.countsMin) )
+        init( "kPaPerVolt",    1.0/(self.vSupply*self.sensorSpan) )
+        init( "kPaOffset",     -self.sensorOffset/self.sensorSpan )
+        init( "mmHgPerKPa",    760/101.3 )
+        init( "emaKeep",       1.0 - self.emaAlpha )
+        init( "bands",         ( ("korotkoff", self.bandLow, self.bandHigh), ) )  # For TriggerEngine
+
+    def __setattr__( self, name, value ):
+        raise AttributeError( "Parameters are read-only, change the configuration file" )
+
+# ------------------------------------------------------------------------
+
+    def pressure( self, counts ):
+        '''
+        Raw ADC reading to pressure, as numpy.interp over the calibration points
+        (clamped outside them) followed by the sensor transfer function.
+
+        OUTPUT:
+            - (kPa, mmHg)
+        '''
+        if( counts <= self.countsMin ):
+            volts = self.voltsMin
+        elif( counts >= self.countsMax ):
+            volts = self.voltsMax
+        else:
+            volts = self.voltsMin + ( counts - self.countsMin )*self.voltsPerCount
+        kPa = volts*self.kPaPerVolt + self.kPaOffset
+        return( kPa, kPa*self.mmHgPerKPa )
+
+    def asDict( self ):
+        return( dict((name, getattr(self, name)) for name in NAMES) )
+
+# ================================================================================= #
+# Validation
+# ================================================================================= #
+
+def validate( layers ):
+    '''
+    Merge and check configuration layers.
+
+    INPUTS:
+        - layers    : list of (source, dict), lowest priority first
+
+    OUTPUT:
+        - dict with every SCHEMA name (raises ConfigError listing every problem)
+    '''
+    values   = dict( (name, default) for name, _, default, _, _ in SCHEMA )
+    kinds    = dict( (name, (kind, check)) for name, kind, _, _, check in SCHEMA )
+    problems = []
+
+    for source, layer in layers:
+        for name, value in layer.items():
+            if( name not in kinds ):
+                problems.append( "%s: unknown parameter %r" %(source, name) )
+                continue
+            kind, check = kinds[name]
+            if( kind is float and isinstance(value, int) and not isinstance(value, bool) ):
+                value = float( value )                                      # 180 is fine for 180.0
+            if( (isinstance(value, bool) and kind is not bool) or not isinstance(value, kind) ):
+                problems.append( "%s: %s must be %s, not %r" %(source, name, getattr(kind, "__name__", "text"), value) )
+                continue
+            try:
+                ok = check is None or check( value )
+            except (TypeError, ValueError, AttributeError):
+                ok = False
+            if( not ok ):
+                problems.append( "%s: %s is out of range: %r" %(source, name, value) )
+                continue
+            values[name] = value
+
+    if( not values["bandLow"] < values["bandHigh"] ):
+        problems.append( "bandLow must be below bandHigh" )
+    if( not values["filterOffMmHg"] < values["filterOnMmHg"] ):
+        problems.append( "filterOffMmHg must be below filterOnMmHg" )
+    if( problems ):
+        raise ConfigError( "; ".join(problems) )
+    return( values )
+
+# ================================================================================= #
+# Panel Config
+# ================================================================================= #
+
+class PanelConfig(object):
+
+    def __init__( self, dataDir=None, panelId=None, overrides=None, checkInterval=1.0 ):
+        '''
+        Parameters of one panel (raises ConfigError if they are invalid).
+
+        INPUTS:
+            - dataDir       : Directory of panelConfig.json/panel<N>config.json (None: defaults only)
+            - panelId       : Panel whose override file is layered on top (None: none)
+            - overrides     : dict applied last, e.g. command line values (None entries are skipped)
+            - checkInterval : Period (sec) of the file check of watch()
+        '''
+
+        self.files          = []
+        if( dataDir is not None ):
+            self.files.append( os.path.join(dataDir, "panelConfig.json") )
+            if( panelId is not None ):
+                self.files.append( os.path.join(dataDir, "panel{}config.json".format(panelId)) )
+        self.overrides      = dict( (k, v) for k, v in (overrides or {}).items() if v is not None )
+        self.checkInterval  = checkInterval
+
+        self.listeners      = []                                            # fn(old, new) after a reload
+        self.signatures     = self._signatures()
+        self.current        = Parameters( validate(self._layers()) )
+        self.reloads        = 0
+        self.wake           = threading.Event()
+        self.running        = False
+
+# ------------------------------------------------------------------------
+
+    def reload( self ):
+        '''
+        Re-read the files and take over the hot parameters.
+
+        OUTPUT:
+            - True if new parameters were applied (invalid files keep the old ones)
+        '''
+        self.signatures = self._signatures()
+        try:
+            values = validate( self._layers() )
+        except (ConfigError, IOError, OSError) as instance:
+            print( fullStamp() + " Configuration not reloaded: " + str(instance) )
+            return( False )
+
+        old     = self.current
+        running = old.asDict()
+        cold    = [ name for name in NAMES if name not in HOT and _frozen(values[name]) != running[name] ]
+        for name in cold:
+            values[name] = getattr( old, name )                             # Until restart
+        if( cold ):
+            print( fullStamp() + " Restart to apply " + ", ".join(cold) )
+
+        changed = [ name for name in HOT if _frozen(values[name]) != running[name] ]
+        if( not changed ):
+            return( False )
+        self.current = Parameters( values )
+        self.reloads = self.reloads + 1
+        print( fullStamp() + " Configuration reloaded: " + ", ".join(sorted(changed)) )
+
+        for listener in self.listeners:
+            try:
+                listener( old, self.current )
+            except Exception as instance:
+                print( fullStamp() + " Configuration listener failed " + str(instance.args) )
+        return( True )
+
+# ------------------------------------------------------------------------
+
+    def watch( self ):
+        '''
+        Reload in the background whenever a configuration file changes.
+        '''
+        self.running = True
+        thread = threading.Thread( target=self._watch, name="panelConfig" )
+        thread.daemon = True
+        thread.start()
+        return( self )
+
+    def stop( self ):
+        self.running = False
+        self.wake.set()
+
+    def _watch( self ):
+        while( self.running ):
+            self.wake.wait( self.checkInterval )
+            if( self.running and self._signatures() != self.signatures ):
+                self.reload()
+
+# ------------------------------------------------------------------------
+
+    def _signatures( self ):
+        signatures = []
+        for fileName in self.files:
+            try:
+                info = os.stat( fileName )
+                signatures.append( (info.st_mtime, info.st_ino, info.st_size) )
+            except OSError:
+                signatures.append( None )
+        return( signatures )
+
+    def _layers( self ):
+        layers = []
+        for fileName in self.files:
+            if( not os.path.exists(fileName) ):
+                continue
+            with open( fileName, 'r' ) as configFile:
+                try:
+                    layer = json.load( configFile )
+                except ValueError as instance:
+                    raise ConfigError( "%s: %s" %(fileName, instance) )
+            if( not isinstance(layer, dict) ):
+                raise ConfigError( "%s: expected a JSON object" %fileName )
+            layers.append( (fileName, layer) )
+        layers.append( ("overrides", self.overrides) )
+        return( layers )
+
+# ------------------------------------------------------------------------
+
+def loadPanelConfig( dataDir=None, interface="eth0", overrides=None ):
+    '''
+    PanelConfig of the panel this runs on (identified by the MAC of interface
+    in panels.txt), from the data directory of definePaths() by default.
+    Missing files only leave the defaults in place.
+    '''
+    from configurationProtocol import definePaths                          # Paths stay defined there
+    from panelRegistry import PanelRegistry
+
+    if( dataDir is None ):
+        dataDir = definePaths()[-1]
+    panel = PanelRegistry( dataDir ).selfID( interface )
+    return( PanelConfig(dataDir, None if panel is None else panel.id, overrides) )
+
+# ================================================================================= #
+# Stand-alone
+# ================================================================================= #
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument( "dataDir", nargs="?", default=None, help="Directory of panelConfig.json" )
+    ap.add_argument( "--panel", default=None, help="Panel whose panel<N>config.json applies" )
+    args = vars( ap.parse_args() )
+
+    params = PanelConfig( args["dataDir"], args["panel"] ).current
+    for name, _, default, hot, _ in SCHEMA:
+        value = getattr( params, name )
+        print( "%-16s %-28r %s%s" %(name, value, "hot " if hot else "    ", "" if value == _frozen(default) else "(set)") )
@@ -0,0 +1,330 @@
+"""
+panelRegistry.py
+
+The following module keeps the panel and device lists (panels.txt and
+panel<N>devices.txt) in memory, indexed, and reloads a file only when it changed.
+
+configurationProtocol.panelSelfID and panelDeviceID used to open and scan their
+file on every call (never closing it), and crashed on split_line[1] when a line
+had too few fields. A TableFile loads its file once into a list of rows, reports
+lines it cannot use as Malformed instead of raising, and re-reads the file only
+when its mtime, inode or size differ from the last load; the stat itself is done
+at most once per checkInterval seconds, so a burst of lookups touches the disk
+once. A missing file loads as no rows and is reported as a Malformed entry
+(lineNumber 0, reason "missing file").
+
+A PanelRegistry sits on top of the files of one data directory and answers in
+O(1), through dictionaries rebuilt on reload:
+    panel(panelId), panelByMac(mac), devices(panelId), device(panelId, deviceId),
+    deviceByAddress(address) (across every panel) and selfID(interface).
+MAC and BT addresses are matched case-insensitively.
+
+The module-level `registry` caches TableFiles by path, for configurationProtocol.
+
+Stand-alone (fleet check of a data directory):
+    python panelRegistry.py /home/pi/pd3d/csec/repos/ControlSystem/Software/Python/consys/data
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  os, threading
+from    collections                 import  namedtuple
+from    timeStamp                   import  fullStamp, monotonic
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+Panel       = namedtuple( "Panel", ("id", "mac") )
+Device      = namedtuple( "Device", ("id", "name", "address", "panel") )
+Malformed   = namedtuple( "Malformed", ("fileName", "lineNumber", "line", "reason") )
+
+PANEL_COLUMNS   = 2                                                         # id,mac
+DEVICE_COLUMNS  = 3                                                         # id,name,bt address
+
+_macs       = {}                                                            # interface -> MAC, read once
+
+def macAddress( interface ):
+    '''
+    MAC address of a network interface from sysfs (cached, None if unknown).
+    '''
+    if( interface not in _macs ):
+        try:
+            with open( "/sys/class/net/" + interface + "/address" ) as f:
+                _macs[interface] = f.read().strip()
+        except (IOError, OSError):
+            return( None )                                                  # Not cached, may show up later
+    return( _macs[interface] )
+
+def deviceFileName( dataDir, panelId ):
+    return( "{}/panel{}devices.txt".format(dataDir, panelId) )
+
+# ================================================================================= #
+# Table File
+# ================================================================================= #
+
+class TableFile(object):
+
+    def __init__( self, fileName, columns, checkInterval=1.0 ):
+        '''
+        Comma separated file, reloaded when it changes.
+
+        INPUTS:
+            - fileName      : Path of the file
+            - columns       : Fields a line needs (extra ones are kept)
+            - checkInterval : Shortest time (sec) between two stat() calls
+        '''
+
+        self.fileName       = fileName
+        self.columns        = columns
+        self.checkInterval  = checkInterval
+
+        self.lock           = threading.Lock()
+        self.signature      = None                                          # (mtime, inode, size) loaded
+        self.checkedAt      = None
+        self.rows           = []                                            # list of field lists
+        self.malformed      = []
+        self.indexes        = {}                                            # (column, normalize) -> dict
+        self.loads          = 0
+        self.listeners      = []                                            # fn(tableFile) after a reload
+
+# ------------------------------------------------------------------------
+
+    def fresh( self ):
+        '''
+        OUTPUT:
+            - True if the file was (re)loaded by this call
+        '''
+        now = monotonic()
+        with self.lock:
+            if( self.checkedAt is not None and now - self.checkedAt < self.checkInterval ):
+                return( False )
+            self.checkedAt = now
+            try:
+                info = os.stat( self.fileName )
+                signature = ( info.st_mtime, info.st_ino, info.st_size )
+            except OSError:
+                signature = None                                            # Missing: no rows, one report
+            if( signature == self.signature and self.loads ):
+                return( False )
+            self._load( signature )
+
+        for listener in self.listeners:
+            listener( self )
+        return( True )
+
+    def invalidate( self ):
+        with self.lock:
+            self.checkedAt, self.signature = None, None
+
+# ------------------------------------------------------------------------
+
+    def _load( self, signature ):
+        rows, malformed = [], []
+        if( signature is None ):
+            malformed.append( Malformed(self.fileName, 0, "", "missing file") )   # Reported like a bad line
+        else:
+            with open( self.fileName, 'r' ) as dataFile:
+                for number, line in enumerate( dataFile, 1 ):
+                    text = line.rstrip( "\r\n" )
+                    if( not text.strip() or text.lstrip().startswith("#") ):   # Blank or comment
+                        continue
+                    fields = [ field.strip() for field in text.split(",") ]
+                    if( len(fields) < self.columns or not all(fields[:self.columns]) ):
+                        malformed.append( Malformed(self.fileName, number, text,
+                                                    "expected %d fields" %self.columns) )
+                        continue
+                    rows.append( fields )
+
+        for report in malformed:
+            print( fullStamp() + " %s:%d malformed (%s): %r" %(report.fileName, report.lineNumber,
+                                                               report.reason, report.line) )
+        self.rows, self.malformed, self.signature = rows, malformed, signature
+        self.indexes = {}
+        self.loads = self.loads + 1
+
+    def missing( self ):
+        '''
+        OUTPUT:
+            - True if the file did not exist at the last load
+        '''
+        return( self.loads > 0 and self.signature is None )
+
+# ------------------------------------------------------------------------
+
+    def index( self, column, normalize=None ):
+        '''
+        OUTPUT:
+            - dict of column value (passed through normalize) -> first row with it,
+              built once per load
+        '''
+        key = ( column, normalize )
+        with self.lock:
+            index = self.indexes.get( key )
+            if( index is None ):
+                index = self.indexes[key] = {}
+                for fields in self.rows:
+                    value = fields[column] if normalize is None else normalize( fields[column] )
+                    index.setdefault( value, fields )
+            return( index )
+
+# ================================================================================= #
+# Registry
+# ================================================================================= #
+
+class Registry(object):
+
+    def __init__( self, checkInterval=1.0 ):
+        '''
+        TableFiles by path, so every caller shares one load of each file.
+        '''
+        self.checkInterval  = checkInterval
+        self.lock           = threading.Lock()
+        self.files          = {}
+
+    def table( self, fileName, columns ):
+        fileName = os.path.abspath( fileName )
+        with self.lock:
+            table = self.files.get( fileName )
+            if( table is None ):
+                table = self.files[fileName] = TableFile( fileName, columns, self.checkInterval )
+        table.fresh()
+        return( table )
+
+registry = Registry()                                                       # Shared by configurationProtocol
+
+# ================================================================================= #
+# Panel Registry
+# ================================================================================= #
+
+class PanelRegistry(object):
+
+    def __init__( self, dataDir, checkInterval=1.0 ):
+        '''
+        Indexed view of panels.txt and every panel<N>devices.txt in dataDir.
+        '''
+
+        self.dataDir        = dataDir
+        self.checkInterval  = checkInterval
+        self.lock           = threading.Lock()
+
+        self.panelFile      = TableFile( os.path.join(dataDir, "panels.txt"), PANEL_COLUMNS, checkInterval )
+        self.panelFile.listeners.append( self._indexPanels )
+        self.deviceFiles    = {}                                            # panel id -> TableFile
+        self.checkedAt      = None
+
+        self.panels         = {}                                            # id -> Panel
+        self.panelsByMac    = {}                                            # lower-case mac -> Panel
+        self.devicesOf      = {}                                            # panel id -> list of Device
+        self.devicesById    = {}                                            # (panel id, device id) -> Device
+        self.devicesByAddr  = {}                                            # upper-case address -> Device
+        self.duplicates     = []                                            # Malformed for repeated keys
+        self.panelDuplicates = []
+
+# ------------------------------------------------------------------------
+
+    def panel( self, panelId ):
+        self._fresh()
+        return( self.panels.get(str(panelId)) )
+
+    def panelByMac( self, mac ):
+        self._fresh()
+        return( self.panelsByMac.get((mac or "").lower()) )
+
+    def selfID( self, interface="eth0" ):
+        '''
+        OUTPUT:
+            - Panel with the MAC of this machine's interface (None if not listed)
+        '''
+        return( self.panelByMac(macAddress(interface)) )
+
+    def devices( self, panelId ):
+        self._fresh()
+        return( list(self.devicesOf.get(str(panelId), ())) )
+
+    def device( self, panelId, deviceId ):
+        self._fresh()
+        return( self.devicesById.get((str(panelId), str(deviceId))) )
+
+    def deviceByAddress( self, address ):
+        self._fresh()
+        return( self.devicesByAddr.get((address or "").upper()) )
+
+    def malformed( self ):
+        '''
+        OUTPUT:
+            - Every line that could not be used, over all files (Malformed tuples)
+        '''
+        self._fresh()
+        reports = list( self.panelFile.malformed )
+        for table in self.deviceFiles.values():
+            reports.extend( table.malformed )
+        return( reports + self.duplicates )
+
+# ------------------------------------------------------------------------
+
+    def _fresh( self ):
+        now = monotonic()
+        if( self.checkedAt is not None and now - self.checkedAt < self.checkInterval ):
+            return                                                          # Indexes are recent enough
+        self.checkedAt = now
+        changed = self.panelFile.fresh()
+        for table in list( self.deviceFiles.values() ):
+            changed = table.fresh() or changed
+        if( changed ):
+            self._indexDevices()
+
+    def _indexPanels( self, table ):
+        panels, byMac, duplicates = {}, {}, []
+        for fields in table.rows:
+            panel = Panel( fields[0], fields[1] )
+            if( panel.id in panels or panel.mac.lower() in byMac ):
+                duplicates.append( Malformed(table.fileName, None, ",".join(fields), "duplicate panel") )
+                continue
+            panels[panel.id] = byMac[panel.mac.lower()] = panel
+
+        with self.lock:
+            self.panels, self.panelsByMac = panels, byMac
+            self.panelDuplicates = duplicates
+            for panelId in panels:                                          # Device files of new panels
+                if( panelId not in self.deviceFiles ):
+                    self.deviceFiles[panelId] = TableFile( deviceFileName(self.dataDir, panelId),
+                                                           DEVICE_COLUMNS, self.checkInterval )
+            for panelId in list( self.deviceFiles ):                        # ... and none of removed ones
+                if( panelId not in panels ):
+                    del self.deviceFiles[panelId]
+
+    def _indexDevices( self ):
+        devicesOf, byId, byAddr = {}, {}, {}
+        duplicates = list( self.panelDuplicates )
+        for panelId, table in self.deviceFiles.items():
+            devicesOf[panelId] = []
+            for fields in table.rows:
+                device = Device( fields[0], fields[1], fields[2], panelId )
+                if( (panelId, device.id) in byId or device.address.upper() in byAddr ):
+                    duplicates.append( Malformed(table.fileName, None, ",".join(fields), "duplicate device") )
+                    continue
+                devicesOf[panelId].append( device )
+                byId[(panelId, device.id)] = byAddr[device.address.upper()] = device
+
+        with self.lock:
+            self.devicesOf, self.devicesById, self.devicesByAddr = devicesOf, byId, byAddr
+            self.duplicates = duplicates
+
+# ================================================================================= #
+# Stand-alone
+# ================================================================================= #
+
+if __name__ == "__main__":
+    import sys
+
+    panels = PanelRegistry( sys.argv[1] if len(sys.argv) > 1 else "." )
+    panels._fresh()
+    for panelId in sorted( panels.panels ):
+        panel = panels.panels[panelId]
+        print( "PANEL%s %s : %d device(s)" %(panel.id, panel.mac, len(panels.devices(panel.id))) )
+    for report in panels.malformed():
+        print( "%s:%s %s: %r" %(report.fileName, report.lineNumber, report.reason, report.line) )
+    print( "This panel: %s" %(panels.selfID(),) )
@@ -0,0 +1,126 @@
+"""
+playbackStateMachine.py
+
+The following module decides when the stethoscope plays the Korotkoff sound.
+
+GUI_v3.1 used to wake every 0.5 sec to check proximity and pressure before
+blending, which adds up to half a second between the stethoscope reaching the
+cuff and the sound starting, and polls forever while idle. A
+PlaybackStateMachine is driven by change events instead: the pressure (dial),
+proximity, pitch and roll (MQTT) inputs call set() when their value changes, and
+the machine evaluates its condition on the caller's thread and submits
+startBlending/stopBlending only on a transition. Submitting never blocks (see
+stethoscopeDispatcher), so nothing waits on the link.
+
+Two latencies are recorded in latencyStats: "playbackTrigger" from the input
+change to the command being queued, and "playbackCommand" from the input change
+to the device's answer.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  threading
+import  stethoscopeDefinitions      as      definitions
+from    stethoscopeDispatcher       import  startBlendingCommand, stopBlendingCommand, ACK, NAK
+from    latencyStats                import  stats
+from    timeStamp                   import  fullStamp, monotonic
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+INPUTS  = ( "pressure", "proximity", "pitch", "roll" )                      # Boolean inputs, False until set
+
+# ================================================================================= #
+# Playback State Machine
+# ================================================================================= #
+
+class PlaybackStateMachine(object):
+
+    def __init__( self, submit=None, requires=("proximity", "pressure"), fileByte=definitions.KOROT,
+                  onChange=None ):
+        '''
+        Reactive start/stop of the stethoscope playback.
+
+        INPUTS:
+            - submit    : fn(command) -> CommandFuture, e.g. Link.submit (can be attached later)
+            - requires  : Inputs that must all be True for playback (INPUTS or
+                          extra ones, e.g. a sensorFusion condition)
+            - fileByte  : Audio file to blend
+            - onChange  : fn(playing) called on every transition
+        '''
+
+        self.submit         = submit
+        self.requires       = tuple( requires )
+        self.fileByte       = fileByte
+        self.onChange       = onChange
+
+        self.lock           = threading.Lock()
+        self.inputs         = dict( (name, False) for name in INPUTS + self.requires )
+        self.playing        = False                                         # Commanded state
+        self.transitions    = 0
+        self.lastFuture     = None
+
+# ------------------------------------------------------------------------
+
+    def attach( self, submit ):
+        '''
+        Start issuing commands through submit, catching up with the current inputs.
+        '''
+        with self.lock:
+            self.submit = submit
+            self._evaluate( monotonic() )
+
+# ------------------------------------------------------------------------
+
+    def set( self, name, value, at=None ):
+        '''
+        Input change event.
+
+        INPUTS:
+            - name      : One of INPUTS or requires
+            - value     : New state (anything truthy)
+            - at        : When the change was observed (monotonic sec), defaults to now
+
+        OUTPUT:
+            - True if this event started or stopped playback
+        '''
+        at = monotonic() if at is None else at
+        with self.lock:
+            if( self.inputs[name] == bool(value) ):
+                return( False )                                             # Not a change
+            self.inputs[name] = bool( value )
+            return( self._evaluate(at) )
+
+# ------------------------------------------------------------------------
+
+    def _evaluate( self, at ):
+        wanted = all( self.inputs[name] for name in self.requires )
+        if( wanted == self.playing or self.submit is None ):
+            return( False )
+
+        self.playing        = wanted
+        self.transitions    = self.transitions + 1
+        command             = startBlendingCommand( self.fileByte ) if wanted else stopBlendingCommand()
+        future              = self.submit( command )
+        stats.record( "playbackTrigger", monotonic() - at )
+        future.addCallback( lambda f: self._answered(f, at) )
+        self.lastFuture     = future
+
+        if( self.onChange is not None ):
+            try:
+                self.onChange( wanted )
+            except Exception as instance:
+                print( fullStamp() + " Playback handler failed " + str(instance.args) )
+        return( True )
+
+# ------------------------------------------------------------------------
+
+    def _answered( self, future, at ):
+        '''
+        Input-to-answer latency; superseded (COALESCED) or lost commands are only counted.
+        '''
+        answered = future.result in ( ACK, NAK )
+        stats.record( "playbackCommand", future.doneAt - at if answered else None, future.result )
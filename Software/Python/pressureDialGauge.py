@@ -31,7 +31,6 @@ import  Adafruit_ADS1x15
 import  numpy                           as      np                                  # Required for LobOdeh method
 from    PyQt4                           import  QtCore, QtGui, Qt                   # PyQt4 libraries required to render display
 from    PyQt4.Qwt5                      import  Qwt                                 # Same here, boo-boo!
-from    numpy                           import  interp                              # Required for mapping values
 from    threading                       import  Thread                              # Run functions in "parallel"
 from    os                              import  getcwd, path, makedirs              # Pathname manipulation for saving data output
 
@@ -41,6 +40,13 @@ from    timeStamp                       import fullStamp
 from    stethoscopeProtocol             import *			            # Import all functions from the stethoscope protocol
 from    bluetoothProtocol_teensy32      import *			            # Import all functions from the bluetooth protocol -teensy3.2
 import  stethoscopeDefinitions          as     definitions                          # Import stethoscope definitions
+from    dataRetention                   import RetentionManager                     # Rotation/retention of dataOutput/
+from    latencyStats                    import SnapshotWriter                       # Periodic stethoscope latency snapshots
+from    stethoscopeDispatcher           import startBlendingCommand, stopBlendingCommand, muteCommand, ACK
+from    latencyStats                    import stats as latencyStats
+from    connectionManager               import ConnectionManager                    # Background (re)connects + keepalives
+from    triggerEngine                   import TriggerEngine                        # Hysteresis/debounce for sim_mode
+from    panelConfig                     import loadPanelConfig                      # Validated, hot-reloadable parameters
 
 # ************************************************************************
 # CONSTRUCT ARGUMENT PARSER 
@@ -59,6 +65,18 @@ ap.add_argument( "-d", "--debug", action='store_true',
 ap.add_argument( "--directory", type=str, default='output',
                 help="Set directory" )
 
+ap.add_argument( "--hysteresis", type=float, default=None,
+                help="Margin (mmHg) needed to leave the simulation band.\nDefault: panelConfig" )
+
+ap.add_argument( "--dwell", type=float, default=None,
+                help="Time (in secs) a band change must hold before it triggers.\nDefault: panelConfig" )
+
+ap.add_argument( "--minInterval", type=float, default=None,
+                help="Minimum time (in secs) between two triggers.\nDefault: panelConfig" )
+
+ap.add_argument( "--config", type=str, default=None,
+                help="Directory of panelConfig.json (see panelConfig.py)" )
+
 args = vars( ap.parse_args() )
 
 ##args["debug"] = True
@@ -106,7 +124,7 @@ class MyWindow( QtGui.QMainWindow ):
         self.ui.Dial.setValue( 0 )
 
         # List all available BT devices
-        address = deviceBTAddress[0]
+        address = params.stethoscopes[0]
         self.ui.pushButtonPair.setEnabled( True )
         self.ui.pushButtonPair.setText( QtGui.QApplication.translate("MainWindow", "Click to Connect", None, QtGui.QApplication.UnicodeUTF8) )
         self.ui.pushButtonPair.clicked.connect( lambda: self.connectStethoscope(address) )
@@ -161,7 +179,7 @@ class MyWindow( QtGui.QMainWindow ):
         """
         
         available = []
-        BT_name, BT_address = findSmartDevice( deviceBTAddress[0] )
+        BT_name, BT_address = findSmartDevice( params.stethoscopes[0] )
         if( BT_name != 0 ):
             available.append( (BT_name[0], BT_address[0]) )
             return( available )
@@ -180,12 +198,12 @@ class MyWindow( QtGui.QMainWindow ):
             makedirs( self.dataFileDir )                                            # if it doesn't exist.
             print( fullStamp() + " Created data output folder" )                    # ...
 
-        with open( self.dataFileName, "w" ) as f:                                   # Write down info as ...
-            f.write( "Date/Time     :  {}\n".format(fullStamp())    )               # a header on the ...
-            f.write( "Scenario      : #{}\n".format(scenarioNumber) )               # output file.
-            f.write( "Device Name   :  {}\n".format(deviceName)     )               # ...
-            f.write( "seconds,    kPa , mmHg Actual, mmHg Simulated\n" )            # ...
-            f.close()                                                               # ...
+        header  = "Date/Time     :  {}\n".format(fullStamp())                       # Write down info as ...
+        header += "Scenario      : #{}\n".format(params.scenarioNumber)             # a header on the ...
+        header += "Device Name   :  {}\n".format(params.deviceName)                 # output file.
+        header += "seconds,    kPa , mmHg Actual, mmHg Simulated\n"                 # ...
+
+        self.log = retention.openLog( self.dataFileName, header )                   # Previous runs are rotated, not truncated
 
         print( fullStamp() + " Created data output .txt file\n" )                   # [INFO] Status
 
@@ -198,6 +216,7 @@ class MyWindow( QtGui.QMainWindow ):
         """
         
         print( fullStamp() + " Goodbye!" )
+        if( hasattr(self, "log") ): self.log.close()                                # Hand log over to housekeeping
         QtCore.QThread.sleep( 2 )                                                   # this delay may be essential
 
 # ************************************************************************
@@ -237,6 +256,11 @@ class Worker( QtCore.QThread ):
 
         # Stethoscope stuff
         self.mute       = False                                                     # Determine if we are muting sounds
+        self.trigger    = TriggerEngine( params.bands,                              # Simulation band (mmHg)
+                                         hysteresis=params.hysteresis,              # ...
+                                         minDwell=params.dwell,                     # ...
+                                         minInterval=params.minInterval )           # ...
+        config.listeners.append( self.retune )                                      # Hot parameters, no restart
         
         # Synthetic bump frequency
         self.bumpFreq = args["bumpFrequency"]                                       # Frequency at which to synthesize a pulse
@@ -261,14 +285,13 @@ class Worker( QtCore.QThread ):
         # Establish communication after a device is selected
         try:
 
-            self.rfObject = createBTPort( self.deviceBTAddress, port )              # Connect to stethoscope
-            print( "{} Opened {}".format(fullStamp(), self.deviceBTAddress) )       # [INFO] Update
+            self.links = ConnectionManager( [self.deviceBTAddress], params.port, discovery=discovery ).start()   # Connect in the background ...
+            self.link  = self.links.link( self.deviceBTAddress )                    # ... and keep the link warm
             
-            QtCore.QThread.sleep( 2 )                                               # Delay for stability
-
-            self.status = statusEnquiry( self.rfObject )                            # Send an enquiry byte
+            self.status = self.link.waitUp( 10 )                                    # Wait for the ENQ/ACK handshake
 
             if( self.status == True ):
+                print( "{} Opened {}".format(fullStamp(), self.deviceBTAddress) )   # [INFO] Update
                 # Update labels
                 self.owner.ui.pushButtonPair.setText(QtGui.QApplication.translate("MainWindow", "Paired", None, QtGui.QApplication.UnicodeUTF8))
             
@@ -276,9 +299,10 @@ class Worker( QtCore.QThread ):
             
             while( True ):                                                          # Loop 43va!
                 val = self.readPressure()                                           # Read pressure
+                p   = config.current                                                # ...
 
                 # Synthesize pulse if conditions are met
-                if( 75 <= val and val <= 125                                        # Check conditions 
+                if( p.bandLow <= val and val <= p.bandHigh                          # Check conditions 
                     and time.time() - self.bumpTrigger >= self.bumpFreq             # ...
                     and self.filterON ):                                            # ...
 
@@ -298,6 +322,17 @@ class Worker( QtCore.QThread ):
             print( fullStamp() + " Error Type " + str(type(instance)) )
             print( fullStamp() + " Error Arguments " + str(instance.args) )
 
+# ------------------------------------------------------------------------
+            
+    def retune( self, old, new ):
+        """
+        Take over reloaded parameters (called from the config watcher)
+        """
+        self.trigger.bands       = new.bands                                        # Simulation band (mmHg)
+        self.trigger.hysteresis  = new.hysteresis                                   # ...
+        self.trigger.minDwell    = new.dwell                                        # ...
+        self.trigger.minInterval = new.minInterval                                  # ...
+
 # ------------------------------------------------------------------------
             
     def readPressure( self ):
@@ -305,14 +340,14 @@ class Worker( QtCore.QThread ):
         Read pressure transducer and convert voltage into pressure readings
         """
         
+        p = config.current                                                          # One consistent set per pass
+
         # Compute pressure
-        V_analog        = ADC.read_adc( 0, gain=GAIN )                              # Convert analog readings to digital
-        V_digital       = interp( V_analog, [1235, 19279.4116], [0.16, 2.41] )      # Map the readings
-        self.P_Pscl     = ( V_digital/V_supply - 0.04 )/0.018                       # Convert voltage to SI pressure readings
-        self.P_mmHg_0   = self.P_Pscl*760/101.3                                     # Convert SI pressure to mmHg (0==original)
+        V_analog        = ADC.read_adc( 0, gain=p.adcGain )                         # Convert analog readings to digital
+        self.P_Pscl, self.P_mmHg_0 = p.pressure( V_analog )                         # Calibrated kPa and mmHg (0==original)
 
         # Criteria to turn ON  filter
-        if( self.P_mmHg_0 >= 180 and self.at_marker == False ):
+        if( self.P_mmHg_0 >= p.filterOnMmHg and self.at_marker == False ):
             self.filterON   = True                                                  # Flag filter to turn ON
             self.at_marker  = True                                                  # Flag that we hit the marker
 
@@ -320,23 +355,21 @@ class Worker( QtCore.QThread ):
                 print( "[INFO] Filter ON" )                                         # ...
 
         # Criteria to turn OFF filter
-        elif( self.P_mmHg <= 40 and self.at_marker and self.filterON ):
+        elif( self.P_mmHg <= p.filterOffMmHg and self.at_marker and self.filterON ):
             self.filterON   = False                                                 # Flag filter to turn OFF
             self.at_marker  = False                                                 # Reset marker flag                                                   
             self.initialRun = True                                                  # Store initial values at first run
 
-            # Send un-mute command from a separate thread
-##            Thread( target=FUNC, args=(self.rfObject, definitions.BYTE,) ).start()
-            self.mute       = False                                                 # Reset muting flag
+            # Queue un-mute command (latest state wins, never blocks sampling)
+            self.setMute( False )                                                   # Reset muting flag
 
             if( args["debug"] ):                                                    # [INFO] Status
                 print( "[INFO] Filter OFF" )                                        # ...
                 print( "[INFO] Muting OFF" )                                        # ...
 
-        elif( self.P_mmHg >= 40 and self.at_marker == False and self.mute == False ):
-            # Send mute command from a separate thread
-##            Thread( target=FUNC, args=(self.rfObject, definitions.BYTE,) ).start()
-            self.mute = True                                                        # Stethoscope is muting
+        elif( self.P_mmHg >= p.filterOffMmHg and self.at_marker == False and self.mute == False ):
+            # Queue mute command (latest state wins, never blocks sampling)
+            self.setMute( True )                                                    # Stethoscope is muting
 
             if( args["debug"] ):                                                    # [INFO] Status
                 print( "[INFO] muting ON" )                                         # ...
@@ -344,7 +377,7 @@ class Worker( QtCore.QThread ):
         # If filter is ON, apply it
         if( self.filterON ):
             self.t       = time.time() - self.startTime                             # [DEPRACATED] Used for LobOdeh
-            self.P_mmHg  = self.EMA(self.P_mmHg_0, ALPHA=0.03)                      # Apply EMA filter
+            self.P_mmHg  = self.EMA(self.P_mmHg_0, ALPHA=p.emaAlpha)                # Apply EMA filter
             self.sim_mode( self.P_mmHg )                                            # Trigger simulations mode
             
             return( self.P_mmHg )                                                   # Return simulated data in mmHg
@@ -353,6 +386,31 @@ class Worker( QtCore.QThread ):
 ##            self.sim_mode( self.P_mmHg_0 )                                          # Trigger simulations mode
             return( self.P_mmHg_0 )                                                 # Return real data in mmHg
 
+# ------------------------------------------------------------------------
+
+    def setMute( self, muted ):
+        """
+        Mute/un-mute the stethoscope without waiting for it.
+        If the state flips again before the command is sent, only
+        the final state goes over the link. Nothing is sent unless the
+        panel config enables muteCommands (firmware with MUTE/UNMUTE).
+        """
+
+        self.mute = muted                                                           # Flag flips right away
+        if( not config.current.muteCommands ):                                      # Opcodes unknown to the
+            return                                                                  # ... current firmware
+        future = self.link.submit( muteCommand(muted) )                             # Queue, never blocks
+        future.addCallback( self.muteDelivered )                                    # ...
+
+    def muteDelivered( self, future ):
+        """
+        Record the delivery latency (queueing + round trip) of mute commands.
+        Runs on the dispatcher thread.
+        """
+
+        if( future.result == ACK ):
+            latencyStats.record( "muteDelivery", future.delivery() )
+
 # ------------------------------------------------------------------------
 
     def sim_mode( self, P ):
@@ -360,35 +418,27 @@ class Worker( QtCore.QThread ):
         In charge of triggering simulations
         """
         
-        # Error handling (1)
-        try:
-            # Entering simulation pressure interval
-            if (P >= 75) and (P <= 125) and (self.playback == False):
-                self.normal = False                                                 # Turn OFF normal playback
-                self.playback = True                                                # Turn on simulation
+        if( not self.trigger.update(P) ):                                           # Debounced, rate capped
+            return
 
-                # Send start playback command from a separate thread
-                Thread( target=startBlending, args=(self.rfObject, definitions.KOROT,) ).start()
-                
-            # Leaving simulation pressure interval
-            elif ((P < 75) or (P > 125)) and (self.normal == False):
-                self.normal = True                                                  # Turn ON normal playback
-                self.playback = False                                               # Turn OFF simulation
+        # Entering simulation pressure interval
+        if( self.trigger.state == "korotkoff" ):
+            self.normal = False                                                     # Turn OFF normal playback
+            self.playback = True                                                    # Turn on simulation
 
-                # Send stop playback command from a separate thread
-                Thread( target=stopBlending, args=(self.rfObject,) ).start()
-                
-        # Error handling (2)        
-        except Exception as instance:
-            print( "" )                                                             # ...
-            print( fullStamp() + " Exception or Error Caught" )                     # ...
-            print( fullStamp() + " Error Type " + str(type(instance)) )             # Indicate the error
-            print( fullStamp() + " Error Arguments " + str(instance.args) )         # ...
+            # Queue start playback command (never blocks sampling)
+            self.link.submit( startBlendingCommand(definitions.KOROT) )
+            
+        # Leaving simulation pressure interval
+        else:
+            self.normal = True                                                      # Turn ON normal playback
+            self.playback = False                                                   # Turn OFF simulation
+
+            # Queue stop playback command (supersedes a start still in the queue)
+            self.link.submit( stopBlendingCommand() )
 
-            print( fullStamp() + " Closing/Reopening Ports..." )                    # ...
-            self.rfObject.close()                                                   # Reset BlueTooth
-            self.rfObject = createBTPort( self.deviceBTAddress, port )              # communications
-            print( fullStamp() + " Successful" )                                    # ...
+        if( args["debug"] ):                                                        # [INFO] update
+            print( "[INFO] Trigger {}".format(self.trigger.stats()) )               # ...
 
 # ------------------------------------------------------------------------
 
@@ -413,9 +463,7 @@ class Worker( QtCore.QThread ):
                                                                self.P_mmHg_0,       # ...
                                                                self.owner.pressureValue )
 
-            with open( self.owner.dataFileName, "a" ) as f:
-                f.write( dataStream )                                               # Write to file
-                f.close()                                                           # Close file
+            self.owner.log.write( dataStream )                                      # Write to file (rotates by size/age)
 
         except:
             pass
@@ -526,16 +574,16 @@ class Worker( QtCore.QThread ):
 # ************************************************************************
 # ===========================> SETUP PROGRAM <===========================
 # ************************************************************************
-port = 1                                                                            # Port number to use in communication
-deviceName = "ABPC"                                                                 # Designated device name
-deviceBTAddress = ["00:06:66:D0:E4:94", "00:06:66:8C:D3:F6", "00:06:66:86:77:09"]   # [ Dev.I (Moe), Dev.II (Moe), Lab Demos ]
-scenarioNumber = 1                                                                  # Device number
-
-V_supply = 3.3                                                                      # Supply voltage to the pressure sensor
+config = loadPanelConfig( args["config"],                                           # Panel parameters (see panelConfig.py)
+                          overrides={ "hysteresis"  : args["hysteresis"],           # Command line wins
+                                      "dwell"       : args["dwell"],                # ...
+                                      "minInterval" : args["minInterval"] } )       # ...
+params = config.current                                                             # Startup values (cold ones stay)
 
 ADC = Adafruit_ADS1x15.ADS1115()                                                    # Initialize ADC
-GAIN = 1                                                                            # Read values in the range of +/-4.096V
 
+retention = RetentionManager( getcwd() + "/dataOutput" )                            # Size/age rotation + disk budget for logs
+latency   = SnapshotWriter( getcwd() + "/dataOutput/latency.json" )                 # View with: python latencyStats.py
 
 # ************************************************************************
 # =========================> MAKE IT ALL HAPPEN <=========================
@@ -543,6 +591,9 @@ GAIN = 1
 
 if __name__ == "__main__":
     print( fullStamp() + " Booting DialGauge" )
+    retention.start()                                                               # Housekeeping runs in the background
+    latency.start()                                                                 # ...
+    config.watch()                                                                  # Retune on configuration changes
     app = QtGui.QApplication( sys.argv )
     MyApp = MyWindow()
     MyApp.show()
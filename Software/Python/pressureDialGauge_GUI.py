@@ -27,11 +27,10 @@
 # ************************************************************************
 
 # Python modules
-import  sys, time, bluetooth, serial, argparse                  # 'nuff said
+import  sys, time, bluetooth, serial, argparse, threading       # 'nuff said
 import  Adafruit_ADS1x15                                        # Required library for ADC converter
 from    PyQt4               import QtCore, QtGui, Qt            # PyQt4 libraries required to render display
 from    PyQt4.Qwt5          import Qwt                          # Same here, boo-boo!
-from    numpy               import interp                       # Required for mapping values
 from    threading           import Thread                       # Run functions in "parallel"
 from    os                  import getcwd, path, makedirs       # Pathname manipulation for saving data output
 
@@ -41,14 +40,22 @@ from    timeStamp                   import fullStamp            # Show date/time
 from    stethoscopeProtocol         import *			# import all functions from the stethoscope protocol
 from    bluetoothProtocol_teensy32  import *			# import all functions from the bluetooth protocol -teensy3.2
 import  stethoscopeDefinitions      as     definitions
+from    dataRetention               import RetentionManager     # Rotation/retention of dataOutput/
+from    triggerEngine               import TriggerEngine        # Hysteresis/debounce for sim_mode
+from    dialIPC                     import DialPublisher, DAEMON_SOCKET     # Structured updates to the launcher
+from    cuffDaemon                  import CuffDaemon           # Warm standby between sessions
+from    connectionManager           import ConnectionManager    # Stethoscope links kept up by the daemon
+from    stethoscopeDispatcher       import codecCommand         # ...
+from    timeStamp                   import monotonic            # Session startup timing
+from    panelConfig                 import loadPanelConfig      # Validated, hot-reloadable parameters
 
 # ************************************************************************
 # CONSTRUCT ARGUMENT PARSER 
 # ************************************************************************
 ap = argparse.ArgumentParser()
 
-ap.add_argument( "-f", "--frequency", type=int, default=0.25,
-                help="Set sampling frequency (in secs).\nDefault=1" )
+ap.add_argument( "-f", "--frequency", type=float, default=None,
+                help="Set sampling frequency (in secs).\nDefault: logInterval of panelConfig" )
 ap.add_argument( "-d", "--debug", action='store_true',
                 help="Invoke flag to enable debugging" )
 ap.add_argument( "--directory", type=str, default='output',
@@ -59,6 +66,22 @@ ap.add_argument( "--stethoscope", type=str, default="00:06:66:D0:E4:94",
                 help="Choose stethoscope" )
 ap.add_argument( "-m", "--mode", type=str, default="SIM",
                 help="Mode to operate under; SIM: Simulation || REC: Recording" )
+ap.add_argument( "--hysteresis", type=float, default=None,
+                help="Margin (mmHg) needed to leave the simulation band (overrides panelConfig)" )
+ap.add_argument( "--dwell", type=float, default=None,
+                help="Time (in secs) a band change must hold before it triggers (overrides panelConfig)" )
+ap.add_argument( "--minInterval", type=float, default=None,
+                help="Minimum time (in secs) between two triggers (overrides panelConfig)" )
+ap.add_argument( "--config", type=str, default=None,
+                help="Directory of panelConfig.json (see panelConfig.py)" )
+ap.add_argument( "--ipc", type=str, default=None,
+                help="Unix socket of the launcher (see dialIPC.py)" )
+ap.add_argument( "--daemon", action='store_true',
+                help="Stay up between sessions, launchers attach over --socket (see cuffDaemon.py)" )
+ap.add_argument( "--socket", type=str, default=DAEMON_SOCKET,
+                help="Control socket of the daemon" )
+ap.add_argument( "--links", action='store_true',
+                help="Daemon holds the stethoscope links (only for launchers that use them instead of their own)" )
 
 args = vars( ap.parse_args() )
 
@@ -113,6 +136,10 @@ class MyWindow(QtGui.QMainWindow):
 
         # Boolean to control recording function
         self.init_rec = True
+        self.log = None                                                 # Open while a session runs
+
+        # A daemon shows/hides the dial per session, from its session threads
+        QtCore.QObject.connect( self, QtCore.SIGNAL( "session(bool)" ), self.setVisible )
 
         # List all available BT devices
         self.ui.Dial.setEnabled( True )
@@ -124,8 +151,8 @@ class MyWindow(QtGui.QMainWindow):
         self.ctimer.start( 10 )
         QtCore.QObject.connect( self.ctimer, QtCore.SIGNAL( "timeout()" ), self.UpdateDisplay )
 
-        # Create logfile
-        self.setup_log()
+        # Create logfile (per session for a daemon)
+        if( not args["daemon"] ): self.setup_log()
 
 # ------------------------------------------------------------------------
 
@@ -184,14 +211,17 @@ class MyWindow(QtGui.QMainWindow):
             print( fullStamp() + " Created data output folder" )
 
         # Write basic information to the header of the data output file
-        with open( self.dataFileName, "w" ) as f:
-            f.write( "Date/Time: " + fullStamp() + "\n" )
-            f.write( "Scenario: #" + str(scenarioNumber) + "\n" )
-            f.write( "Device Name: " + deviceName + "\n" )
-            f.write( "Stethoscope ID: " + self.address + "\n" )
-            f.write( "Units: seconds, kPa, mmHg" + "\n" )
-            f.close()
-            print( fullStamp() + " Created data output .txt file" )
+        # (a previous run under the same name is rotated, not truncated)
+        header  = "Date/Time: " + fullStamp() + "\n"
+        header += "Scenario: #" + str(params.scenarioNumber) + "\n"
+        header += "Device Name: " + params.deviceName + "\n"
+        header += "Stethoscope ID: " + self.address + "\n"
+        header += "Units: seconds, kPa, mmHg" + "\n"
+        log = retention.openLog( self.dataFileName, header )
+        with self.thread.lock:
+            old, self.log = self.log, log                               # Worker writes to the new one next
+        if( old is not None ): old.close()
+        print( fullStamp() + " Created data output .txt file" )
 
 # ------------------------------------------------------------------------
 
@@ -201,9 +231,64 @@ class MyWindow(QtGui.QMainWindow):
         Stops recording and closes communication with device
         """
         
+        if( args["daemon"] ):                                   # Only the session ends
+            daemon.end( "dial closed" )                         # ...
+            return                                              # ...
+
         print( fullStamp() + " Goodbye!" )
+        self.log.close()                                        # Hand log over to housekeeping
+        if( self.thread.ipc ): self.thread.ipc.close()          # Launcher sees EOF
         QtCore.QThread.sleep( 2 )                               # this delay may be essential
 
+# ------------------------------------------------------------------------
+
+    def closeEvent( self, event ):
+        """
+        Closing the window of a daemon ends the session and hides the dial.
+        """
+        if( args["daemon"] ): daemon.end( "dial closed" )
+        event.accept()
+
+# ------------------------------------------------------------------------
+
+    def attach( self, options, publisher ):
+        """
+        Start a session on the warm dial (called by cuffDaemon).
+        Options are the dial's command line options; returns the step durations.
+        """
+        steps, t = {}, monotonic()
+
+        self.directory   = options.get( "directory", args["directory"] )
+        self.destination = options.get( "destination", args["destination"] )
+        self.address     = options.get( "stethoscope", args["stethoscope"] )
+        self.mode        = options.get( "mode", args["mode"] )
+        self.init_rec    = True
+        self.setup_log()                                                            # Log of this session
+        steps["log"], t  = monotonic() - t, monotonic()
+
+        link = links.links.get( self.address ) if links is not None else None       # Warm link, if we hold it
+        if( link is not None and not link.waitUp(10) ):
+            publisher.event( "Stethoscope %s is not up" %self.address )
+        steps["link"], t = monotonic() - t, monotonic()
+
+        self.thread.begin( publisher, link )                                        # Worker goes live ...
+        self.thread.firstSample.wait( 1.0 )                                         # ... with the next reading
+        steps["firstSample"] = monotonic() - t
+
+        self.emit( QtCore.SIGNAL("session(bool)"), True )                          # Show the dial
+        return( steps )
+
+    def detach( self, reason ):
+        """
+        End the session (called by cuffDaemon); the dial keeps sampling.
+        """
+        self.thread.end()
+        with self.thread.lock:
+            log, self.log = self.log, None
+        if( log is not None ): log.close()                                          # Hand log over to housekeeping
+        self.emit( QtCore.SIGNAL("session(bool)"), False )                         # Hide the dial
+        print( fullStamp() + " Session ended (" + reason + ")" )
+
 
 # ************************************************************************
 # CLASS FOR OPTIONAL INDEPENDENT THREAD
@@ -215,17 +300,45 @@ class Worker( QtCore.QThread ):
     normal = True
     playback = False
     
-    # Define sasmpling frequency (units: sec) controls writing frequency
-    wFreq = args["frequency"]
+    # Writing frequency (units: sec) is params.logInterval
     wFreqTrigger = time.time()
     
     def __init__( self, parent = None ):
         QtCore.QThread.__init__( self, parent )
         # self.exiting = False # not sure what this line is for
         print( fullStamp() + " Initializing Worker Thread" )
+        self.trigger = TriggerEngine( params.bands, params.hysteresis,
+                                      params.dwell, params.minInterval )
+        config.listeners.append( self.retune )                                    # Hot parameters, no restart
         self.owner = parent
+        self.ipc = DialPublisher( args["ipc"] ) if args["ipc"] else None         # Launcher updates (if any)
+        self.link = None                                                          # Warm link of a daemon session
+        self.lock = threading.Lock()                                              # Session handover (log, ipc)
+        self.live = not args["daemon"]                                            # A daemon idles between sessions
+        self.firstSample = threading.Event()
         self.start()
 
+# ------------------------------------------------------------------------
+
+    def begin( self, publisher, link ):
+        """
+        Go live for a daemon session.
+        """
+        with self.lock:
+            self.trigger = TriggerEngine( config.current.bands, config.current.hysteresis,
+                                          config.current.dwell, config.current.minInterval )
+            self.normal, self.playback = True, False
+            self.startTime = time.time()
+            self.wFreqTrigger = 0                                                 # Log the first reading
+            self.ipc, self.link = publisher, link
+            self.firstSample.clear()
+            self.live = True
+
+    def end( self ):
+        with self.lock:
+            self.live = False
+            self.ipc, self.link = None, None
+
 # ------------------------------------------------------------------------
 
     def __del__(self):
@@ -250,35 +363,57 @@ class Worker( QtCore.QThread ):
             print( fullStamp() + " Exception or Error Caught" )                     # ...
             print( fullStamp() + " Error Type " + str(type(instance)) )             # ...
             print( fullStamp() + " Error Arguments " + str(instance.args) )         # ...
+            if( self.ipc ): self.ipc.event( "Worker stopped: " + str(instance.args) )
+
+# ------------------------------------------------------------------------
+
+    def retune( self, old, new ):
+        """
+        Take over reloaded parameters (called from the config watcher)
+        """
+        self.trigger.bands       = new.bands                                        # Simulation band (mmHg)
+        self.trigger.hysteresis  = new.hysteresis                                   # ...
+        self.trigger.minDwell    = new.dwell                                        # ...
+        self.trigger.minInterval = new.minInterval                                  # ...
 
 # ------------------------------------------------------------------------
 
     def readPressure(self):
 
+        p = config.current                                                          # One consistent set per pass
+
         # Compute pressure
-        V_analog  = ADC.read_adc( 0, gain=GAIN )                                    # Convert analog readings to digital
-        V_digital = interp( V_analog, [1235, 19279.4116], [0.16, 2.41] )            # Map the readings
-        P_Pscl  = ( V_digital/V_supply - 0.04 )/0.018                               # Convert voltage to SI pressure readings
-        P_mmHg = P_Pscl*760/101.3                                                   # Convert SI pressure to mmHg
+        V_analog  = ADC.read_adc( 0, gain=p.adcGain )                               # Convert analog readings to digital
+        P_Pscl, P_mmHg = p.pressure( V_analog )                                     # Calibrated kPa and mmHg
+        if( not self.live ): return( P_mmHg )                                       # Daemon between sessions: dial only
+
+        with self.lock:                                                             # Session may end meanwhile
+            if( self.live ): self.readingLive( p, P_Pscl, P_mmHg )
+        self.firstSample.set()
+        return( P_mmHg )                                                            # Return pressure readings in mmHg
+
+# ------------------------------------------------------------------------
+
+    def readingLive( self, p, P_Pscl, P_mmHg ):
+        """
+        Publish, log and act on one reading of a session.
+        """
+        if( self.ipc ): self.ipc.sample( time.time()-self.startTime, P_mmHg )      # Every reading, to the launcher
         
         # Check if we should write to file or not yet
-        if( time.time() - self.wFreqTrigger ) >= self.wFreq:
+        if( time.time() - self.wFreqTrigger ) >= p.logInterval:
             
             self.wFreqTrigger = time.time()                                         # Reset wFreqTrigger
 
-            print( "SIM %r" %(self.playback) )                                      # Print to STDOUT
+            if( not self.ipc ): print( "SIM %r" %(self.playback) )                  # Print to STDOUT (no launcher)
             
             # Write to file
             dataStream = "%.02f, %.2f, %.2f\n" %( time.time()-self.startTime,       # Format readings
                                                   P_Pscl, P_mmHg )                  # into desired form
-            with open( self.owner.dataFileName, "a" ) as f:
-                f.write( dataStream )                                               # Write to file
-                f.close()                                                           # Close file
+            if( self.owner.log ): self.owner.log.write( dataStream )                # Write to file (rotates by size/age)
 
         if( self.owner.mode == "SIM" ): self.sim_mode( P_mmHg )                     # Trigger simulations mode (if --mode SIM)
         else: self.rec_mode()                                                       # Trigger recording   mode (if --mide REC)
-        
-        return( P_mmHg )                                                            # Return pressure readings in mmHg
 
 # ------------------------------------------------------------------------
 
@@ -289,16 +424,22 @@ class Worker( QtCore.QThread ):
         
         # Error handling (1)
         try:
+            # Band changes are debounced and rate capped
+            if( not self.trigger.update(P) ):
+                return
+
             # Entering simulation pressure interval
-            if (P >= 75) and (P <= 125) and (self.playback == False):
+            if( self.trigger.state == "korotkoff" ):
                 self.normal = False                                                 # Turn OFF normal playback
                 self.playback = True                                                # Turn on simulation
 
             # Leaving simulation pressure interval
-            elif ((P < 75) or (P > 125)) and (self.normal == False):
+            else:
                 self.normal = True                                                  # Turn ON normal playback
                 self.playback = False                                               # Turn OFF simulation
 
+            if( self.ipc ): self.ipc.state( self.playback, self.normal )            # Push the transition at once
+
         # Error handling (2)        
         except Exception as instance:
             print( "" )                                                             # ...
@@ -315,7 +456,10 @@ class Worker( QtCore.QThread ):
         
         if( self.owner.init_rec == True ):
             self.owner.init_rec = False
-            startCustomRecording( self.rfObject, self.owner.destination )           # If all is good, start recording
+            if( self.link is not None ):                                            # Daemon: warm link, never blocks
+                self.link.submit( codecCommand("startCustomRecording", self.owner.destination) )
+            else: startCustomRecording( self.rfObject, self.owner.destination )     # If all is good, start recording
+            if( self.ipc ): self.ipc.event( "Recording " + self.owner.destination )
 
         else: pass
             
@@ -323,25 +467,40 @@ class Worker( QtCore.QThread ):
 # ************************************************************************
 # ===========================> SETUP PROGRAM <===========================
 # ************************************************************************
-port = 1                                                                            # Port number to use in communication
-deviceName = "ABPC"                                                                 # Designated device name
-scenarioNumber = 1                                                                  # Device number
-
-V_supply = 3.3                                                                      # Supply voltage to the pressure sensor
+config = loadPanelConfig( args["config"],                                           # Panel parameters (see panelConfig.py)
+                          overrides={ "logInterval" : args["frequency"],            # Command line wins
+                                      "hysteresis"  : args["hysteresis"],           # ...
+                                      "dwell"       : args["dwell"],                # ...
+                                      "minInterval" : args["minInterval"] } )       # ...
+params = config.current                                                             # Startup values (cold ones stay)
 
 ADC = Adafruit_ADS1x15.ADS1115()                                                    # Initialize ADC
-GAIN = 1                                                                            # Read values in the range of +/-4.096V
+
+retention = RetentionManager( getcwd() + "/dataOutput" )                            # Size/age rotation + disk budget for logs
+
+links  = None                                                                       # Stethoscope links (daemon)
+daemon = None                                                                       # Control socket (daemon)
 
 # ************************************************************************
 # =========================> MAKE IT ALL HAPPEN <=========================
 # ************************************************************************
 
 def main():
+    global links, daemon
     
     print( fullStamp() + " Booting DialGauge" )
+    retention.start()                                                               # Housekeeping runs in the background
+    config.watch()                                                                  # Retune on configuration changes
     app = QtGui.QApplication(sys.argv)
     MyApp = MyWindow()
-    MyApp.show()
+
+    if( args["daemon"] ):                                                           # Warm standby (launchOnBoot.sh)
+        if( args["links"] ):
+            links = ConnectionManager( params.stethoscopes, params.port, discovery=discovery ).start()   # Keep every link up
+        daemon = CuffDaemon( MyApp, args["socket"] ).start()                        # Sessions attach here
+        app.setQuitOnLastWindowClosed( False )                                      # Hidden between sessions
+    else: MyApp.show()
+    
     sys.exit(app.exec_())
     
 if __name__ == "__main__":
@@ -0,0 +1,322 @@
+"""
+rfFraming.py
+
+The following module implements the optional framed mode of the stethoscope link.
+
+Legacy mode sends bare command bytes and reads bare responses, so a response can
+not be matched to its request, corruption goes unnoticed and a free-form string
+(STARTCREC, PSTRING) only ends when the link goes quiet. In framed mode every
+command and every response travels as
+
+    SOH | LEN (u16) | SEQ (u8) | BODY | CRC16 (u16)          big-endian
+
+where BODY is exactly what legacy mode would send (command code + payload) or
+answer (ACK/NAK or data), LEN counts SEQ + BODY, and the CRC16-CCITT covers LEN,
+SEQ and BODY. Responses carry the sequence number of their command, so commands
+can be pipelined, and a FrameReader parses whole frames out of large recv()
+chunks (resynchronizing on the next SOH after corruption).
+
+Framing is negotiated right after connecting: the client sends SOH 'F' <version>
+and a framing-capable device echoes it. Anything else (legacy firmware NAKs the
+unknown bytes or stays silent) leaves the link in legacy byte mode.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  socket, struct
+import  protocolDefinitions         as      dcDefinitions
+from    stethoscopeCodec            import  codec, toBytes
+from    timeStamp                   import  fullStamp, monotonic
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+VERSION     = 1
+SOH_BYTE    = toBytes( dcDefinitions.SOH )
+NEGOTIATE   = SOH_BYTE + b"F" + struct.pack( ">B", VERSION )               # Echoed by framing-capable firmware
+MAX_BODY    = 1024                                                          # Larger LEN values are treated as corruption
+HEADER      = 4                                                             # SOH + LEN + SEQ
+OVERHEAD    = HEADER + 2                                                    # ... + CRC
+
+for _i in range( len(NEGOTIATE) ):                                          # Legacy firmware must not act on these
+    if( codec.decodeCommand(NEGOTIATE[_i:_i+1])[0] is not None ):
+        raise ValueError( "Negotiation byte %r is a command code" %NEGOTIATE[_i:_i+1] )
+
+def _crcTable():
+    table = []
+    for byte in range( 256 ):
+        crc = byte << 8
+        for _ in range( 8 ):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append( crc & 0xFFFF )
+    return( table )
+
+CRC_TABLE = _crcTable()
+
+def crc16( data, crc=0xFFFF ):
+    """
+    CRC16-CCITT (poly 0x1021, init 0xFFFF), table driven.
+    """
+    table = CRC_TABLE
+    for byte in bytearray( data ):
+        crc = ((crc << 8) & 0xFFFF) ^ table[((crc >> 8) ^ byte) & 0xFF]
+    return( crc )
+
+def encodeFrame( seq, body ):
+    """
+    Build one frame around a body (command or response bytes).
+    """
+    body    = toBytes( body )
+    inner   = struct.pack( ">HB", len(body) + 1, seq & 0xFF ) + body
+    return( SOH_BYTE + inner + struct.pack(">H", crc16(inner)) )
+
+# ================================================================================= #
+# Frame Reader
+# ================================================================================= #
+
+class FrameReader(object):
+
+    def __init__( self, maxBody=MAX_BODY ):
+        '''
+        Incremental frame parser: feed() it recv() chunks, take frames with next().
+        '''
+        self.buffer     = bytearray()
+        self.maxBody    = maxBody
+        self.stats      = { "frames": 0, "crcErrors": 0, "skipped": 0 }
+
+    def feed( self, data ):
+        self.buffer.extend( bytearray(data) )
+
+    def next( self ):
+        '''
+        OUTPUT:
+            - (seq, body) of the next complete, valid frame ; None if there is none yet
+        '''
+
+        buffer = self.buffer
+        while( True ):
+            start = buffer.find( SOH_BYTE )
+            if( start < 0 ):
+                self.stats["skipped"] += len( buffer )                     # Nothing that can start a frame
+                del buffer[:]
+                return( None )
+            if( start > 0 ):
+                self.stats["skipped"] += start
+                del buffer[:start]
+
+            if( len(buffer) < HEADER ):
+                return( None )
+            length, seq = struct.unpack( ">HB", bytes(buffer[1:HEADER]) )
+            if( length < 1 or length - 1 > self.maxBody ):
+                self.stats["skipped"] += 1                                  # Bogus length: resync on next SOH
+                del buffer[:1]
+                continue
+
+            total = 1 + 2 + length + 2
+            if( len(buffer) < total ):
+                return( None )
+
+            inner = bytes( buffer[1:total-2] )
+            crc,  = struct.unpack( ">H", bytes(buffer[total-2:total]) )
+            if( crc16(inner) != crc ):
+                self.stats["crcErrors"] += 1                                # Corrupted: resync on next SOH
+                del buffer[:1]
+                continue
+
+            del buffer[:total]
+            self.stats["frames"] += 1
+            return( seq, inner[3:] )
+
+# ================================================================================= #
+# Framed Transport
+# ================================================================================= #
+
+class FramedTransport(object):
+
+    def __init__( self, sock, version=VERSION ):
+        '''
+        Framed request/response over a connected socket.
+
+        INPUTS:
+            - sock      : Connected socket, already negotiated to framed mode
+            - version   : Negotiated framing version
+        '''
+        self.sock       = sock
+        self.version    = version
+        self.reader     = FrameReader()
+        self.seq        = 0
+        self.early      = {}                                                # seq -> body received before asked for
+        self.outstanding = set()                                            # seqs whose response is still wanted
+        self.stats      = { "sent": 0, "recvCalls": 0, "stale": 0 }
+
+    def close( self ):
+        self.sock.close()
+
+    def fileno( self ):
+        return( self.sock.fileno() )
+
+# ------------------------------------------------------------------------
+
+    def sendMany( self, bodies ):
+        '''
+        Send several commands in a single write.
+
+        OUTPUT:
+            - list of their sequence numbers
+        '''
+        seqs, out = [], b""
+        for body in bodies:
+            self.seq = ( self.seq + 1 ) & 0xFF
+            self.early.pop( self.seq, None )                                # Never hand out a reply to an older use
+            self.outstanding.add( self.seq )
+            seqs.append( self.seq )
+            out = out + encodeFrame( self.seq, body )
+        self.sock.sendall( out )
+        self.stats["sent"] += len( seqs )
+        return( seqs )
+
+    def send( self, body ):
+        return( self.sendMany([body])[0] )
+
+# ------------------------------------------------------------------------
+
+    def receive( self, seq, timeout ):
+        '''
+        Wait for the response frame of a command.
+
+        OUTPUT:
+            - Response body ; raises socket.timeout, or IOError if the link closed
+        '''
+
+        try:
+            return( self.receiveAny([seq], timeout)[1] )
+        except socket.timeout:
+            self.outstanding.discard( seq )                                 # Its late reply is dropped
+            raise
+
+    def receiveAny( self, seqs, timeout ):
+        '''
+        Wait for the response of whichever of several commands comes first
+        (the others stay outstanding, even on a timeout).
+
+        OUTPUT:
+            - (seq, body) ; raises socket.timeout, or IOError if the link closed
+        '''
+
+        deadline = monotonic() + timeout
+        while( True ):
+            for seq in seqs:
+                if( seq in self.early ):
+                    body = self.early.pop( seq )
+                    self.outstanding.discard( seq )
+                    if( len(self.early) > 128 ):                            # Answers nobody waits for anymore
+                        self.stats["stale"] += len( self.early )
+                        self.early.clear()
+                    return( (seq, body) )
+
+            frame = self.reader.next()
+            if( frame is not None ):
+                if( frame[0] in self.outstanding ):
+                    self.early[ frame[0] ] = frame[1]
+                else:
+                    self.stats["stale"] += 1                                # Late reply to a timed out command
+                continue
+
+            remaining = deadline - monotonic()
+            if( remaining <= 0 ):
+                raise socket.timeout( "timed out" )
+            self.sock.settimeout( remaining )
+            data = self.sock.recv( 4096 )                                   # Whole chunks, not recv(1)
+            self.stats["recvCalls"] += 1
+            if( not data ):
+                raise IOError( "Connection closed by device" )
+            self.reader.feed( data )
+
+    def cancel( self, seqs ):
+        '''
+        Stop waiting for these commands; their replies are dropped if they come.
+        '''
+        for seq in seqs:
+            self.outstanding.discard( seq )
+            self.early.pop( seq, None )
+
+# ------------------------------------------------------------------------
+
+    def exchange( self, outBytes, nResponse, timeout ):
+        '''
+        One command, one response (used by CommandDispatcher and stethoscopeProtocol).
+        nResponse is implied by the frame.
+        '''
+        return( self.receive(self.send(outBytes), timeout) )
+
+# ------------------------------------------------------------------------
+
+    def pipeline( self, bodies, timeout ):
+        '''
+        Send several commands at once and collect their responses.
+
+        OUTPUT:
+            - list of response bodies (None for those that did not arrive in time)
+        '''
+
+        seqs     = self.sendMany( bodies )
+        deadline = monotonic() + timeout
+        out      = []
+        for seq in seqs:
+            try:
+                out.append( self.receive(seq, max(0, deadline - monotonic())) )
+            except socket.timeout:
+                out.append( None )
+        return( out )
+
+# ================================================================================= #
+# Negotiation
+# ================================================================================= #
+
+def negotiate( sock, timeout=0.5, quiet=0.1 ):
+    '''
+    Offer framed mode to the device.
+
+    INPUTS:
+        - sock      : Freshly connected socket
+        - timeout   : How long to wait for the echo (sec)
+        - quiet     : Silence (sec) that ends the answers of legacy firmware
+
+    OUTPUT:
+        - FramedTransport if the device accepted, else the socket itself (legacy mode)
+    '''
+
+    sock.sendall( NEGOTIATE )
+    answer   = b""
+    deadline = monotonic() + timeout
+    try:
+        while( len(answer) < len(NEGOTIATE) and monotonic() < deadline ):
+            sock.settimeout( max(0.001, deadline - monotonic()) )
+            data = sock.recv( len(NEGOTIATE) - len(answer) )
+            if( not data ):
+                raise IOError( "Connection closed by device" )
+            answer = answer + toBytes( data )
+    except socket.timeout:
+        pass
+    except Exception as instance:
+        if( "timed out" not in str(instance) ):                             # PyBluez reports timeouts as BluetoothError
+            raise
+
+    if( answer == NEGOTIATE ):
+        print( fullStamp() + " Framed mode v%d" %VERSION )
+        return( FramedTransport(sock) )
+
+    _drain( sock, quiet )                                                   # NAKs of legacy firmware
+    print( fullStamp() + " Device does not support framing, using legacy mode" )
+    return( sock )
+
+def _drain( sock, quiet ):
+    try:
+        sock.settimeout( quiet )
+        while( sock.recv(64) ):
+            pass
+    except Exception:
+        pass
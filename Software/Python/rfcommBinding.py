@@ -0,0 +1,252 @@
+"""
+rfcommBinding.py
+
+The following module binds stethoscopes to /dev/rfcommN serial ports in-process.
+
+The PySerial path used to run "sudo rfcomm release" and "sudo rfcomm bind" on
+every connection attempt (a fork, an exec and a sudo each) and then sleep for a
+second. An RfcommBinder talks to the kernel's RFCOMM TTY layer directly through
+the same ioctls the rfcomm tool uses (RFCOMMCREATEDEV, RFCOMMRELEASEDEV,
+RFCOMMGETDEVINFO). A binding it made, or found already in place for the same
+address and channel, is reused on every reconnect instead of being torn down.
+
+openSerialPort() opens the bound port and polls ENQ until the device ACKs,
+retrying a bounded number of times with backoff. Bind and connect times are
+recorded in latencyStats ("rfcommBind", "serialConnect"), so a reconnect costs
+the link's own latency instead of seconds.
+
+The ioctls need CAP_NET_ADMIN. Without it the binder falls back to the rfcomm
+tool, once per port, and still caches the binding.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  errno, fcntl, os, socket, struct, subprocess, time
+import  protocolDefinitions         as      definitions
+from    stethoscopeCodec            import  toBytes, ACK_BYTE, NAK_BYTE
+from    timeStamp                   import  fullStamp, monotonic
+from    latencyStats                import  stats
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+AF_BLUETOOTH    = getattr( socket, "AF_BLUETOOTH", 31 )
+BTPROTO_RFCOMM  = getattr( socket, "BTPROTO_RFCOMM", 3 )
+
+def _ioc( direction, number, size=4 ):                                      # <asm-generic/ioctl.h>, type 'R'
+    return( (direction << 30) | (size << 16) | (ord("R") << 8) | number )
+
+RFCOMMCREATEDEV     = _ioc( 1, 200 )                                        # _IOW('R', 200, int)
+RFCOMMRELEASEDEV    = _ioc( 1, 201 )                                        # _IOW('R', 201, int)
+RFCOMMGETDEVINFO    = _ioc( 2, 211 )                                        # _IOR('R', 211, int)
+
+DEV_REQ     = struct.Struct( "=h2xI6s6sB3x" )                               # struct rfcomm_dev_req  (24 bytes)
+DEV_INFO    = struct.Struct( "=h2xIH6s6sB1x" )                              # struct rfcomm_dev_info (24 bytes)
+
+def packAddress( address ):
+    """
+    "00:06:66:86:60:3D" -> bdaddr_t (little-endian bytes)
+    """
+    return( struct.pack("6B", *[int(b, 16) for b in reversed(address.split(":"))]) )
+
+def unpackAddress( data ):
+    return( ":".join("%02X" %b for b in reversed(bytearray(data))) )
+
+def devicePath( portNumber ):
+    return( "/dev/rfcomm%d" %portNumber )
+
+class BindingError(Exception):
+    """
+    The kernel refused to bind or release a port.
+    """
+    pass
+
+# ================================================================================= #
+# RFCOMM Binder
+# ================================================================================= #
+
+class RfcommBinder(object):
+
+    def __init__( self, fallback=True ):
+        '''
+        Create, look up and release RFCOMM TTY bindings.
+
+        INPUTS:
+            - fallback  : Use "sudo rfcomm" when the ioctls are not permitted
+        '''
+        self.fallback   = fallback
+        self.control    = None                                              # Raw RFCOMM socket for the ioctls
+        self.bound      = {}                                                # portNumber -> (address, channel)
+
+    def close( self ):
+        if( self.control is not None ):
+            self.control.close()
+            self.control = None
+
+# ------------------------------------------------------------------------
+
+    def _ioctl( self, request, data ):
+        if( self.control is None ):
+            self.control = socket.socket( AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_RFCOMM )
+        return( fcntl.ioctl(self.control.fileno(), request, data) )
+
+# ------------------------------------------------------------------------
+
+    def info( self, portNumber ):
+        '''
+        OUTPUT:
+            - (address, channel) the port is bound to ; None if it is not bound
+        '''
+        try:
+            data = self._ioctl( RFCOMMGETDEVINFO, DEV_INFO.pack(portNumber, 0, 0, b"\0"*6, b"\0"*6, 0) )
+        except (IOError, OSError) as instance:
+            if( instance.errno == errno.ENODEV ):
+                return( None )
+            raise
+        _, _, _, _, dst, channel = DEV_INFO.unpack( data )
+        return( unpackAddress(dst), channel )
+
+# ------------------------------------------------------------------------
+
+    def bind( self, portNumber, address, channel=1 ):
+        '''
+        Bind a device to /dev/rfcommN, reusing an existing binding to the same device.
+
+        OUTPUT:
+            - Path of the serial device
+        '''
+
+        target = ( address.upper(), channel )
+        if( self.bound.get(portNumber) == target and os.path.exists(devicePath(portNumber)) ):
+            stats.count( "rfcommBind", "cached" )
+            return( devicePath(portNumber) )
+
+        t0 = monotonic()
+        try:
+            current = self.info( portNumber )
+            if( current != target ):
+                if( current is not None ):                                  # Someone else's device
+                    self._release( portNumber )
+                print( fullStamp() + " Binding " + address + " to " + devicePath(portNumber) )
+                self._ioctl( RFCOMMCREATEDEV,
+                             DEV_REQ.pack(portNumber, 0, b"\0"*6, packAddress(address), channel) )
+        except (IOError, OSError) as instance:
+            if( not self.fallback or instance.errno not in (errno.EPERM, errno.EACCES) ):
+                stats.record( "rfcommBind", None, "ERROR" )
+                raise BindingError( "Could not bind %s: %s" %(devicePath(portNumber), instance) )
+            self._shell( "release", str(portNumber) )
+            self._shell( "bind", devicePath(portNumber), address, str(channel) )
+
+        stats.record( "rfcommBind", monotonic() - t0, "BOUND" )
+        self.bound[portNumber] = target
+        return( devicePath(portNumber) )
+
+# ------------------------------------------------------------------------
+
+    def release( self, portNumber ):
+        '''
+        Release /dev/rfcommN (a port that is not bound is left alone).
+        '''
+        self.bound.pop( portNumber, None )
+        try:
+            self._release( portNumber )
+        except (IOError, OSError) as instance:
+            if( instance.errno == errno.ENODEV ):
+                return
+            if( not self.fallback or instance.errno not in (errno.EPERM, errno.EACCES) ):
+                raise BindingError( "Could not release %s: %s" %(devicePath(portNumber), instance) )
+            self._shell( "release", str(portNumber) )
+
+    def _release( self, portNumber ):
+        print( fullStamp() + " Releasing " + devicePath(portNumber) )
+        self._ioctl( RFCOMMRELEASEDEV, DEV_REQ.pack(portNumber, 0, b"\0"*6, b"\0"*6, 0) )
+
+    def forget( self, portNumber ):
+        '''
+        Drop a cached binding so the next bind() checks with the kernel again.
+        '''
+        self.bound.pop( portNumber, None )
+
+# ------------------------------------------------------------------------
+
+    def _shell( self, *args ):
+        print( fullStamp() + " No CAP_NET_ADMIN, running rfcomm " + " ".join(args) )
+        with open( os.devnull, "w" ) as null:
+            subprocess.call( ("sudo", "rfcomm") + args, stdout=null, stderr=null )
+
+binder = RfcommBinder()                                                     # Shared by every serial connection
+
+# ================================================================================= #
+# Serial Connection
+# ================================================================================= #
+
+def openSerialPort( portNumber, address, baudrate=115200, attempts=5, timeout=1.0, readyTimeout=5.0,
+                    poll=0.1, backoff=0.2, binder=binder ):
+    '''
+    Bind (cached), open and handshake a serial port to a stethoscope.
+
+    INPUTS:
+        - portNumber  : N of /dev/rfcommN
+        - address     : Bluetooth address of the device
+        - baudrate    : Serial baudrate
+        - attempts    : Connection attempts before giving up
+        - timeout     : Read timeout of the port (sec)
+        - readyTimeout: How long a NAKing (booting) device is polled per attempt (sec)
+        - poll        : Delay between two ENQ while the device NAKs (sec)
+        - backoff     : First delay between two attempts (doubles each time, sec)
+
+    OUTPUT:
+        - Open serial.Serial that ACKed an ENQ ; None if every attempt failed
+    '''
+
+    import  serial                                                          # PySerial, see bluetoothProtocol_teensy32.py
+
+    for attempt in range( attempts ):
+        t0          = monotonic()
+        rfObject    = None
+        try:
+            path        = binder.bind( portNumber, address )
+            rfObject    = serial.Serial( port=path, baudrate=baudrate, bytesize=serial.EIGHTBITS,
+                                         parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
+                                         timeout=timeout )
+            if( _waitReady(rfObject, readyTimeout, poll) ):
+                stats.record( "serialConnect", monotonic() - t0, "ACK" )
+                print( fullStamp() + " ACK Connection Established (%.2f sec)" %(monotonic() - t0) )
+                return( rfObject )
+            stats.record( "serialConnect", None, "TIMEOUT" )
+
+        except (BindingError, serial.SerialException, IOError, OSError) as instance:
+            stats.record( "serialConnect", None, "ERROR" )
+            print( fullStamp() + " Attempt %d failed %s" %(attempt+1, str(instance)) )
+            binder.forget( portNumber )                                     # Binding may be stale
+
+        if( rfObject is not None ):
+            rfObject.close()
+        time.sleep( backoff * 2**attempt )
+
+    print( fullStamp() + " Attempts limit reached" )
+    print( fullStamp() + " Please troubleshoot devices" )
+    return( None )
+
+def _waitReady( rfObject, readyTimeout, poll ):
+    '''
+    Poll ENQ until ACK; NAK means the device is still booting, silence means no link.
+    '''
+    t0 = monotonic()
+    while( monotonic() - t0 < readyTimeout ):
+        t1 = monotonic()
+        rfObject.write( toBytes(definitions.ENQ) )
+        inByte = rfObject.read( size=1 )
+        if( inByte == ACK_BYTE ):
+            stats.record( "statusEnquiry", monotonic() - t1, "ACK" )
+            return( True )
+        if( inByte != NAK_BYTE ):
+            stats.record( "statusEnquiry", None, "TIMEOUT" )
+            return( False )
+        stats.record( "statusEnquiry", monotonic() - t1, "NAK" )
+        print( fullStamp() + " NAK device NOT READY" )
+        time.sleep( poll )
+    return( False )
@@ -0,0 +1,236 @@
+"""
+sensorFusion.py
+
+The following module fuses the cuff pressure stream (ADS1115, dial process) with
+the cuff IMU stream (ESP8266 over MQTT).
+
+The two streams arrive on different clocks and threads, and GUI_v3.1 used to AND
+their latest booleans together. A FusionEngine instead takes every sample with
+the monotonic time it was received at, holds it in a bounded reorder buffer for
+reorderWindow seconds and releases samples in timestamp order, so the fused state
+moves forward on a single timeline no matter which thread delivered what first.
+Samples older than what was already released are counted as late and applied at
+the current position.
+
+Conditions are evaluated on that timeline, in O(1) per released sample. A
+condition is a list of terms, each a predicate over the fused state plus the time
+it must have held (e.g. "proximity for >= 200 ms" and "pressure in band"). The
+condition is active while every term has held long enough; onChange reports the
+exact timeline time it changed. Changes are queued in timeline order under the
+lock and delivered by one thread at a time, so two threads pushing at once can
+never hand a later change to the handler before an earlier one.
+
+skew() exposes, per stream, the delay from reception to fusion and the age of its
+latest sample, and the skew between the streams (how far apart in time the
+latest samples being fused are).
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  collections, heapq, itertools, threading
+from    timeStamp                   import  fullStamp, monotonic
+
+# ================================================================================= #
+# Condition
+# ================================================================================= #
+
+class Condition(object):
+
+    def __init__( self, name, terms, onChange=None ):
+        '''
+        Joint condition over the fused state.
+
+        INPUTS:
+            - name      : Condition name
+            - terms     : list of (predicate(state) -> bool, holdFor sec)
+            - onChange  : fn(name, active, t) called on every change (t: timeline time)
+        '''
+        self.name       = name
+        self.terms      = [ (predicate, float(holdFor)) for predicate, holdFor in terms ]
+        self.since      = [ None ]*len( self.terms )                        # Time each term became true
+        self.onChange   = onChange
+        self.active     = False
+        self.changes    = 0
+
+    def update( self, state, t ):
+        '''
+        Re-evaluate the terms after the state changed at t.
+        '''
+        for i, (predicate, _) in enumerate( self.terms ):
+            try:
+                true = bool( predicate(state) )
+            except (KeyError, TypeError):                                   # A stream has not reported yet
+                true = False
+            if( not true ):
+                self.since[i] = None
+            elif( self.since[i] is None ):
+                self.since[i] = t
+
+    def check( self, t ):
+        '''
+        OUTPUT:
+            - (active, time of the change) if the condition changed by t, else None
+        '''
+        if( None in self.since ):
+            active, at = False, t
+        else:
+            at     = max( since + holdFor for since, (_, holdFor) in zip(self.since, self.terms) )
+            active = at <= t
+        if( active == self.active ):
+            return( None )
+        self.active  = active
+        self.changes = self.changes + 1
+        return( active, at )
+
+# ================================================================================= #
+# Fusion Engine
+# ================================================================================= #
+
+class FusionEngine(object):
+
+    def __init__( self, reorderWindow=0.05, maxBuffer=1024, alpha=0.1 ):
+        '''
+        Time-aligned fusion of sensor streams.
+
+        INPUTS:
+            - reorderWindow : How long (sec) a sample waits for earlier ones from other streams
+            - maxBuffer     : Samples held at most (the oldest are released early beyond that)
+            - alpha         : Weight of a new sample in the skew/lag EWMAs
+        '''
+
+        self.reorderWindow  = reorderWindow
+        self.maxBuffer      = maxBuffer
+        self.alpha          = alpha
+
+        self.lock           = threading.Lock()
+        self.buffer         = []                                            # heap of (t, n, stream, fields)
+        self.counter        = itertools.count()                             # Keeps equal times in push order
+        self.state          = {}                                            # Fused state: field -> value
+        self.conditions     = []
+        self.position       = None                                          # Timeline time of the last release
+        self.streams        = {}                                            # stream -> figures
+        self.skewEwma       = None
+        self.late           = 0
+        self.outbox         = collections.deque()                           # (condition, change) to deliver, in order
+        self.delivering     = threading.Lock()                              # Held by the thread delivering them
+
+# ------------------------------------------------------------------------
+
+    def addCondition( self, name, terms, onChange=None ):
+        condition = Condition( name, terms, onChange )
+        with self.lock:
+            self.conditions.append( condition )
+        return( condition )
+
+    def active( self, name ):
+        return( any(c.active for c in self.conditions if c.name == name) )
+
+# ------------------------------------------------------------------------
+
+    def push( self, stream, fields, at=None ):
+        '''
+        Add one sample.
+
+        INPUTS:
+            - stream    : Stream name (e.g. "pressure", "imu")
+            - fields    : dict merged into the fused state (e.g. {"mmHg": 101.2})
+            - at        : Monotonic time the sample was received at (default: now)
+        '''
+        now = monotonic()
+        at  = now if at is None else at
+        with self.lock:
+            figures = self.streams.get( stream )
+            if( figures is None ):
+                figures = self.streams[stream] = { "samples": 0, "lag": 0.0, "latest": None }
+            figures["samples"] += 1
+            figures["lag"] = ( 1 - self.alpha )*figures["lag"] + self.alpha*( now - at )
+            heapq.heappush( self.buffer, (at, next(self.counter), stream, fields) )
+            self.outbox.extend( self._release(now) )
+        self._notify()
+
+    def poll( self, now=None ):
+        '''
+        Release what is due and re-check the hold times (call it when no samples come in).
+        '''
+        with self.lock:
+            self.outbox.extend( self._release(monotonic() if now is None else now) )
+        self._notify()
+
+# ------------------------------------------------------------------------
+
+    def _release( self, now ):
+        watermark = now - self.reorderWindow
+        changes   = []
+        buffer    = self.buffer
+        while( buffer and (buffer[0][0] <= watermark or len(buffer) > self.maxBuffer) ):
+            t, _, stream, fields = heapq.heappop( buffer )
+            if( self.position is not None and t < self.position ):
+                self.late = self.late + 1                                   # Arrived after later samples were fused
+                t = self.position
+            self.position = t
+            self.state.update( fields )
+            self.streams[stream]["latest"] = t
+            self._skew()
+            for condition in self.conditions:
+                condition.update( self.state, t )
+                change = condition.check( t )
+                if( change is not None ):
+                    changes.append( (condition, change) )
+
+        if( self.position is not None and watermark > self.position ):
+            for condition in self.conditions:                               # Holds that ran out between samples
+                change = condition.check( watermark )
+                if( change is not None ):
+                    changes.append( (condition, change) )
+        return( changes )
+
+    def _skew( self ):
+        latest = [ s["latest"] for s in self.streams.values() if s["latest"] is not None ]
+        if( len(latest) > 1 ):
+            skew = max( latest ) - min( latest )
+            self.skewEwma = skew if self.skewEwma is None else ( 1 - self.alpha )*self.skewEwma + self.alpha*skew
+
+    def _notify( self ):
+        '''
+        Deliver queued changes in order. If another thread (or a handler
+        up the stack) is delivering, it takes ours too.
+        '''
+        while( True ):
+            if( not self.delivering.acquire(False) ):
+                return
+            try:
+                while( True ):
+                    with self.lock:
+                        if( not self.outbox ):
+                            break
+                        condition, (active, at) = self.outbox.popleft()
+                    if( condition.onChange is not None ):
+                        try:
+                            condition.onChange( condition.name, active, at )
+                        except Exception as instance:
+                            print( fullStamp() + " Fusion handler failed " + str(instance.args) )
+            finally:
+                self.delivering.release()
+            with self.lock:
+                if( not self.outbox ):                                      # None queued while we let go
+                    return
+
+# ------------------------------------------------------------------------
+
+    def skew( self ):
+        '''
+        OUTPUT:
+            - dict with "skew" (EWMA, sec, between the latest samples of the streams),
+              "late" (samples that arrived out of the reorder window) and, per stream,
+              its sample count, "lag" (EWMA, reception to push) and "age" of its latest sample
+        '''
+        with self.lock:
+            now = monotonic()
+            out = { "skew": self.skewEwma, "late": self.late, "streams": {} }
+            for stream, figures in self.streams.items():
+                out["streams"][stream] = { "samples" : figures["samples"],
+                                           "lag"     : figures["lag"],
+                                           "age"     : None if figures["latest"] is None else now - figures["latest"] }
+            return( out )
@@ -0,0 +1,220 @@
+"""
+sessionWorkflow.py
+
+The following module runs the steps of a recording session (connect, record
+heartbeat, stop, launch cuff, collect results) without ever blocking the GUI.
+
+GUI_v2.0 used to busy-wait 10 sec on the Tk thread while the heartbeat recorded,
+and then block it on the dial process until it exited. A SessionWorkflow is an
+explicit state machine instead: every step's action runs on a background worker
+thread, minimum durations are timers, and a step can wait at a gate (e.g. the
+user pressing Stop) that the GUI opens with trigger(). All transitions happen on
+the worker thread, so the workflow needs no locks; the GUI is told about them
+through post() (appJar's queueFunction) and only ever calls start(), trigger()
+and cancel(), which return at once.
+
+A step moves through
+    RUNNING -> HOLDING (until minDuration) -> WAITING (until its gate opens) -> DONE
+or ends in FAILED (its action raised) or CANCELLED. The duration of every step,
+and the time spent in its action, are kept in self.durations and recorded in
+latencyStats as "session <step>".
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  threading
+from    timeStamp                   import  fullStamp, monotonic
+from    latencyStats                import  stats
+
+try:
+    import  Queue   as queue                                                # Python 2
+except ImportError:
+    import  queue                                                           # Python 3
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+RUNNING     = "RUNNING"                                                     # Action executing
+HOLDING     = "HOLDING"                                                     # Action done, minDuration not reached
+WAITING     = "WAITING"                                                     # Waiting for the gate to open
+DONE        = "DONE"
+FAILED      = "FAILED"
+CANCELLED   = "CANCELLED"
+
+class Step(object):
+
+    def __init__( self, name, action=None, minDuration=0.0, gate=None ):
+        '''
+        One step of a session.
+
+        INPUTS:
+            - name        : Step name
+            - action      : fn(context) run on the worker thread (may block, e.g. on a device)
+            - minDuration : The step lasts at least this long (sec), measured from its start
+            - gate        : Name of the trigger() that ends the step, None to go on at once
+        '''
+        self.name           = name
+        self.action         = action
+        self.minDuration    = minDuration
+        self.gate           = gate
+
+# ================================================================================= #
+# Session Workflow
+# ================================================================================= #
+
+class SessionWorkflow(object):
+
+    def __init__( self, steps, post=None, onState=None, onDone=None ):
+        '''
+        INPUTS:
+            - steps     : list of Step, run in order
+            - post      : fn(callable, *args) that runs a callable on the GUI thread
+                          (e.g. app.queueFunction); None calls the handlers directly
+            - onState   : fn(stepName, state) on every transition
+            - onDone    : fn(state, context) once the session ended (DONE/FAILED/CANCELLED)
+        '''
+
+        self.steps      = list( steps )
+        self.post       = post
+        self.onState    = onState
+        self.onDone     = onDone
+
+        self.jobs       = queue.Queue()                                     # Everything runs through here
+        self.context    = None
+        self.index      = None                                              # Current step
+        self.state      = None
+        self.opened     = set()                                             # Gates opened so far
+        self.timer      = None
+        self.stepStart  = None
+        self.actionTime = None
+        self.durations  = []                                                # (step, total sec, action sec)
+        self.thread     = None
+
+# ------------------------------------------------------------------------
+
+    def start( self, context=None ):
+        '''
+        Begin the session on a fresh worker thread (returns at once).
+
+        INPUTS:
+            - context   : dict shared by the step actions (results go in it too)
+        '''
+        self.context    = {} if context is None else context
+        self.opened     = set()
+        self.durations  = []
+        self.thread     = threading.Thread( target=self._worker, name="sessionWorkflow" )
+        self.thread.daemon = True
+        self.thread.start()
+        self.jobs.put( (self._enter, 0) )
+        return( self )
+
+    def trigger( self, gate ):
+        '''
+        Open a gate (e.g. "stop" when the user presses Stop).
+        '''
+        self.jobs.put( (self._open, gate) )
+
+    def cancel( self ):
+        self.jobs.put( (self._finish, CANCELLED) )
+
+# ------------------------------------------------------------------------
+
+    def _worker( self ):
+        while( True ):
+            job, arg = self.jobs.get()
+            if( job is None ):
+                return
+            job( arg )
+
+    def _enter( self, index ):
+        if( index >= len(self.steps) ):
+            self._finish( DONE )
+            return
+
+        step            = self.steps[index]
+        self.index      = index
+        self.stepStart  = monotonic()
+        self._set( RUNNING )
+        try:
+            if( step.action is not None ):
+                step.action( self.context )
+        except Exception as instance:
+            print( fullStamp() + " Step " + step.name + " failed " + str(instance.args) )
+            self.context["error"] = instance
+            self._finish( FAILED )
+            return
+        self.actionTime = monotonic() - self.stepStart
+
+        remaining = step.minDuration - ( monotonic() - self.stepStart )
+        if( remaining > 0 ):
+            self._set( HOLDING )
+            self.timer = threading.Timer( remaining, self.jobs.put, ((self._held, index),) )
+            self.timer.daemon = True
+            self.timer.start()
+        else:
+            self._held( index )
+
+    def _held( self, index ):
+        if( index != self.index or self.state != HOLDING and self.state != RUNNING ):
+            return                                                          # Stale timer (cancelled)
+        step = self.steps[index]
+        if( step.gate is not None and step.gate not in self.opened ):
+            self._set( WAITING )
+            return
+        self._leave()
+
+    def _open( self, gate ):
+        self.opened.add( gate )
+        if( self.state == WAITING and self.steps[self.index].gate == gate ):
+            self._leave()
+
+    def _leave( self ):
+        step  = self.steps[self.index]
+        total = monotonic() - self.stepStart
+        self.durations.append( (step.name, total, self.actionTime) )
+        stats.record( "session " + step.name, total )
+        self._set( DONE )
+        self._enter( self.index + 1 )
+
+    def _finish( self, state ):
+        if( self.state in (FAILED, CANCELLED) or (self.state == DONE and self.index == len(self.steps)) ):
+            return                                                          # Already over
+        if( self.timer is not None ):
+            self.timer.cancel()
+        if( state != DONE and self.index is not None ):
+            self._set( state )
+        self.index, self.state = len( self.steps ), state
+        self._call( self.onDone, state, self.context )
+        self.jobs.put( (None, None) )                                       # Stop the worker
+
+# ------------------------------------------------------------------------
+
+    def _set( self, state ):
+        self.state = state
+        self._call( self.onState, self.steps[self.index].name, state )
+
+    def _call( self, fn, *args ):
+        if( fn is None ):
+            return
+        try:
+            if( self.post is not None ):
+                self.post( fn, *args )
+            else:
+                fn( *args )
+        except Exception as instance:                                       # Keep the worker alive
+            print( fullStamp() + " Session handler failed " + str(instance.args) )
+
+# ------------------------------------------------------------------------
+
+    def report( self ):
+        '''
+        OUTPUT:
+            - Printable table of step durations (for profiling)
+        '''
+        lines = [ "%-12s %8s %8s" %("step", "total", "action") ]
+        for name, total, action in self.durations:
+            lines.append( "%-12s %7.2fs %7.2fs" %(name, total, action) )
+        return( "\n".join(lines) )
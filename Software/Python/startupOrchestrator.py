@@ -0,0 +1,95 @@
+"""
+startupOrchestrator.py
+
+The following module brings up every device of a panel at once.
+
+Devices used to be connected one after the other, each with a fixed sleep "for
+stability" before its ENQ, so a panel with three stethoscopes took well over ten
+seconds to get ready. Here the device list is read with
+configurationProtocol.panelDeviceID, all links connect concurrently through a
+ConnectionManager, and a device counts as ready as soon as it ACKs an ENQ (a NAK
+is polled again until the device has booted). The time to ready of every device
+is reported.
+
+Stand-alone:
+    python startupOrchestrator.py --timeout 15
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+from    timeStamp                   import  fullStamp, monotonic
+from    connectionManager           import  ConnectionManager
+
+# ================================================================================= #
+# Startup
+# ================================================================================= #
+
+def startDevices( addresses, timeout=15.0, **kwargs ):
+    '''
+    Connect to all devices concurrently and wait until they are ready.
+
+    INPUTS:
+        - addresses : Bluetooth addresses
+        - timeout   : Longest wait for the whole panel (sec)
+        - kwargs    : Passed on to ConnectionManager
+
+    OUTPUT:
+        - (ConnectionManager, report) ; report maps address -> time to ready
+          (sec), None for devices that were not ready in time. The manager keeps
+          reconnecting those in the background.
+    '''
+
+    t0      = monotonic()
+    links   = ConnectionManager( addresses, **kwargs ).start()
+    allUp   = links.waitReady( timeout )
+
+    report  = dict( (address, link.timeToReady()) for address, link in links.links.items() )
+    printReport( report, monotonic() - t0 )
+    if( not allUp ):
+        print( fullStamp() + " Not every device was ready within %.1f sec" %timeout )
+    return( links, report )
+
+# ------------------------------------------------------------------------
+
+def startPanel( deviceFile, panelID, timeout=15.0, **kwargs ):
+    '''
+    startDevices() for the devices listed in panel<N>devices.txt.
+    '''
+    from configurationProtocol import panelDeviceID
+    _, _, bt_address_list = panelDeviceID( deviceFile, panelID )
+    return( startDevices(bt_address_list, timeout, **kwargs) )
+
+# ------------------------------------------------------------------------
+
+def printReport( report, elapsed ):
+    '''
+    Print the time to ready of every device.
+    '''
+
+    print( fullStamp() + " Startup report" )
+    for address in sorted( report ):
+        ttr = report[address]
+        print( "    %s : %s" %(address, "NOT READY" if ttr is None else "%.2f sec" %ttr) )
+    print( "    panel ready after %.2f sec" %elapsed )
+
+# ================================================================================= #
+# Stand-alone
+# ================================================================================= #
+
+if __name__ == "__main__":
+    import argparse
+    from configurationProtocol import definePaths, panelSelfID, getMAC
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument( "--timeout", type=float, default=15.0, help="Longest wait for the panel (sec)" )
+    ap.add_argument( "--port", type=int, default=1, help="RFCOMM channel" )
+    args = vars( ap.parse_args() )
+
+    _, _, _, _, _, _, _, _, dataDir = definePaths()                         # Identify panel ...
+    _, _, panelID, _ = panelSelfID( dataDir + "/panels.txt", getMAC("eth0") )
+    deviceFile = "{}/panel{}devices.txt".format( dataDir, panelID )        # ... and its devices
+
+    links, report = startPanel( deviceFile, panelID, args["timeout"], port=args["port"] )
+    links.stop()
@@ -0,0 +1,304 @@
+"""
+stethoscopeAsync.py
+
+The following module is an asyncio client for the stethoscope protocol.
+
+Unlike stethoscopeProtocol.py, nothing here blocks: the socket is non-blocking,
+every command has a deadline, timed-out commands are retried, and callers can
+cancel a command at any time. Commands are pipelined: up to `window` commands
+may be on the link at once and their responses are matched in order, which the
+firmware guarantees since it answers every command in the order received.
+Commands followed by a free-form string (STARTCREC, PSTRING) are sent alone,
+since the firmware reads the string until the link goes quiet. The command set
+is generated from the table in stethoscopeCodec.py.
+
+Requires Python 3.5+ (asyncio); the rest of the package remains Python 2 compatible.
+
+Benchmark against the fake device:
+    python3 fakeStethoscope.py --client async --window 4 --latency 0.02
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  asyncio, collections, socket
+from    stethoscopeCodec            import  codec, toBytes, STRING
+from    timeStamp                   import  fullStamp, monotonic
+
+class StethoscopeTimeout(Exception):
+    """
+    No response within the deadline, after all retries.
+    """
+    pass
+
+class _Resync(Exception):
+    """
+    Response alignment was lost; the command may be retried.
+    """
+    pass
+
+# ================================================================================= #
+# Async Stethoscope
+# ================================================================================= #
+
+class AsyncStethoscope(object):
+
+    def __init__( self, sock, timeout=2.0, retries=2, window=4, quiet=0.05 ):
+        '''
+        Asyncio client around a connected stethoscope socket.
+
+        INPUTS:
+            - sock      : Connected socket (RFCOMM, TCP or socketpair end)
+            - timeout   : Per-attempt response deadline (sec)
+            - retries   : Extra attempts after a timeout
+            - window    : Maximum number of commands on the link at once
+            - quiet     : Silence (sec) required to resynchronize after a timeout
+        '''
+
+        self.sock       = sock
+        self.sock.setblocking( False )
+        self.timeout    = timeout
+        self.retries    = retries
+        self.quiet      = quiet
+
+        self.loop       = asyncio.get_event_loop()
+        self.window     = asyncio.Semaphore( window )
+        self.sendLock   = asyncio.Lock()                                    # Keeps send order == in-flight order
+        self.idle       = asyncio.Event()                                   # Set when nothing is in flight
+        self.ready      = asyncio.Event()                                   # Cleared while resynchronizing
+        self.idle.set()
+        self.ready.set()
+
+        self.inflight   = collections.deque()                               # [nResponse, future] in send order
+        self.buffer     = b""
+        self.stats      = { "sent": 0, "retries": 0, "timeouts": 0, "stray": 0 }
+        self.reader     = self.loop.create_task( self._read() )
+
+# ------------------------------------------------------------------------
+
+    @classmethod
+    async def connect( cls, address, port=1, **kwargs ):
+        '''
+        Open a native RFCOMM connection and wrap it.
+
+        INPUTS:
+            - address   : Bluetooth address of the stethoscope
+            - port      : RFCOMM channel
+        '''
+
+        sock = socket.socket( socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM )
+        sock.setblocking( False )
+        await asyncio.get_event_loop().sock_connect( sock, (address, port) )
+        return( cls(sock, **kwargs) )
+
+# ------------------------------------------------------------------------
+
+    def close( self ):
+        self.reader.cancel()
+        self._failInflight( ConnectionError("Connection closed") )
+        self.sock.close()
+
+# ------------------------------------------------------------------------
+
+    async def _read( self ):
+        '''
+        Reader task: match incoming bytes to in-flight commands, in order.
+        '''
+
+        try:
+            while( True ):
+                data = await self.loop.sock_recv( self.sock, 4096 )
+                if( not data ):
+                    raise ConnectionError( "Connection closed by device" )
+
+                self.buffer = self.buffer + data
+                while( self.inflight and len(self.buffer) >= self.inflight[0][0] ):
+                    n, future = self.inflight.popleft()
+                    response, self.buffer = self.buffer[:n], self.buffer[n:]
+                    if( not future.done() ):                                # Cancelled callers still consume theirs
+                        future.set_result( response )
+
+                if( not self.inflight ):
+                    if( self.buffer ):
+                        self.stats["stray"] += len( self.buffer )           # Late answer to a timed-out command
+                        self.buffer = b""
+                    self.idle.set()
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as instance:
+            print( fullStamp() + " Stethoscope reader stopped " + str(instance.args) )
+            self._failInflight( instance )
+
+# ------------------------------------------------------------------------
+
+    def _failInflight( self, instance ):
+        while( self.inflight ):
+            n, future = self.inflight.popleft()
+            if( not future.done() ):
+                future.set_exception( instance )
+                future.exception()                                          # Timed-out callers no longer listen
+        self.buffer = b""
+        self.idle.set()
+
+# ------------------------------------------------------------------------
+
+    async def _resync( self ):
+        '''
+        After a timeout nobody knows which response belongs to which command:
+        fail everything in flight, then wait for the link to go quiet.
+        '''
+
+        if( not self.ready.is_set() ):
+            await self.ready.wait()
+            return
+
+        self.ready.clear()
+        self._failInflight( _Resync() )
+        strays = -1
+        while( strays != self.stats["stray"] ):                             # Until nothing arrived for `quiet` sec
+            strays = self.stats["stray"]
+            await asyncio.sleep( self.quiet )
+        self.ready.set()
+
+# ------------------------------------------------------------------------
+
+    async def request( self, outBytes, nResponse=1, outString=None, timeout=None, retries=None ):
+        '''
+        Send a command and await its response.
+
+        INPUTS:
+            - outBytes  : Command bytes
+            - nResponse : Number of response bytes
+            - outString : Optional string sent right after the command (sent exclusively)
+            - timeout   : Per-attempt deadline (sec)
+            - retries   : Extra attempts after a timeout
+
+        OUTPUT:
+            - Raw response bytes
+        '''
+
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        payload = toBytes( outBytes ) + ( toBytes(outString) if outString is not None else b"" )
+
+        for attempt in range( retries + 1 ):
+            if( attempt > 0 ):
+                self.stats["retries"] += 1
+
+            async with self.window:
+                async with self.sendLock:
+                    await self.ready.wait()
+                    if( outString is not None ):                            # String commands go alone ...
+                        await self.idle.wait()
+                    future = self.loop.create_future()
+                    self.inflight.append( [nResponse, future] )
+                    self.idle.clear()
+                    await self.loop.sock_sendall( self.sock, payload )
+                    self.stats["sent"] += 1
+                    if( outString is not None ):                            # ... and hold the link until answered
+                        response = await self._wait( future, timeout )
+
+                if( outString is None ):
+                    response = await self._wait( future, timeout )
+
+            if( response is not None ):
+                return( response )
+
+        raise StethoscopeTimeout( "No response after %d attempt(s)" %(retries + 1) )
+
+# ------------------------------------------------------------------------
+
+    async def _wait( self, future, timeout ):
+        '''
+        Await a response; None means the attempt failed and may be retried.
+        '''
+
+        try:
+            return( await asyncio.wait_for(asyncio.shield(future), timeout) )
+
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            await self._resync()
+
+        except _Resync:
+            pass                                                            # Someone else timed out
+
+        return( None )
+
+# ------------------------------------------------------------------------
+
+    async def command( self, name, payload=None, **kwargs ):
+        '''
+        Send a command of the stethoscopeCodec table.
+
+        INPUTS:
+            - name      : Command name (or alias)
+            - payload   : String for STRING commands, audio file for FILE commands
+
+        OUTPUT:
+            - True on ACK, False on NAK, raw bytes for DATA responses
+        '''
+
+        command, fixed = codec.lookup( name )
+        if( command.payload == STRING ):
+            response = await self.request( command.code, command.nResponse, payload, **kwargs )
+        else:
+            response = await self.request( codec.encode(name, payload), command.nResponse, **kwargs )
+        return( codec.decodeResponse(name, response) )
+
+def _makeCommand( name ):
+    command, fixed = codec.lookup( name )
+    if( command.payload is None or fixed is not None ):
+        async def method( self, **kwargs ):
+            return( await self.command(name, **kwargs) )
+    else:
+        async def method( self, payload, **kwargs ):
+            return( await self.command(name, payload, **kwargs) )
+    method.__name__ = name
+    method.__doc__  = "Send %s and await the response." %name
+    return( method )
+
+for _name in list( codec.byName ) + list( codec.aliases ):                 # Expose every command as an awaitable
+    setattr( AsyncStethoscope, _name, _makeCommand(_name) )
+
+# ================================================================================= #
+# Benchmark
+# ================================================================================= #
+
+async def _benchmark( fake, count, window ):
+    from latencyStats import Histogram
+    histogram   = Histogram()
+    outcomes    = {}
+    steth       = AsyncStethoscope( fake.socketPair(), window=window, timeout=max(0.2, 10*fake.latency) )
+
+    async def worker( n ):                                                  # One caller per window slot
+        for _ in range( n ):
+            t0 = monotonic()
+            try:
+                result = await steth.statusEnquiry()
+                histogram.record( monotonic() - t0 )
+            except StethoscopeTimeout:
+                result = "TIMEOUT"
+            outcomes[result] = outcomes.get( result, 0 ) + 1
+
+    await asyncio.gather( *[worker(count//window) for _ in range(window)] )
+    steth.close()
+    return( histogram, outcomes )
+
+def benchmark( fake, count, window ):
+    '''
+    Pipelined statusEnquiry() round trips against a fakeStethoscope.FakeStethoscope.
+
+    OUTPUT:
+        - (elapsed sec, latencyStats.Histogram of round trips, results per outcome)
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop( loop )
+    t0 = monotonic()
+    histogram, outcomes = loop.run_until_complete( _benchmark(fake, count, window) )
+    elapsed = monotonic() - t0
+    loop.close()
+    return( elapsed, histogram, outcomes )
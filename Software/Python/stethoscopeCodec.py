@@ -0,0 +1,316 @@
+"""
+stethoscopeCodec.py
+
+The following module holds the single, declarative command table of the stethoscope
+protocol and compiles it into encode/decode lookups.
+
+Every command is one row: name, code (one or two bytes), payload type, expected
+response and response length. The byte codes themselves still come from
+stethoscopeDefinitions.py (single-byte commands) and protocolDefinitions.py
+(two-byte DC1/DC3/DC4 "device control" commands).
+
+The two definitions modules overlap: DC1..DC4 (0x11..0x14) are the same bytes as
+DEVICEID, SDCHECK, SENDWAV and DELVOLATILE. A link can only decode one of them, so
+the table is validated at import time to be prefix-free (no code is a prefix of
+another, no command code is a response byte). The table resolves the overlap as:
+
+    0x11 -> DC1 prefix  (deviceID, sdCardCheck)    DEVICEID single byte not used
+    0x12 -> SDCHECK     (systemCheck)              DC2 family not used
+    0x13 -> DC3 prefix  (mic stream/tracking)      SENDWAV single byte not used
+    0x14 -> DC4 prefix  (synthetic playback)       DELVOLATILE single byte not used
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  stethoscopeDefinitions      as      definitions
+import  protocolDefinitions         as      dcDefinitions
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+def toBytes( data ):
+    """
+    Convert the chr() based definitions into bytes for the socket.
+    (Python 2 strings already are bytes)
+    """
+    if( isinstance(data, bytes) ):
+        return data
+    return bytes( bytearray(ord(c) for c in data) )
+
+ACK_BYTE = toBytes( definitions.ACK )
+NAK_BYTE = toBytes( definitions.NAK )
+
+# Payload types
+NONE    = None                                                              # Code only
+STRING  = "string"                                                          # Code followed by a free-form string
+FILE    = "file"                                                            # The code is the audio file to blend
+
+# Expected responses
+ACKNAK  = "acknak"                                                          # One byte, ACK | NAK
+DATA    = "data"                                                            # nResponse bytes of data
+
+# Audio files that can be passed to startBlending()
+BLEND_FILES = ( definitions.KOROT, definitions.STARTBLEND, definitions.NHBSYN,
+                definitions.ESMSYN, definitions.NHBREC, definitions.EHBREC )
+
+DC1 = dcDefinitions.DC1
+DC3 = dcDefinitions.DC3
+DC4 = dcDefinitions.DC4
+
+# ================================================================================= #
+# Command Table
+# ================================================================================= #
+
+#   name                      code                                    payload  response nResp  ACK message / NAK message
+COMMANDS = (
+    ( "statusEnquiry",          definitions.ENQ,                        NONE,   ACKNAK, 1,  "Device READY",
+                                                                                            "Device NOT READY" ),
+    ( "systemCheck",            definitions.SDCHECK,                    NONE,   ACKNAK, 1,  "SD Card Check Passed",
+                                                                                            "SD Card Check Failed" ),
+    ( "deviceID",               DC1 + dcDefinitions.DC1_DEVICEID,       NONE,   DATA,   3,  "Device Identified",
+                                                                                            "Device NOT Identified" ),
+    ( "sdCardCheck",            DC1 + dcDefinitions.DC1_SDCHECK,        NONE,   ACKNAK, 1,  "SD Card Check Passed",
+                                                                                            "SD Card Check Failed" ),
+    ( "parseString",            definitions.PSTRING,                    STRING, ACKNAK, 1,  "Device READY",
+                                                                                            "Device NOT READY" ),
+    ( "startRecording",         definitions.STARTREC,                   NONE,   ACKNAK, 1,  "Stethoscope will START RECORDING",
+                                                                                            "Stethoscope CANNOT START RECORDING" ),
+    ( "startCustomRecording",   definitions.STARTCREC,                  STRING, ACKNAK, 1,  "Device will START RECORDING",
+                                                                                            "Device CANNOT START RECORDING" ),
+    ( "stopRecording",          definitions.STOPREC,                    NONE,   ACKNAK, 1,  "Stethoscope will STOP RECORDING",
+                                                                                            "Stethoscope CANNOT STOP RECORDING" ),
+    ( "startMicStream",         DC3 + dcDefinitions.DC3_STARTSTREAM,    NONE,   ACKNAK, 1,  "Stethoscope will START STREAMING",
+                                                                                            "Stethoscope CANNOT START STREAMING" ),
+    ( "startTrackingMicStream", DC3 + dcDefinitions.DC3_STARTTRACKING,  NONE,   ACKNAK, 1,  "Device will START Tracking",
+                                                                                            "Device CANNOT START Tracking" ),
+    ( "stopTrackingMicStream",  DC3 + dcDefinitions.DC3_STOPTRACKING,   NONE,   ACKNAK, 1,  "Device will STOP Tracking",
+                                                                                            "Device CANNOT STOP Tracking" ),
+    ( "normalHBPlayback",       DC4 + dcDefinitions.DC4_NORMALHB,       NONE,   ACKNAK, 1,  "Stethoscope will START PLAYBACK of NORMAL HEARTBEAT",
+                                                                                            "Stethoscope CANNOT START PLAYBACK of NORMAL HEARTBEAT" ),
+    ( "earlyHMPlayback",        DC4 + dcDefinitions.DC4_ESHMURMUR,      NONE,   ACKNAK, 1,  "Stethoscope will START PLAYBACK of EARLY SYSTOLIC HEART MUMUR",
+                                                                                            "Stethoscope CANNOT START PLAYBACK of EARLY SYSTOLIC HEART MUMUR" ),
+    ( "startPlayback",          definitions.STARTPLAY,                  NONE,   ACKNAK, 1,  "Stethoscope will START PLAYBACK",
+                                                                                            "Stethoscope CANNOT START PLAYBACK" ),
+    ( "stopPlayback",           definitions.STOPPLAY,                   NONE,   ACKNAK, 1,  "Stethoscope will STOP PLAYBACK",
+                                                                                            "Stethoscope CANNOT STOP PLAYBACK" ),
+    ( "startPassthrough",       definitions.STARTPASSTHRU,              NONE,   ACKNAK, 1,  "Stethoscope will START PASSTHROUGH",
+                                                                                            "Stethoscope CANNOT START PASSTHROUGH" ),
+    ( "startHBMonitor",         definitions.STARTHBMONITOR,             NONE,   ACKNAK, 1,  "Stethoscope will START MONITORING",
+                                                                                            "Stethoscope CANNOT START MONITORING" ),
+    ( "stopHBMonitor",          definitions.STOPHBMONITOR,              NONE,   ACKNAK, 1,  "Stethoscope will STOP MONITORING",
+                                                                                            "Stethoscope CANNOT STOP MONITORING" ),
+    ( "startBlending",          None,                                   FILE,   ACKNAK, 1,  "Stethoscope will START BLENDING",
+                                                                                            "Stethoscope CANNOT START BLENDING" ),
+    ( "stopBlending",           definitions.STOPBLEND,                  NONE,   ACKNAK, 1,  "Stethoscope will STOP BLENDING",
+                                                                                            "Stethoscope CANNOT STOP BLENDING" ),
+    ( "mute",                   definitions.MUTE,                       NONE,   ACKNAK, 1,  "Stethoscope MUTED",
+                                                                                            "Stethoscope CANNOT MUTE" ),
+    ( "unmute",                 definitions.UNMUTE,                     NONE,   ACKNAK, 1,  "Stethoscope UN-MUTED",
+                                                                                            "Stethoscope CANNOT UN-MUTE" ),
+    ( "startBPNorm",            definitions.STARTBPNORM,                NONE,   ACKNAK, 1,  "Stethoscope will START NORMAL playback",
+                                                                                            "Stethoscope CANNOT START NORMAL playback" ),
+    ( "startBPBrady",           definitions.STARTBPBRADY,               NONE,   ACKNAK, 1,  "Stethoscope will START PLAYBACK of BRADYCARDIA",
+                                                                                            "Stethoscope CANNOT START BRADYCARDIA" ),
+    ( "startBPTachy",           definitions.STARTBPTACHY,               NONE,   ACKNAK, 1,  "Stethoscope will START PLAYBACK of TACHYCARDIA",
+                                                                                            "Stethoscope CANNOT START TACHYCARDIA" ),
+    ( "stopBPAll",              definitions.STOPBPALL,                  NONE,   ACKNAK, 1,  "Stethoscope will STOP AUGMENTING",
+                                                                                            "Stethoscope CANNOT STOP AUGMENTING" ),
+    )
+
+# Convenience aliases kept from stethoscopeProtocol.py
+ALIASES = { "earlyHMBlending" : ("startBlending", definitions.STARTBLEND) }
+
+# ================================================================================= #
+# Compiled Command
+# ================================================================================= #
+
+class CompiledCommand(object):
+
+    __slots__ = ( "name", "code", "payload", "response", "nResponse",
+                  "ackMessage", "nakMessage" )
+
+    def __init__( self, name, code, payload, response, nResponse, ackMessage, nakMessage ):
+        self.name       = name
+        self.code       = toBytes( code ) if code is not None else None
+        self.payload    = payload
+        self.response   = response
+        self.nResponse  = nResponse
+        self.ackMessage = " ACK " + ackMessage                              # Formatted once, not per call
+        self.nakMessage = " NAK " + nakMessage
+
+# ================================================================================= #
+# Codec
+# ================================================================================= #
+
+class Codec(object):
+
+    def __init__( self, table=COMMANDS, aliases=ALIASES ):
+        '''
+        Compile and validate a command table.
+
+        INPUTS:
+            - table     : Sequence of command rows (see COMMANDS)
+            - aliases   : name -> (command name, fixed payload)
+        '''
+
+        self.byName     = {}                                                # name -> CompiledCommand
+        self.byCode     = {}                                                # code bytes -> CompiledCommand
+        self.prefixes   = set()                                             # First bytes of two-byte codes
+        self.blendFiles = dict( (toBytes(f), f) for f in BLEND_FILES )
+        self.aliases    = dict( aliases )
+
+        for row in table:
+            command = CompiledCommand( *row )
+            if( command.name in self.byName ):
+                raise ValueError( "Duplicate command name %s" %command.name )
+            self.byName[ command.name ] = command
+
+            codes = ( [command.code] if command.payload != FILE else list(self.blendFiles) )
+            for code in codes:
+                self._register( code, command )
+
+        for alias, (name, payload) in self.aliases.items():
+            if( name not in self.byName ):
+                raise ValueError( "Alias %s refers to unknown command %s" %(alias, name) )
+
+        self._validate()
+
+# ------------------------------------------------------------------------
+
+    def _register( self, code, command ):
+        if( code in self.byCode ):
+            raise ValueError( "Code %r of %s collides with %s"
+                              %(code, command.name, self.byCode[code].name) )
+        self.byCode[ code ] = command
+        if( len(code) > 1 ):
+            self.prefixes.add( code[:1] )
+
+# ------------------------------------------------------------------------
+
+    def _validate( self ):
+        '''
+        A stream of commands must decode unambiguously.
+        '''
+
+        for code, command in self.byCode.items():
+            if( code in (ACK_BYTE, NAK_BYTE) ):
+                raise ValueError( "%s uses response byte %r as its code" %(command.name, code) )
+            if( len(code) == 1 and code in self.prefixes ):
+                raise ValueError( "Code %r of %s is also a two-byte command prefix"
+                                  %(code, command.name) )
+            if( len(code) > 2 ):
+                raise ValueError( "Code %r of %s is longer than two bytes" %(code, command.name) )
+
+# ------------------------------------------------------------------------
+
+    def lookup( self, name ):
+        '''
+        OUTPUT:
+            - (CompiledCommand, fixed payload or None) for a name or alias
+        '''
+
+        if( name in self.aliases ):
+            name, payload = self.aliases[ name ]
+            return( self.byName[name], payload )
+        return( self.byName[name], None )
+
+# ------------------------------------------------------------------------
+
+    def encode( self, name, payload=None ):
+        '''
+        Encode a command into the bytes written to the link.
+
+        INPUTS:
+            - name      : Command name (or alias)
+            - payload   : String for STRING commands, audio file for FILE commands
+
+        OUTPUT:
+            - bytes
+        '''
+
+        command, fixed = self.lookup( name )
+        if( fixed is not None ):
+            payload = fixed
+
+        if( command.payload == FILE ):
+            code = toBytes( payload )
+            if( code not in self.blendFiles ):
+                raise ValueError( "%r is not a blendable audio file" %payload )
+            return( code )
+
+        if( command.payload == STRING ):
+            return( command.code + toBytes(payload) )
+
+        return( command.code )
+
+# ------------------------------------------------------------------------
+
+    def encodeBatch( self, commands ):
+        '''
+        Encode several commands into a single write. The firmware reads a
+        STRING payload until the link goes quiet, so one may only come last.
+
+        INPUTS:
+            - commands  : List of (name, payload) tuples
+
+        OUTPUT:
+            - (bytes, total number of response bytes)
+        '''
+
+        out, nResponse = [], 0
+        for i, (name, payload) in enumerate( commands ):
+            command, fixed = self.lookup( name )
+            if( command.payload == STRING and i != len(commands) - 1 ):
+                raise ValueError( "%s carries a string and must be the last of a batch" %name )
+            out.append( self.encode(name, payload) )
+            nResponse = nResponse + command.nResponse
+
+        return( b"".join(out), nResponse )
+
+# ------------------------------------------------------------------------
+
+    def decodeResponse( self, name, response ):
+        '''
+        OUTPUT:
+            - True on ACK, False on NAK, None on anything else,
+              raw bytes for DATA responses
+        '''
+
+        command = self.lookup( name )[0]
+        if( command.response == DATA ):
+            return( response if len(response) == command.nResponse else None )
+        if( response == ACK_BYTE ): return( True )
+        if( response == NAK_BYTE ): return( False )
+        return( None )
+
+# ------------------------------------------------------------------------
+
+    def decodeCommand( self, data ):
+        '''
+        Device-side decoding of the next command in a byte buffer.
+        STRING payloads are not delimited on the wire; the caller collects them.
+
+        OUTPUT:
+            - (CompiledCommand or None, number of bytes consumed)
+              (None, 0) means more bytes are needed
+        '''
+
+        if( not data ):
+            return( None, 0 )
+
+        first = data[:1]
+        if( first in self.prefixes ):
+            if( len(data) < 2 ):
+                return( None, 0 )
+            return( self.byCode.get(data[:2]), 2 )
+
+        return( self.byCode.get(first), 1 )
+
+# ================================================================================= #
+# Compiled at import (raises if the table is inconsistent)
+# ================================================================================= #
+
+codec = Codec()
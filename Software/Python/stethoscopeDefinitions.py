@@ -34,6 +34,8 @@ STOPHBMONITOR   = chr(0x1C)       # Stop Monitoring Heart Beat
 STARTBLEND      = chr(0x1F)       # Start Blending
 STOPBLEND       = chr(0x20)       # Stop Blending
 PSTRING         = chr(0x31)       # Parse String
+MUTE            = chr(0x33)       # Mute ear monitors (not in current firmware, see panelConfig muteCommands)  [resp: ACK | NAK]
+UNMUTE          = chr(0x34)       # Un-mute ear monitors (not in current firmware, ...)                 [resp: ACK | NAK]
 
 ## Simulation Functions ============================================================================================================= // 
 NHBSYN          = chr(0x1D)       # Playback of Synthetic, Normal Heart Beat                           			[resp: ACK | NAK]
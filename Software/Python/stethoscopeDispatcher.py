@@ -0,0 +1,428 @@
+"""
+stethoscopeDispatcher.py
+
+The following module serializes every command sent to a stethoscope over a single
+RFCOMM socket.
+
+A CommandDispatcher owns the socket and one worker thread. Callers submit typed
+Command objects into a bounded priority queue and get a CommandFuture back
+immediately; the worker sends one command at a time, waits (with a timeout) for
+its response and resolves the future as ACK, NAK, TIMEOUT or ERROR.
+
+Commands that share a "group" describe a state (e.g. blending ON/OFF). A newer
+command supersedes a pending one of the same group, and a command whose state
+matches what was last sent is dropped, so a stop queued behind a start collapses
+into nothing instead of two round trips.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  heapq, socket, threading
+from    timeStamp                   import  fullStamp, monotonic
+from    stethoscopeCodec            import  codec, toBytes, ACK_BYTE, NAK_BYTE
+from    latencyStats                import  stats as latencyStats
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+# Command outcomes
+ACK         = "ACK"                                                         # Device acknowledged the command
+NAK         = "NAK"                                                         # Device refused the command
+TIMEOUT     = "TIMEOUT"                                                     # No (complete) response in time
+ERROR       = "ERROR"                                                       # The link failed while sending
+COALESCED   = "COALESCED"                                                   # Superseded before it was sent
+DROPPED     = "DROPPED"                                                     # Queue full or dispatcher stopped
+
+# Priorities (lower is served first)
+PRIORITY_CONTROL    = 0                                                     # Playback control, user actions
+PRIORITY_NORMAL     = 1                                                     # Everything else
+PRIORITY_BACKGROUND = 2                                                     # Keepalives, diagnostics
+
+# ================================================================================= #
+# Command Future
+# ================================================================================= #
+
+class CommandFuture(object):
+
+    def __init__( self ):
+        '''
+        Outcome of a submitted command, resolved by the dispatcher thread.
+        '''
+
+        self.event          = threading.Event()
+        self.lock           = threading.Lock()                              # Orders addCallback() and _resolve()
+        self.result         = None                                          # ACK | NAK | TIMEOUT | ERROR | COALESCED | DROPPED
+        self.response       = None                                          # Raw response bytes
+        self.submittedAt    = monotonic()
+        self.sentAt         = None
+        self.doneAt         = None
+        self.callbacks      = []
+
+    def done( self ):
+        return( self.event.is_set() )
+
+    def wait( self, timeout=None ):
+        '''
+        Block until resolved (or timeout); returns the result (None if still pending).
+        '''
+        self.event.wait( timeout )
+        return( self.result )
+
+    def addCallback( self, fn ):
+        '''
+        Call fn(future) once resolved (immediately if it already is).
+        Callbacks run on the dispatcher thread and must not block.
+        '''
+        with self.lock:
+            if( not self.done() ):
+                self.callbacks.append( fn )                                 # _resolve() will call it
+                return
+        fn( self )
+
+    def latency( self ):
+        '''
+        Round-trip time (sec) from send to response, None if never sent.
+        '''
+        if( self.sentAt is None or self.doneAt is None ):
+            return( None )
+        return( self.doneAt - self.sentAt )
+
+    def delivery( self ):
+        '''
+        Time (sec) from submit to response, queueing included. None if not resolved.
+        '''
+        if( self.doneAt is None ):
+            return( None )
+        return( self.doneAt - self.submittedAt )
+
+    def _resolve( self, result, response=None ):
+        with self.lock:
+            if( self.done() ):
+                return
+            self.result     = result
+            self.response   = response
+            self.doneAt     = monotonic()
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            try:
+                fn( self )
+            except Exception as instance:
+                print( fullStamp() + " Command callback failed " + str(instance.args) )
+
+# ================================================================================= #
+# Command
+# ================================================================================= #
+
+class Command(object):
+
+    __slots__ = ( "name", "outBytes", "nResponse", "priority", "group",
+                  "state", "timeout", "future", "seq" )
+
+    def __init__( self, name, outBytes, nResponse=1, priority=PRIORITY_NORMAL,
+                  group=None, state=None, timeout=None ):
+        '''
+        A single request/response exchange with the stethoscope.
+
+        INPUTS:
+            - name      : Command name (for logs and statistics)
+            - outBytes  : Bytes written to the socket
+            - nResponse : Number of response bytes to read
+            - priority  : PRIORITY_* value (lower is served first)
+            - group     : Coalescing group; commands of a group supersede each other
+            - state     : State the command sets within its group
+            - timeout   : Response timeout (sec), defaults to the dispatcher's
+        '''
+
+        self.name       = name
+        self.outBytes   = toBytes( outBytes )
+        self.nResponse  = nResponse
+        self.priority   = priority
+        self.group      = group
+        self.state      = state
+        self.timeout    = timeout
+        self.future     = CommandFuture()
+        self.seq        = 0
+
+    def __lt__( self, other ):
+        return( (self.priority, self.seq) < (other.priority, other.seq) )
+
+# Typed command helpers ----------------------------------------------------------- #
+
+def codecCommand( name, payload=None, **kwargs ):
+    '''
+    Build a Command for a row of the stethoscopeCodec table.
+    '''
+    command = codec.lookup( name )[0]
+    return( Command(name, codec.encode(name, payload), command.nResponse, **kwargs) )
+
+def enquiryCommand( priority=PRIORITY_BACKGROUND ):
+    return( codecCommand("statusEnquiry", priority=priority) )
+
+def startBlendingCommand( fileByte ):
+    return( codecCommand("startBlending", fileByte, priority=PRIORITY_CONTROL,
+                         group="blend", state=fileByte) )
+
+def stopBlendingCommand():
+    return( codecCommand("stopBlending", priority=PRIORITY_CONTROL,
+                         group="blend", state=None) )
+
+def muteCommand( muted ):
+    '''
+    Fire-and-forget mute/unmute: only the latest state goes over the link.
+    '''
+    return( codecCommand("mute" if muted else "unmute", priority=PRIORITY_CONTROL,
+                         group="mute", state=bool(muted)) )
+
+# ================================================================================= #
+# Command Dispatcher
+# ================================================================================= #
+
+class CommandDispatcher(object):
+
+    def __init__( self, rfObject, maxPending=16, timeout=2.0, drainQuiet=0.5 ):
+        '''
+        Single owner of a stethoscope socket.
+
+        INPUTS:
+            - rfObject  : Connected RFCOMM socket (None until a link is set)
+            - maxPending: Maximum number of queued commands
+            - timeout   : Default response timeout (sec)
+            - drainQuiet: Byte mode: after a timeout, late replies are discarded
+                          until the line has been quiet this long (sec)
+        '''
+
+        self.rfObject       = rfObject
+        self.maxPending     = maxPending
+        self.timeout        = timeout
+        self.drainQuiet     = drainQuiet
+
+        self.pending        = []                                            # Heap of Command
+        self.groupState     = {}                                            # group -> last state sent
+        self.gated          = False                                         # Only priority < 0 goes out (handshake)
+        self.cond           = threading.Condition()
+        self.seq            = 0
+        self.running        = False
+        self.thread         = None
+
+        self.onLinkError    = None                                          # fn(dispatcher, exception), called on the worker
+        self.stats          = dict( (k, 0) for k in (ACK, NAK, TIMEOUT, ERROR, COALESCED, DROPPED) )
+
+# ------------------------------------------------------------------------
+
+    def start( self ):
+        if( self.thread is None ):
+            self.running        = True
+            self.thread         = threading.Thread( target=self._run, name="stethoscope" )
+            self.thread.daemon  = True
+            self.thread.start()
+        return( self )
+
+# ------------------------------------------------------------------------
+
+    def stop( self ):
+        '''
+        Stop the worker thread; pending commands are resolved as DROPPED.
+        '''
+
+        with self.cond:
+            self.running = False
+            pending, self.pending = self.pending, []
+            self.cond.notify()
+
+        for command in pending:
+            self._finish( command, DROPPED )
+
+        if( self.thread is not None and self.thread is not threading.current_thread() ):
+            self.thread.join()
+        self.thread = None
+
+# ------------------------------------------------------------------------
+
+    def setLink( self, rfObject, gated=False ):
+        '''
+        Swap the socket (e.g. after a reconnect). The state of every group is
+        unknown on a fresh link, so nothing is coalesced against it.
+
+        INPUTS:
+            - rfObject  : Connected socket, None while the link is down
+            - gated     : Send only commands of priority < 0 (the handshake)
+                          until ungate() confirms the link
+        '''
+
+        with self.cond:
+            self.rfObject   = rfObject
+            self.groupState = {}
+            self.gated      = gated
+            self.cond.notify()
+
+    def ungate( self ):
+        with self.cond:
+            self.gated = False
+            self.cond.notify()
+
+# ------------------------------------------------------------------------
+
+    def submit( self, command ):
+        '''
+        Queue a command without blocking.
+
+        INPUTS:
+            - command   : Command instance
+
+        OUTPUT:
+            - CommandFuture of the command
+        '''
+
+        evicted  = []                                                       # (command, result) resolved below
+        accepted = False
+        with self.cond:
+            if( not self.running ):
+                evicted.append( (command, DROPPED) )
+
+            else:
+                if( command.group is not None ):
+                    for queued in self.pending:                             # Supersede the pending one of the group
+                        if( queued.group == command.group ):
+                            self.pending.remove( queued )
+                            heapq.heapify( self.pending )
+                            evicted.append( (queued, COALESCED) )
+                            break
+
+                if( command.group is not None and command.group in self.groupState
+                    and self.groupState[command.group] == command.state ):  # Device is already in that state
+                    evicted.append( (command, COALESCED) )
+
+                elif( len(self.pending) >= self.maxPending ):
+                    worst = max( self.pending )
+                    if( command < worst ):                                  # Make room for the more urgent one
+                        self.pending.remove( worst )
+                        heapq.heapify( self.pending )
+                        evicted.append( (worst, DROPPED) )
+                        accepted = True
+                    else:
+                        evicted.append( (command, DROPPED) )
+
+                else:
+                    accepted = True
+
+            if( accepted ):
+                self.seq        = self.seq + 1
+                command.seq     = self.seq
+                heapq.heappush( self.pending, command )
+                self.cond.notify()
+
+        for queued, result in evicted:                                      # Resolve outside the lock
+            self._finish( queued, result )
+
+        return( command.future )
+
+# ------------------------------------------------------------------------
+
+    def _run( self ):
+        '''
+        Worker loop: one command on the link at a time.
+        '''
+
+        while( True ):
+            with self.cond:
+                while( self.running and (not self.pending or self.rfObject is None or
+                                         (self.gated and self.pending[0].priority >= 0)) ):
+                    self.cond.wait()
+                if( not self.running ):
+                    return
+                command  = heapq.heappop( self.pending )
+                rfObject = self.rfObject
+                if( command.group is not None ):
+                    self.groupState[command.group] = command.state          # Assume it lands; undone on failure
+
+            result, response = self._transact( rfObject, command )
+
+            if( result != ACK and command.group is not None ):
+                with self.cond:
+                    self.groupState.pop( command.group, None )              # Device state now unknown
+
+            self._finish( command, result, response )
+
+            if( result == ERROR and self.onLinkError is not None ):
+                try:
+                    self.onLinkError( self, response )
+                except Exception as instance:
+                    print( fullStamp() + " Link error handler failed " + str(instance.args) )
+
+# ------------------------------------------------------------------------
+
+    def _transact( self, rfObject, command ):
+        '''
+        Send a command and read its response within its timeout.
+
+        OUTPUT:
+            - (result, response) ; response is the exception for ERROR
+        '''
+
+        timeout = command.timeout if command.timeout is not None else self.timeout
+        command.future.sentAt = monotonic()
+
+        try:
+            if( hasattr(rfObject, "exchange") ):                            # Framed link (rfFraming.FramedTransport)
+                response = rfObject.exchange( command.outBytes, command.nResponse, timeout )
+                return( self._decode(command, response) )
+
+            self._drain( rfObject, 0 )                                      # Nothing stale may pass for our reply
+            rfObject.settimeout( timeout )
+            rfObject.send( command.outBytes )
+
+            deadline = command.future.sentAt + timeout
+            response = b""
+            while( len(response) < command.nResponse ):
+                remaining = deadline - monotonic()
+                if( remaining <= 0 ):
+                    raise socket.timeout( "timed out" )
+                rfObject.settimeout( remaining )
+                chunk = rfObject.recv( command.nResponse - len(response) )
+                if( not chunk ):
+                    return( ERROR, IOError("Connection closed by device") )
+                response = response + toBytes( chunk )
+
+        except Exception as instance:
+            if( not isinstance(instance, socket.timeout) and
+                "timed out" not in str(instance) ):                         # PyBluez reports timeouts as BluetoothError
+                return( ERROR, instance )
+            if( not hasattr(rfObject, "exchange") ):                        # Byte mode: the reply may still come,
+                self._drain( rfObject, self.drainQuiet )                    # ... and would answer the next command
+            return( TIMEOUT, None )
+
+        return( self._decode(command, response) )
+
+# ------------------------------------------------------------------------
+
+    def _drain( self, rfObject, quiet ):
+        '''
+        Discard input until none arrived for quiet sec (0: only what is buffered).
+        '''
+        try:
+            rfObject.settimeout( quiet )
+            while( rfObject.recv(64) ):
+                pass
+        except Exception:
+            pass                                                            # Quiet (timed out / would block)
+
+# ------------------------------------------------------------------------
+
+    def _decode( self, command, response ):
+        if( command.nResponse == 1 ):
+            if( response == ACK_BYTE ): return( ACK, response )
+            if( response == NAK_BYTE ): return( NAK, response )
+            return( ERROR, IOError("Unexpected response %r" %response) )
+
+        return( ACK, response )                                             # Multi-byte answers carry data
+
+# ------------------------------------------------------------------------
+
+    def _finish( self, command, result, response=None ):
+        self.stats[result] = self.stats[result] + 1
+        command.future._resolve( result, response )
+        latencyStats.record( command.name, command.future.latency() if result in (ACK, NAK) else None, result )
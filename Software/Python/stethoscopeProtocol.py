@@ -13,509 +13,144 @@ Date        : Nov. 15th, 2017, Year of Our Lord
 Changes:-
     MODIFIED: protocol uses PyBluez instead of PySerial
     ADDED   : cleaned up code and added extra functions
+    MODIFIED: functions are generated from the command table in stethoscopeCodec.py
+    ADDED   : every exchange is timed into latencyStats.stats
+    ADDED   : functions also accept a framed link (rfFraming.FramedTransport)
     
 """
 
 # Import Libraries and/or Modules
 from    configurationProtocol       import  *
 from    bluetoothProtocol_teensy32  import  *
-from    timeStamp                   import  fullStamp
+from    timeStamp                   import  fullStamp, monotonic
+from    latencyStats                import  stats
+from    stethoscopeCodec            import  codec, toBytes, STRING, FILE, DATA
 import  stethoscopeDefinitions      as      definitions
 import  os, sys, serial
 
 
-def systemCheck( rfObject ):
-    """
-    System Check:
-    This function commands the connected stethoscope to perform
-    a "systems check", which may consist on a routine verification
-    of remote features.
-    """
-    
-    print( fullStamp() + " systemCheck()" )                                                             # Print function name
-
-    outByte = definitions.SDCHECK                                                                           # Send CHK / System Check command - see protocolDefinitions.py                     
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)                                                                           # Check for response
-
-    if inByte == definitions.ACK:                                                                       # Check for ACK / NAK response found through sendUntilRead()
-        print( fullStamp() + " ACK SD Card Check Passed" )                                              # If the SD card check is successful, the remote device sends a ACK
-        print( fullStamp() + " ACK Device Ready" )                                                      # ACK, in this case, translates to DEVICE READY
-
-    elif inByte == definitions.NAK:                                                                     # Check for ACK / NAK response found through sendUntilRead()
-        print( fullStamp() + " NAK SD Card Check Failed" )                                              # If the SD card check fails, the remote device sends a NAK
-        print( fullStamp() + " NAK Device NOT Ready" )                                                  # NAK, in this case, translates to DEVICE NOT READY
-
-#
-# Diagnostic Functions
-#       These functions deal with the status of the hardware
-#
-
-def deviceID( rfObject ):
-    """
-    Device Identification:
-    This function requests the identification of the connected device.
-    """
-    
-    outBytes = [definitions.DC1, definitions.DC1_DEVICEID]                                              # Store the sequence of bytes associated with the operation, function, feature
-    inBytes = []
-    for i in range(0,len(outBytes)):                                                                    # For loop for the sequential delivery of bytes using the length of the sequence for the range
-        rfObject.send(outBytes[i])
-        if i == (len(outBytes) - 1):                                                                    # On the last byte, the program reads the response
-            for i in range(0,3):
-                inBytes.append(rfObject.recv(1))
-
-    print inBytes
-
-#
-# Parse String
-#
-def parseString( rfObject, outString ):
-    """
-    Parse String
-    This function passes a string over bluetooth
-    """
-
-    print( fullStamp() + " parseString()" )
-
-    outByte = definitions.PSTRING
-    rfObject.send( outByte )
-    
-    rfObject.send( outString )
-    inByte = rfObject.recv(1)                      
-
-    if inByte == definitions.ACK:                     
-        print( fullStamp() + " ACK Device READY" )
-        return True
-    
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Device NOT READY" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
-
-
-#
-# SD Card Check
-#
-def sdCardCheck( rfObject ):
-    """
-    SD Card Check:
-    This function commands the connected stethoscope
-    to perform a check on the connected SD card.
-    """
-    
-    print( fullStamp() + " sdCardCheck()" )
-
-    outBytes = [definitions.DC1, definitions.DC1_SDCHECK]
-
-    for i in range( 0, len(outBytes) ):
-        rfObject.send( outBytes[i] )
-        if i == (len(outBytes) - 1):
-            inByte = rfObject.recv(1)
-
-    if inByte == definitions.ACK:
-        print( fullStamp() + " ACK SD Card Check Passed" )
-        print( fullStamp() + " ACK Device Ready" )
-
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK SD Card Check Failed" )
-        print( fullStamp() + " NAK Device NOT Ready" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
-
-
-def statusEnquiry( rfObject ):
-    """
-    State Enquiry:
-    This function requests the status of the stethoscope.
-    """
-    
-    print( fullStamp() + " statusEnquiry()" )
-
-    outByte = definitions.ENQ                    
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)                      
-
-    if inByte == definitions.ACK:                     
-        print( fullStamp() + " ACK Device READY" )
-        return True
-    
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Device NOT READY" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
-
-#
-# Operational Functions
-#       These functions deal with the normal operation of the device
-#
-
-#
-# Device-Specific Functions
-#       These functions deal with the device-specific operation or features
-#
-
-def startRecording( rfObject ):
-    """
-    Start Recording:
-    This function commands the connected stethoscope to begin recording audio.
-    """
-    
-    print( fullStamp() + " startRecording()" )
-
-    outByte = definitions.STARTREC                  
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)
-    
-    if inByte == definitions.ACK:                   
-        print( fullStamp() + " ACK Stethoscope will START RECORDING" )
-
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT START RECORDING" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
-
-def startCustomRecording( rfObject, outString ):
-    """
-    Start Custom Recording
-    Begins recording to be saved undr a custom filename
-    """
-
-    print( fullStamp() + " startCustomRecording()" )
-    print( fullStamp() + " Parsing STARTCREC Byte" )
-    outByte = definitions.STARTCREC
-    rfObject.send( outByte )
-
-    #print( fullStamp() + " Parsing custom recording string = " + outString )
-    rfObject.send( outString )
-    inByte = rfObject.recv(1)                      
-
-    if inByte == definitions.ACK:                     
-        print( fullStamp() + " ACK Device will START RECORDING" )
-        print( fullStamp() + " ACK Device will RECORD under the " + outString + " filename")
-        return True
-    
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Device CANNOT START RECORDING" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
-
-def stopRecording( rfObject ):
-    """
-    Stop Recording:
-    This function commands the connected stethoscope to stop recording audio.
-    """
-    
-    print( fullStamp() + " stopRecording()" )
-
-    outByte = definitions.STOPREC                     
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)                          
-
-    if inByte == definitions.ACK:                               
-        print( fullStamp() + " ACK Stethoscope will STOP RECORDING" )
-
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT STOP RECORDING" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
-
-
-def startMicStream( rfObject ):
-    """
-    Start Microphone Streaming:
-    This function commands the connected stethoscope to begin
-    streaming audio from the microphone to the connected speakers.
-    """
-    
-    print( fullStamp() + " startMicStream()" )
-
-    outBytes = [definitions.DC3, definitions.DC3_STARTSTREAM]
-
-    for i in range(0,len(outBytes)):
-        rfObject.send(outBytes[i])
-        if i == (len(outBytes) - 1):
-            inByte = rfObject.recv(1)
-
-    if inByte == definitions.ACK:
-        print( fullStamp() + " ACK Stethoscope will START STREAMING" )
-
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT START STREAMING" )
-
-
-def startTrackingMicStream( rfObject ):
-    """
-    Start Tracking Microphone Stream for Peaks:
-    This function commands the connected stethoscope to stop streaming
-    audio from the microphone and find/detect peaks.
-    """
-    
-    print( fullStamp() + " startTrackingMicStream()" )     
-
-    outByte = definitions.STARTTRACKING      
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)                  
-
-    if inByte == definitions.ACK:                  
-        print( fullStamp() + " ACK Device will START Tracking" )  
-
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Device CANNOT START Tracking" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
-
-
-def stopTrackingMicStream( rfObject ):
-    """
-    Stop Tracking Microphone Stream for Peaks:
-    This function commands the connected stethoscope to
-    stop finding/detecting peaks.
-    """
-    
-    print( fullStamp() + " stopTrackingMicStream()" )           
-
-    outByte = definitions.STOPTRACKING                 
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)                       
-
-    if inByte == definitions.ACK:                                    
-        print( fullStamp() + " ACK Device will STOP Tracking" )    
-
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Device CANNOT STOP Tracking" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
+VERBOSE = False                                                                                         # Also print ACK messages (NAKs are always reported)
+FRAMED_TIMEOUT = 2.0                                                                                    # Response timeout on framed links (sec)
 
 #
-# Simulation Functions
-#       These functions deal with the simulations corresponding to the connected device
+# Generated Functions
+#       One function per row of stethoscopeCodec.COMMANDS, e.g.
+#           statusEnquiry( rfObject )                       -> True (ACK) | False (NAK) | None
+#           startBlending( rfObject, definitions.KOROT )    -> True (ACK) | False (NAK) | None
+#           startCustomRecording( rfObject, outString )     -> True (ACK) | False (NAK) | None
+#           deviceID( rfObject )                            -> response bytes
 #
 
-def normalHBPlayback( rfObject ):
+def _transact( rfObject, nResponse, outBytes ):
     """
-    Normal Heart Beat Playback:
-    This function triggers the playback of a normal heart beat.
+    Send the encoded command and read its response.
     """
-    
-    print( fullStamp() + " normalHBPlayback()" )       
 
-    outByte = definitions.NORMALHB                   
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)                           
+    if( hasattr(rfObject, "exchange") ):                                                                # Framed link, see rfFraming.py
+        return rfObject.exchange( outBytes, nResponse, FRAMED_TIMEOUT )
 
-    if inByte == definitions.ACK:                
-        print( fullStamp() + " ACK Stethoscope will START PLAYBACK of NORMAL HEARTBEAT" )
+    rfObject.send( outBytes )
+    inBytes = b""
+    while( len(inBytes) < nResponse ):
+        chunk = rfObject.recv( nResponse - len(inBytes) )
+        if( not chunk ):
+            break
+        inBytes = inBytes + toBytes( chunk )
 
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT START PLAYBACK of NORMAL HEARTBEAT" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
+    return inBytes
 
 
-def earlyHMPlayback( rfObject ):
+def _report( command, result ):
     """
-    Early Systolic Heart Murmur:
-    This function triggers the playback of an early systolic heart mumur.
+    Report the outcome using the messages compiled into the command.
     """
-    
-    print( fullStamp() + " earlyHMPlayback()" )    
-
-    outByte = definitions.ESHMURMUR 
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)  
-
-    if inByte == definitions.ACK:       
-        print( fullStamp() + " ACK Stethoscope will START PLAYBACK of EARLY SYSTOLIC HEART MUMUR" )
 
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT START PLAYBACK of EARLY SYSTOLIC HEART MUMUR" ) 
-
-    else:
+    if( result is None ):
         print( fullStamp() + " Please troubleshoot device" )
+    elif( result is False ):
+        print( fullStamp() + command.nakMessage )
+    elif( VERBOSE ):
+        print( fullStamp() + command.ackMessage )
 
 
-def stopPlayback( rfObject ):
+def _timed( name, rfObject, nResponse, outBytes ):
     """
-    Stop Playback:
-    This function commands the connected stethoscope to stop
-    playing an audio file stored within the SD card.
+    _transact() + decode, recording round-trip time and outcome.
     """
-    
-    print( fullStamp() + " stopPlayback()" )      
 
-    outByte = definitions.STOPPLAY          
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)          
-
-    if inByte == definitions.ACK:               
-        print( fullStamp() + " ACK Stethoscope will STOP PLAYBACK" )                                                       
-
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT STOP PLAYBACK" )
+    t0 = monotonic()
+    try:
+        inBytes = _transact( rfObject, nResponse, outBytes )
+    except Exception:
+        stats.record( name, None, "ERROR" )
+        raise
 
+    result = codec.decodeResponse( name, inBytes )
+    if( result is None ):
+        stats.record( name, None, "TIMEOUT" )                                                           # Incomplete or unexpected answer
     else:
-        print( fullStamp() + " Please troubleshoot device" )
+        stats.record( name, monotonic() - t0, "NAK" if result is False else "ACK" )
+    return result
 
 
-def earlyHMBlending( rfObject ):
+def _makeFunction( name ):
     """
-    Early Systolic Heart Murmur:
-    This function triggers the playback of an early systolic heart mumur.
+    Build the public function for a command (or alias) of the table.
     """
-    
-    print( fullStamp() + " earlyHMBlending()" )
 
-    outByte = definitions.STARTBLEND    
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)             
+    command, fixed  = codec.lookup( name )
+    nResponse       = command.nResponse
 
-    if inByte == definitions.ACK:           
-        print( fullStamp() + " ACK Stethoscope will START BLENDING of EARLY SYSTOLIC HEART MUMUR" )                                                       
+    if( command.payload is None or fixed is not None ):
+        outBytes = codec.encode( name )                                                                 # Encoded once, at import
 
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT START BLENDING of EARLY SYSTOLIC HEART MUMUR" )
+        def function( rfObject ):
+            result = _timed( name, rfObject, nResponse, outBytes )
+            _report( command, result )
+            return result
 
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
-
-
-def startBlending( rfObject, fileByte ):
-    """
-    Start Blending:
-    This function starts blending of audio file.
-    """
-    
-    print( fullStamp() + " startBlending()" )         
-
-    outByte = fileByte                                  
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)              
-
-    if inByte == definitions.ACK:               
-        print( fullStamp() + " ACK Stethoscope will START BLENDING" )
-
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT START BLENDING" )
+    elif( command.payload == STRING ):
+        def function( rfObject, outString ):
+            result = _timed( name, rfObject, nResponse, codec.encode(name, outString) )
+            _report( command, result )
+            return result
 
     else:
-        print( fullStamp() + " Please troubleshoot device" )
-
-
-def stopBlending( rfObject ):
-    """
-    Stop Blending:
-    This function stops blending of audio file.
-    """
-    
-    print( fullStamp() + " stopBlending()" )              
+        def function( rfObject, fileByte ):
+            result = _timed( name, rfObject, nResponse, codec.encode(name, fileByte) )
+            _report( command, result )
+            return result
 
-    outByte = definitions.STOPBLEND                     
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)                                 
+    function.__name__   = name
+    function.__doc__    = ( "%s:\nSends %r and returns %s." %(name, command.code or "<fileByte>",
+                            "the response bytes" if command.response == DATA else "True on ACK, False on NAK") )
+    return function
 
-    if inByte == definitions.ACK:                   
-        print( fullStamp() + " ACK Stethoscope will STOP BLENDING" )
 
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT STOP BLENDING" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
-
-
-def startBPNorm( rfObject ):
-    """
-    Normal Heartrate:
-    This function starts Normal Heartrate playback.
-    """
-    
-    print( fullStamp() + " startBPNorm()" )
-
-    outByte = definitions.STARTBPNORM
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)
-
-    if inByte == definitions.ACK:
-        print( fullStamp() + " ACK Stethoscope will START NORMAL playback" )    
-
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT START NORMAL playback" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
+for _name in list( codec.byName ) + list( codec.aliases ):
+    globals()[ _name ] = _makeFunction( _name )
 
 
-def startBPBrady( rfObject ):
+def sendBatch( rfObject, commands ):
     """
-    Bradycardia:
-    This function starts Bradycardia playback.
-    """
-    
-    print( fullStamp() + " startBPBrady()" )
-
-    outByte = definitions.STARTBPBRADY
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)
-    
-    if inByte == definitions.ACK:
-        print( fullStamp() + " ACK Stethoscope will START PLAYBACK of BRADYCARDIA" )    
-
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT START BRADYCARDIA" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
-
+    Send Batch:
+    This function sends several commands in a single write and
+    reads all of their responses.
 
-def startBPTachy( rfObject ):
+    commands is a list of (name, payload) tuples, e.g.
+        sendBatch( rfObject, [("stopBlending", None), ("startBPBrady", None)] )
     """
-    Tachycardia:
-    This function starts Tachycardia playback.
-    """
-    
-    print( fullStamp() + " startBPTachy()" )
 
-    outByte = definitions.STARTBPTACHY
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)
-    
-    if inByte == definitions.ACK:
-        print( fullStamp() + " ACK Stethoscope will START PLAYBACK of TACHYCARDIA" )
-            
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT START TACHYCARDIA" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
+    outBytes, nResponse = codec.encodeBatch( commands )
+    t0 = monotonic()
+    inBytes = _transact( rfObject, nResponse, outBytes )
+    stats.record( "batch", monotonic() - t0 if len(inBytes) == nResponse else None,
+                  "ACK" if len(inBytes) == nResponse else "TIMEOUT" )
 
+    results = []
+    for name, payload in commands:
+        command = codec.lookup( name )[0]
+        results.append( codec.decodeResponse(name, inBytes[:command.nResponse]) )
+        inBytes = inBytes[command.nResponse:]
 
-def stopBPAll( rfObject ):
-    """
-    Stop All:
-    This function stops all augmentation.
-    """
-    
-    print( fullStamp() + " stopBPAll()" )
-
-    outByte = definitions.STOPBPALL
-    rfObject.send(outByte)
-    inByte = rfObject.recv(1)
-    
-    if inByte == definitions.ACK:
-        print( fullStamp() + " ACK Stethoscope will STOP AUGMENTING" )
-            
-    elif inByte == definitions.NAK:
-        print( fullStamp() + " NAK Stethoscope CANNOT STOP AUGMENTING" )
-
-    else:
-        print( fullStamp() + " Please troubleshoot device" )
+    return results
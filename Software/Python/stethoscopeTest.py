@@ -1,51 +1,40 @@
-
 # Import
 import sys
-import os
-import serial
-from   os.path               import expanduser
-from   configurationProtocol import *
-from   bluetoothProtocol     import *
-from   stethoscopeProtocol   import *
+import time
+import argparse
+from   bluetoothProtocol_teensy32 import *
+from   stethoscopeProtocol        import *
+from   fakeStethoscope            import FakeStethoscope
 
 # =========
 # OPERATION
 # =========
 
+ap = argparse.ArgumentParser()
+ap.add_argument( "--fake", action="store_true", help="Run against fakeStethoscope instead of hardware" )
+args = vars( ap.parse_args() )
+
 deviceName = "SS"
 deviceBTAddress = "00:06:66:86:60:3D"
-rfObject = createPort(deviceName, deviceBTAddress, 115200, 5, 5)
+if args["fake"]:
+    fake = FakeStethoscope( latency=0.02 )
+    rfObject = fake.socketPair()
+else:
+    rfObject = createBTPort(deviceBTAddress, 1)
 
-time.sleep(1)
-if rfObject.isOpen() == False:
-    rfObject.open()
 sdCardCheck(rfObject)
-rfObject.close()
-
 
 time.sleep(2)
-if rfObject.isOpen() == False:
-    rfObject.open()
 startRecording(rfObject)
 #startTrackingMicStream(rfObject)
-rfObject.close()
 
+time.sleep(2 if args["fake"] else 30)
 
-time.sleep(30)
-
-time.sleep(2)
-if rfObject.isOpen() == False:
-    rfObject.open()
 stopRecording(rfObject)
 #stopTrackingMicStream(rfObject)
-rfObject.close()
 
 """
-time.sleep(1)
-if rfObject.isOpen() == False:
-    rfObject.open()
 sdCardCheck(rfObject)
-rfObject.close()
 """
 
-portRelease('rfcomm', 0)
+closeBTPort(rfObject)
@@ -25,6 +25,41 @@ def stampedFolder():
     folderName = "/" + fullStamp()
     return folderName
 
+# Monotonic clock for measuring intervals and timeouts (immune to wall-clock changes).
+# Python 2 has no time.monotonic(), so read CLOCK_MONOTONIC through ctypes there;
+# only where that is unavailable too (not Linux) is the wall clock used.
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    import ctypes, ctypes.util
+
+    CLOCK_MONOTONIC = 1                                                     # <linux/time.h>
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    def _clockGettime():
+        for name in ("librt.so.1", ctypes.util.find_library("c")):
+            try:
+                fn = ctypes.CDLL(name, use_errno=True).clock_gettime
+            except (OSError, AttributeError, TypeError):
+                continue
+            fn.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+            return fn
+        return None
+
+    _clock_gettime = _clockGettime()
+
+    if _clock_gettime is None:
+        monotonic = time.time
+    else:
+        def monotonic():
+            t = _timespec()
+            if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t.tv_sec + t.tv_nsec * 1e-9
+
 
 """
 References
@@ -0,0 +1,131 @@
+"""
+triggerEngine.py
+
+The following module turns a noisy pressure signal into clean simulation
+transitions.
+
+Switching playback the moment the filtered pressure crosses exactly 75 or 125
+mmHg makes noise near a boundary fire a burst of Bluetooth commands. A
+TriggerEngine instead:
+    - enters a band inside [low, high] but only leaves it outside
+      [low - hysteresis, high + hysteresis],
+    - commits a change only after the new state has held for minDwell seconds,
+    - never commits two changes less than minInterval seconds apart.
+It counts the raw boundary crossings it saw next to the transitions it made, so
+the number of suppressed commands is known.
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+from    timeStamp                   import  monotonic
+
+# ================================================================================= #
+# Trigger Engine
+# ================================================================================= #
+
+class TriggerEngine(object):
+
+    def __init__( self, bands, hysteresis=3.0, minDwell=0.3, minInterval=0.5,
+                  onChange=None, clock=monotonic ):
+        '''
+        Debounced band detector.
+
+        INPUTS:
+            - bands      : list of (name, low, high) ; bands must not overlap
+            - hysteresis : Extra margin (same unit as the signal) needed to leave a band
+            - minDwell   : Time (sec) a new state must hold before it is committed
+            - minInterval: Minimum time (sec) between two committed transitions
+            - onChange   : fn(old, new) called on every committed transition
+                           (band names, None outside every band)
+            - clock      : Time source (sec)
+        '''
+
+        self.bands          = [ (name, float(low), float(high)) for name, low, high in bands ]
+        self.hysteresis     = hysteresis
+        self.minDwell       = minDwell
+        self.minInterval    = minInterval
+        self.onChange       = onChange
+        self.clock          = clock
+
+        self.state          = None                                          # Committed band (None: outside)
+        self.pending        = None                                          # Candidate band ...
+        self.pendingSince   = None                                          # ... and since when it holds (None: nothing pending)
+        self.lastChange     = None                                          # Time of the last committed transition
+        self.rawState       = None                                          # Band without hysteresis/debounce
+
+        self.crossings      = 0                                             # Raw boundary crossings
+        self.transitions    = 0                                             # Committed transitions (= commands)
+
+# ------------------------------------------------------------------------
+
+    def suppressed( self ):
+        '''
+        Number of commands a plain threshold trigger would have sent on top of ours.
+        '''
+        return( max(0, self.crossings - self.transitions) )
+
+# ------------------------------------------------------------------------
+
+    def stats( self ):
+        return( { "state"       : self.state,
+                  "crossings"   : self.crossings,
+                  "transitions" : self.transitions,
+                  "suppressed"  : self.suppressed() } )
+
+# ------------------------------------------------------------------------
+
+    def _band( self, value, margin ):
+        for name, low, high in self.bands:
+            if( low - margin <= value <= high + margin ):
+                return( name )
+        return( None )
+
+# ------------------------------------------------------------------------
+
+    def update( self, value, now=None ):
+        '''
+        Feed one sample.
+
+        INPUTS:
+            - value     : Signal value (e.g. filtered pressure in mmHg)
+            - now       : Sample time (sec), defaults to the clock
+
+        OUTPUT:
+            - True if this sample committed a transition (see self.state)
+        '''
+
+        now = self.clock() if now is None else now
+
+        raw = self._band( value, 0 )                                        # What a plain threshold would do
+        if( raw != self.rawState ):
+            self.rawState   = raw
+            self.crossings  = self.crossings + 1
+
+        if( self.state is not None and self._band(value, self.hysteresis) == self.state ):
+            candidate = self.state                                          # Still within the widened band
+        else:
+            candidate = raw
+
+        if( candidate == self.state ):
+            self.pending, self.pendingSince = None, None                    # Noise excursion is over
+            return( False )
+
+        if( self.pendingSince is None or candidate != self.pending ):       # pending may be None (leaving the bands)
+            self.pending        = candidate                                 # Start timing the new state
+            self.pendingSince   = now
+
+        if( now - self.pendingSince < self.minDwell ):
+            return( False )
+        if( self.lastChange is not None and now - self.lastChange < self.minInterval ):
+            return( False )                                                 # Rate cap: retried on later samples
+
+        old, self.state     = self.state, candidate
+        self.pending        = None
+        self.pendingSince   = None
+        self.lastChange     = now
+        self.transitions    = self.transitions + 1
+        if( self.onChange is not None ):
+            self.onChange( old, self.state )
+        return( True )
@@ -0,0 +1,307 @@
+"""
+wavTransfer.py
+
+The following module pulls recordings off the stethoscope SD card (SENDWAV).
+
+SENDWAV is only available on framed links (see rfFraming.py): in byte mode its
+code collides with the DC3 prefix. Inside a frame the length disambiguates, so a
+transfer request is a body starting with DC2 DC2_SENDWAV:
+
+    INFO  : DC2 DC2_SENDWAV 'I' <name>                          -> ACK size(u32) crc32(u32) | NAK
+    READ  : DC2 DC2_SENDWAV 'R' offset(u32) length(u16) <name>  -> ACK offset(u32) <data>   | NAK
+
+Requests are stateless on the device, so a transfer can resume anywhere. The
+client keeps a window of READ requests in flight, checks every chunk (frame CRC16
+plus offset) and writes them to <file>.part in order as they become contiguous,
+so memory use is bounded by the window, not the file. A small JSON sidecar
+records the verified length; an interrupted transfer resumes from there. The
+whole file is checked against the device's CRC32 before the .part file is
+renamed into place.
+
+The device answers requests in the order they were sent, so replies are taken as
+they come (receiveAny): a reply to a later request means every request sent
+before it that is still unanswered was lost, and those are re-requested at once
+(fast retransmit) instead of after the full timeout. The timeout only applies
+when nothing at all arrives.
+
+Against the fake device:
+    python wavTransfer.py --fake --size 2000000 --latency 0.02 --window 8
+"""
+
+# ================================================================================= #
+# Import Libraries and/or Modules
+# ================================================================================= #
+
+import  json, os, socket, struct, zlib
+import  protocolDefinitions         as      dcDefinitions
+from    stethoscopeCodec            import  toBytes, ACK_BYTE
+from    rfFraming                   import  FramedTransport, MAX_BODY
+from    timeStamp                   import  fullStamp, monotonic
+
+# ================================================================================= #
+# Definitions
+# ================================================================================= #
+
+SENDWAV     = toBytes( dcDefinitions.DC2 + dcDefinitions.DC2_SENDWAV )     # Framed-only request prefix
+INFO        = b"I"
+READ        = b"R"
+MAX_CHUNK   = MAX_BODY - 1 - 4                                              # Response: ACK + offset + data
+
+class TransferError(Exception):
+    """
+    The device refused the transfer, or the file did not verify.
+    """
+    pass
+
+def infoRequest( name ):
+    return( SENDWAV + INFO + toBytes(name) )
+
+def readRequest( name, offset, length ):
+    return( SENDWAV + READ + struct.pack(">IH", offset, length) + toBytes(name) )
+
+def parseRequest( body ):
+    '''
+    Device side: decode a transfer request.
+
+    OUTPUT:
+        - (kind, name, offset, length) ; None if body is not a transfer request
+    '''
+    if( body[:len(SENDWAV)] != SENDWAV or len(body) < len(SENDWAV) + 1 ):
+        return( None )
+    kind, rest = body[len(SENDWAV):len(SENDWAV)+1], body[len(SENDWAV)+1:]
+    if( kind == INFO ):
+        return( INFO, rest, 0, 0 )
+    if( kind == READ and len(rest) >= 6 ):
+        offset, length = struct.unpack( ">IH", rest[:6] )
+        return( READ, rest[6:], offset, length )
+    return( None )
+
+# ================================================================================= #
+# WAV Transfer
+# ================================================================================= #
+
+class WavTransfer(object):
+
+    def __init__( self, transport, chunkSize=MAX_CHUNK, window=8, timeout=2.0, retries=3,
+                  checkpoint=64 ):
+        '''
+        Bulk, resumable SD card transfers over a framed link.
+
+        INPUTS:
+            - transport : rfFraming.FramedTransport (exclusive use during a transfer)
+            - chunkSize : Bytes per READ (at most MAX_CHUNK)
+            - window    : READ requests in flight
+            - timeout   : Response timeout per request (sec)
+            - retries   : Re-requests of a chunk before giving up
+            - checkpoint: Chunks between two sidecar updates
+        '''
+
+        if( not isinstance(transport, FramedTransport) ):
+            raise TransferError( "WAV transfer needs a framed link (device is in legacy mode)" )
+
+        self.transport  = transport
+        self.chunkSize  = min( chunkSize, MAX_CHUNK )
+        self.window     = window
+        self.timeout    = timeout
+        self.retries    = retries
+        self.checkpoint = checkpoint
+        self.sent       = 0                                                 # READ requests sent so far
+
+# ------------------------------------------------------------------------
+
+    def info( self, name ):
+        '''
+        OUTPUT:
+            - (size, crc32) of a file on the SD card
+        '''
+        body = self.transport.exchange( infoRequest(name), None, self.timeout )
+        if( body[:1] != ACK_BYTE or len(body) != 9 ):
+            raise TransferError( "Device has no file %r" %name )
+        return( struct.unpack(">II", body[1:9]) )
+
+# ------------------------------------------------------------------------
+
+    def fetch( self, name, destination, progress=None ):
+        '''
+        Copy a file from the SD card, resuming a previous partial copy.
+
+        INPUTS:
+            - name        : File name on the SD card
+            - destination : Local path
+            - progress    : Optional fn(done, size) called after every chunk
+
+        OUTPUT:
+            - dict with size, resumedAt, seconds, throughput (bytes/sec), retries
+        '''
+
+        size, crc = self.info( name )
+        part      = destination + ".part"
+        sidecar   = part + ".json"
+        offset    = self._resumePoint( name, size, crc, part, sidecar )
+
+        t0        = monotonic()
+        stats     = { "size": size, "resumedAt": offset, "retries": 0 }
+        running   = self._crcOf( part, offset )                             # CRC32 of what is already verified
+
+        with open( part, "r+b" if os.path.exists(part) else "wb" ) as f:
+            f.truncate( offset )
+            f.seek( offset )
+
+            nextRequest = offset                                            # Next offset to ask for
+            inflight    = {}                                                # seq -> [offset, length, attempts, sent #]
+            arrived     = {}                                                # offset -> data, waiting to be contiguous
+            chunks      = 0
+
+            while( offset < size ):
+                requests = []
+                while( len(inflight) + len(requests) < self.window and nextRequest < size ):
+                    length = min( self.chunkSize, size - nextRequest )
+                    requests.append( [nextRequest, length, 0] )
+                    nextRequest = nextRequest + length
+                self._send( name, requests, inflight )
+
+                try:
+                    seq, body = self.transport.receiveAny( list(inflight), self.timeout )
+                except socket.timeout:
+                    seq = None                                              # Nothing came back at all
+
+                if( seq is None ):
+                    lost = list( inflight )
+                else:
+                    start, length, attempts, sent = inflight.pop( seq )
+                    data = self._check( body, start, length )
+                    lost = [ s for s in inflight if inflight[s][3] < sent ]   # Overtaken: never answered
+                    if( data is None ):
+                        inflight[seq] = [start, length, attempts, sent]     # Bad: ask again
+                        lost.append( seq )
+
+                retry = sorted( inflight.pop(s) for s in lost )
+                self.transport.cancel( lost )
+                for request in retry:
+                    if( request[2] >= self.retries ):
+                        self._saveSidecar( sidecar, name, size, crc, offset )
+                        raise TransferError( "Chunk at %d failed %d times" %(request[0], request[2]+1) )
+                stats["retries"] += len( retry )
+                self._send( name, [[r[0], r[1], r[2]+1] for r in retry], inflight )
+                if( seq is None or data is None ):
+                    continue
+
+                arrived[start] = data
+                while( offset in arrived ):                                 # Stream out in order
+                    data    = arrived.pop( offset )
+                    f.write( data )
+                    running = zlib.crc32( data, running )
+                    offset  = offset + len( data )
+                    chunks  = chunks + 1
+                    if( chunks % self.checkpoint == 0 ):
+                        f.flush()
+                        self._saveSidecar( sidecar, name, size, crc, offset )
+                if( progress is not None ):
+                    progress( offset, size )
+
+        if( (running & 0xFFFFFFFF) != crc ):
+            os.remove( part )
+            self._removeSidecar( sidecar )
+            raise TransferError( "CRC32 mismatch for %r, partial copy discarded" %name )
+
+        os.rename( part, destination )
+        self._removeSidecar( sidecar )
+
+        stats["seconds"]    = monotonic() - t0
+        stats["throughput"] = ( size - stats["resumedAt"] ) / max( stats["seconds"], 1e-9 )
+        print( fullStamp() + " Fetched %s (%d bytes, %.1f kB/s, %d retries)"
+               %(name, size, stats["throughput"]/1e3, stats["retries"]) )
+        return( stats )
+
+# ------------------------------------------------------------------------
+
+    def _send( self, name, requests, inflight ):
+        if( not requests ):
+            return
+        seqs = self.transport.sendMany( [readRequest(name, r[0], r[1]) for r in requests] )
+        for seq, request in zip( seqs, requests ):
+            self.sent = self.sent + 1
+            inflight[seq] = request[:3] + [self.sent]                       # Send order, to spot lost ones
+
+# ------------------------------------------------------------------------
+
+    def _check( self, body, start, length ):
+        '''
+        A chunk is good if the device ACKed it for the offset asked and it is complete.
+        (The frame CRC16 already covered the bytes.)
+        '''
+        if( body[:1] != ACK_BYTE or len(body) != 5 + length ):
+            return( None )
+        if( struct.unpack(">I", body[1:5])[0] != start ):
+            return( None )
+        return( body[5:] )
+
+# ------------------------------------------------------------------------
+
+    def _resumePoint( self, name, size, crc, part, sidecar ):
+        '''
+        Verified length of a previous partial copy of the same file, else 0.
+        '''
+        try:
+            with open( sidecar ) as f:
+                state = json.load( f )
+        except (IOError, OSError, ValueError):
+            return( 0 )
+        if( state.get("name") != name or state.get("size") != size or state.get("crc") != crc
+            or not os.path.exists(part) ):
+            return( 0 )
+        return( min(state.get("offset", 0), os.path.getsize(part)) )
+
+    def _crcOf( self, path, length ):
+        running = 0
+        if( length ):
+            with open( path, "rb" ) as f:
+                while( length > 0 ):
+                    data    = f.read( min(65536, length) )
+                    running = zlib.crc32( data, running )
+                    length  = length - len( data )
+        return( running )
+
+    def _saveSidecar( self, sidecar, name, size, crc, offset ):
+        with open( sidecar + ".tmp", "w" ) as f:
+            json.dump( {"name": name, "size": size, "crc": crc, "offset": offset}, f )
+        os.rename( sidecar + ".tmp", sidecar )
+
+    def _removeSidecar( self, sidecar ):
+        if( os.path.exists(sidecar) ):
+            os.remove( sidecar )
+
+# ================================================================================= #
+# Stand-alone
+# ================================================================================= #
+
+if __name__ == "__main__":
+    import argparse
+    from rfFraming import negotiate
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument( "--name", default="HDEMO18", help="File on the SD card" )
+    ap.add_argument( "--out", default=None, help="Destination (default: dataOutput/<name>)" )
+    ap.add_argument( "--address", default=None, help="Stethoscope Bluetooth address" )
+    ap.add_argument( "--window", type=int, default=8, help="Requests in flight" )
+    ap.add_argument( "--fake", action="store_true", help="Use fakeStethoscope" )
+    ap.add_argument( "--size", type=int, default=1000000, help="Fake file size (bytes)" )
+    ap.add_argument( "--latency", type=float, default=0.02, help="Fake device latency (sec)" )
+    ap.add_argument( "--drop", type=float, default=0.0, help="Fake device drop rate" )
+    args = vars( ap.parse_args() )
+
+    if( args["fake"] ):
+        from fakeStethoscope import FakeStethoscope
+        fake = FakeStethoscope( latency=args["latency"], dropRate=args["drop"], framing=True, seed=1 )
+        fake.files[ args["name"] ] = os.urandom( args["size"] )
+        sock = fake.socketPair()
+    else:
+        from connectionManager import openRFCOMM
+        sock = openRFCOMM( args["address"], 1, 10.0 )
+
+    out = args["out"] or os.path.join( os.getcwd(), "dataOutput", args["name"] )
+    if( not os.path.isdir(os.path.dirname(out)) ):
+        os.makedirs( os.path.dirname(out) )
+
+    transfer = WavTransfer( negotiate(sock), window=args["window"] )
+    transfer.fetch( args["name"], out )
@@ -3,5 +3,5 @@
 
 cd ~/
 cd Desktop/AugmentedBloodPressureCuff/
-sudo python pressureDialGauge.py
+sudo python pressureDialGauge_GUI.py --daemon       # Warm dial the launchers attach to (cuffDaemon.py), the only ADC reader
 cd ~/